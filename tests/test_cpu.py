@@ -0,0 +1,654 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import os
+import json
+import tempfile
+import unittest
+import unittest.mock
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from tutel import moe as tutel_moe
+from tutel.impls.communicate import exchange_counts, get_2dh_groups, get_world_rank
+from tutel.benchmark.runner import get_free_port
+
+
+def distributed_worker(rank, world_size, port, check_fn, args):
+    """Runs `check_fn(rank, world_size, *args)` in a gloo process group of spawned CPU processes."""
+    dist.init_process_group('gloo', init_method='tcp://127.0.0.1:%d' % port, rank=rank, world_size=world_size)
+    try:
+        check_fn(rank, world_size, *args)
+    finally:
+        dist.destroy_process_group()
+
+
+def run_distributed(check_fn, world_size, *args):
+    mp.spawn(distributed_worker, args=(world_size, get_free_port(), check_fn, args), nprocs=world_size)
+
+
+def forward_backward(moe, x, samples=None):
+    """Output and gradients of input and parameters after one step, with loss over the leading `samples` rows."""
+    moe.zero_grad()
+    x = x.detach().clone().requires_grad_()
+    y = moe(x)[:samples]
+    (y * y).sum().backward()
+    return [y.detach(), x.grad[:samples]] + [param.grad for param in moe.parameters()]
+
+
+def check_allclose(expected, results, atol=1e-5):
+    for i, (a, b) in enumerate(zip(expected, results)):
+        assert (a is None) == (b is None) and (a is None or torch.allclose(a, b, atol=atol)), 'Mismatch of result %d: %s vs %s' % (i, a, b)
+
+
+def check_2dh_all_to_all(rank, world_size):
+    os.environ['LOCAL_SIZE'] = '2'
+    assert get_2dh_groups(dist.group.WORLD) is not None
+    torch.manual_seed(rank)
+    x = torch.randn([16, 8])
+    moe = tutel_moe.moe_layer(
+        gate_type={'type': 'top', 'k': 2, 'capacity_factor': 2.0},
+        model_dim=8,
+        experts={'type': 'ffn', 'count_per_node': 2, 'hidden_size_per_expert': 16},
+        seeds=(1, rank + 1),
+    )
+    moe.use_2dh = False
+    expected = forward_backward(moe, x)
+    moe.use_2dh = True
+    check_allclose(expected, forward_backward(moe, x))
+
+
+def check_dropless(rank, world_size):
+    torch.manual_seed(rank)
+    # Ranks have different sample sizes, and shifted inputs route uneven token counts to experts
+    samples, max_samples = 8 * (rank + 1), 8 * world_size
+    x = torch.randn([samples, 8]) + rank
+    def create_moe(dropless):
+        # Capacity of the reference layer covers every token routed from one rank to one expert
+        return tutel_moe.moe_layer(
+            gate_type={'type': 'top', 'k': 2, 'dropless': dropless, 'capacity_factor': float(2 * world_size)},
+            model_dim=8,
+            experts={'type': 'ffn', 'count_per_node': 2, 'hidden_size_per_expert': 16},
+            seeds=(1, rank + 1),
+        )
+    moe, reference = create_moe(True), create_moe(False)
+
+    send_counts = torch.bincount(torch.topk(moe.gate.wg(x), 2).indices.view(-1), minlength=2 * world_size)
+    all_counts = [torch.empty_like(send_counts) for _ in range(world_size)]
+    dist.all_gather(all_counts, send_counts)
+    assert any(not torch.equal(all_counts[0], counts) for counts in all_counts[1:])
+    recv_counts = exchange_counts(dist.group.WORLD, send_counts)
+    assert torch.equal(recv_counts, torch.stack([counts.view(world_size, 2)[rank] for counts in all_counts]).view(-1))
+
+    padded_x = torch.cat([x, x.new_zeros([max_samples - samples, 8])])
+    check_allclose(forward_backward(reference, padded_x, samples), forward_backward(moe, x))
+
+
+def check_pipelined_all_to_all(rank, world_size):
+    torch.manual_seed(rank)
+    x = torch.randn([32, 8])
+    moe = tutel_moe.moe_layer(
+        gate_type={'type': 'top', 'k': 2},
+        model_dim=8,
+        experts={'type': 'ffn', 'count_per_node': 2, 'hidden_size_per_expert': 16},
+        seeds=(1, rank + 1),
+    )
+    expected = forward_backward(moe, x)
+    # Auto mode takes a warm-up step and one step per candidate degree before settling, which all must match
+    for overlap_degree, steps in ((2, 1), (3, 1), ('auto', 6)):
+        moe.a2a_ffn_overlap_degree = overlap_degree
+        for _ in range(steps):
+            check_allclose(expected, forward_backward(moe, x))
+    assert moe.gate._auto_overlap_degree in (1, 2, 4, 8)
+
+
+def check_compressed_all_to_all(rank, world_size):
+    torch.manual_seed(rank)
+    x = torch.randn([32, 8])
+    moe = tutel_moe.moe_layer(
+        gate_type={'type': 'top', 'k': 2},
+        model_dim=8,
+        experts={'type': 'ffn', 'count_per_node': 2, 'hidden_size_per_expert': 16},
+        seeds=(1, rank + 1),
+    )
+    expected = forward_backward(moe, x)
+    # Messages of both all_to_all in forward and backward are compressed, so that outputs and all gradients carry the error,
+    # bounded relative to the max magnitude of each tensor
+    for a2a_compress, tolerance in (('fp16', 2e-3), ('bf16', 5e-2), ('int8', 2e-2)):
+        moe.a2a_compress = a2a_compress
+        results = forward_backward(moe, x)
+        for i, (a, b) in enumerate(zip(expected, results)):
+            error = float((a - b).abs().max() / a.abs().max())
+            assert error < tolerance, 'Relative error %g of result %d exceeds %g for a2a_compress = %s' % (error, i, tolerance, a2a_compress)
+        assert not torch.equal(expected[0], results[0]), 'Messages are not compressed by a2a_compress = %s' % a2a_compress
+
+
+def check_sample_buckets(rank, world_size):
+    torch.manual_seed(1)
+    moe = tutel_moe.moe_layer(
+        gate_type={'type': 'top', 'k': 2},
+        model_dim=8,
+        experts={'type': 'ffn', 'count_per_node': 1, 'hidden_size_per_expert': 16},
+        sample_buckets=[16, 64],
+    )
+    x = torch.randn([5 if rank == 0 else 20, 8])
+    expected = moe(x)
+    assert moe.expected_sample_size == 64, moe.expected_sample_size
+    # A host-side max sample size agrees on the bucket without all_reduce
+    with unittest.mock.patch.object(dist, 'all_reduce', side_effect=AssertionError('unexpected all_reduce')):
+        output = moe(x, max_sample_size=20)
+    assert moe.expected_sample_size == 64, moe.expected_sample_size
+    check_allclose([expected], [output])
+
+
+def create_checkpoint_layer(count_per_node, activation_fn, seed):
+    return tutel_moe.moe_layer(
+        gate_type={'type': 'top', 'k': 2, 'capacity_factor': 4.0},
+        model_dim=8,
+        experts={'type': 'ffn', 'count_per_node': count_per_node, 'hidden_size_per_expert': 16, 'activation_fn': activation_fn},
+        seeds=(seed, seed + get_world_rank(None), seed),
+    )
+
+
+def get_checkpoint_input(rank):
+    return torch.randn([16, 8], generator=torch.Generator().manual_seed(rank))
+
+
+def check_checkpoint_reshard(rank, world_size, path, count_per_node, activation_fn, save):
+    """Saves a layer and outputs of each rank's input, or loads the layer into a differently seeded one and checks outputs"""
+    layer = create_checkpoint_layer(count_per_node, activation_fn, 1 if save else 11)
+    if save:
+        layer.save_checkpoint(path)
+    else:
+        layer.load_checkpoint(path)
+    # A layer of any world size routes each rank's input with the same capacity, so that one rank replays all inputs
+    for r in (range(2) if world_size == 1 else [rank]):
+        output, output_path = layer(get_checkpoint_input(r)).detach(), os.path.join(path, 'output_%d.pt' % r)
+        if save:
+            torch.save(output, output_path)
+        else:
+            check_allclose([torch.load(output_path)], [output])
+
+class TutelCpuTestCase(unittest.TestCase):
+    """A class for tutel test cases on CPU backend."""
+    def setUp(self):
+        """Hook method for setting up the test"""
+        torch.manual_seed(0)
+        self.samples, self.global_experts, self.capacity, self.model_dim = 37, 5, 6, 8
+
+    def dense_reference(self, x, indices_s, locations_s):
+        """Dense dispatch buffer computed by plain indexing."""
+        dispatched = torch.zeros([self.global_experts * self.capacity, self.model_dim])
+        for indices, locations in zip(indices_s, locations_s):
+            for i in range(self.samples):
+                if locations[i] < self.capacity:
+                    dispatched[indices[i] * self.capacity + locations[i]] += x[i]
+        return dispatched
+
+    def assert_option_equivalent(self, gate_type, experts, option, values, shape=(4, 16)):
+        """Layers with the same seeds that only differ in expert `option` produce the same outputs and gradients."""
+        results = []
+        for value in values:
+            moe = tutel_moe.moe_layer(
+                gate_type=gate_type,
+                model_dim=self.model_dim,
+                experts=dict({'type': 'ffn', 'count_per_node': 2, 'hidden_size_per_expert': 16}, **experts, **{option: value}),
+                seeds=(1, 1, 1),
+            )
+            x = torch.randn(list(shape) + [self.model_dim], generator=torch.Generator().manual_seed(1), requires_grad=True)
+            y = moe(x)
+            results.append([y] + list(torch.autograd.grad((y ** 2).sum(), [x] + list(moe.parameters()))))
+        for expected, actual in zip(*results):
+            self.assertTrue(torch.allclose(expected, actual, atol=1e-5))
+
+    def test_fast_cumsum_sub_one(self):
+        """Test fast_cumsum_sub_one with CPU tensors."""
+        mask = torch.randint(0, 2, [self.samples, self.global_experts], dtype=torch.int32)
+        self.assertTrue(torch.equal(tutel_moe.fast_cumsum_sub_one(mask), torch.cumsum(mask, dim=0).to(torch.int32) - 1))
+
+    def test_fast_topk_locations(self):
+        """Test sort-based top-k locations match cumsum over stacked one-hot masks, with and without importance scores."""
+        from tutel.jit_kernels.gating import fast_topk_locations
+        S, E = self.samples, self.global_experts
+        for top_k in (1, 2, 3):
+            topk_indices = torch.topk(torch.randn([S, E]), top_k, dim=1).indices
+            # Few distinct scores for many ties, where batch prioritized routing keeps sample order as a stable sort
+            for importance_scores in (None, torch.randint(0, 4, [S]).float()):
+                order = torch.arange(S) if importance_scores is None else torch.sort(importance_scores, stable=True)[1]
+                masks_se = [torch.nn.functional.one_hot(topk_indices[order, i], E).to(torch.int32) for i in range(top_k)]
+                locations1 = tutel_moe.fast_cumsum_sub_one(torch.cat(masks_se, dim=0))
+                expected = torch.stack([torch.sum(locations1[i * S:(i + 1) * S] * masks_se[i], dim=1)[order.argsort()] for i in range(top_k)])
+
+                locations, expert_counts = fast_topk_locations(topk_indices, E, importance_scores)
+                self.assertTrue(torch.equal(locations.long(), expected.long()))
+                self.assertTrue(torch.equal(expert_counts, torch.bincount(topk_indices.view(-1), minlength=E)))
+                for capacity in (1, self.capacity, S):
+                    kept = locations < capacity
+                    self.assertTrue(torch.equal(kept, expected < capacity))
+                    kept_counts = torch.bincount(topk_indices.t()[kept], minlength=E)
+                    self.assertTrue(torch.equal(kept_counts, expert_counts.clamp(max=capacity)))
+
+    def test_load_balance_from_indices(self):
+        """Test load balance loss from top-1 indices matches the one from one-hot masks."""
+        from tutel.impls.moe_layer import load_balance, load_balance_from_indices
+        indices1_s = torch.randint(0, self.global_experts, [self.samples])
+        mask1 = torch.nn.functional.one_hot(indices1_s, self.global_experts)
+        for dtype, fp32_gate in ((torch.float32, False), (torch.bfloat16, False), (torch.bfloat16, True)):
+            gates = torch.softmax(torch.randn([self.samples, self.global_experts]), dim=1).to(dtype)
+            expected = load_balance(gates, mask1, self.global_experts, fp32_gate)
+            self.assertTrue(torch.allclose(load_balance_from_indices(gates, indices1_s, self.global_experts, fp32_gate), expected))
+
+    def test_fast_dispatcher_encode_decode(self):
+        """Test encode/decode of fast_dispatcher and their gradients with CPU tensors."""
+        top_k = 2
+        x = torch.randn([self.samples, self.model_dim], requires_grad=True)
+        indices_s = [torch.randint(0, self.global_experts, [self.samples]) for _ in range(top_k)]
+        locations_s = [torch.randint(0, self.capacity + 2, [self.samples]) for _ in range(top_k)]
+        gates_s = [torch.rand([self.samples], requires_grad=True) for _ in range(top_k)]
+
+        fdr = tutel_moe.fast_dispatcher(self.global_experts, self.capacity, self.model_dim, torch.float32, device='cpu')
+        fdr.update(indices_s, locations_s, gates_s)
+        dispatched = fdr.encode(x)
+        self.assertTrue(torch.allclose(dispatched, self.dense_reference(x.detach(), indices_s, locations_s), atol=1e-5))
+
+        output = fdr.decode(dispatched)
+        expected = sum(dispatched.detach()[indices * self.capacity + locations.clamp(max=self.capacity - 1)] * (gates * (locations < self.capacity)).detach().unsqueeze(-1) for indices, locations, gates in zip(indices_s, locations_s, gates_s))
+        self.assertTrue(torch.allclose(output, expected, atol=1e-5))
+
+        output.sum().backward()
+        self.assertEqual(x.grad.shape, x.shape)
+        for gates in gates_s:
+            self.assertEqual(gates.grad.shape, gates.shape)
+
+    def test_fast_dispatcher_index_gather(self):
+        """Test index-gather dispatch matches atomic scatter dispatch in outputs and gradients."""
+        top_k = 2
+        x = torch.randn([self.samples, self.model_dim], requires_grad=True)
+        topk_indices = torch.stack([torch.randperm(self.global_experts)[:top_k] for _ in range(self.samples)])
+        locations = tutel_moe.fast_cumsum_sub_one(torch.nn.functional.one_hot(topk_indices.t().reshape(-1), self.global_experts).to(torch.int32))
+        locations_s = [loc.view(-1) for loc in locations.gather(1, topk_indices.t().reshape(-1, 1)).view(top_k, self.samples).unbind(0)]
+        indices_s = list(topk_indices.t().unbind(0))
+        gates_s = [torch.rand([self.samples], requires_grad=True) for _ in range(top_k)]
+
+        results = []
+        for index_gather in (False, True):
+            fdr = tutel_moe.fast_dispatcher(self.global_experts, self.capacity, self.model_dim, torch.float32, device='cpu', index_gather=index_gather)
+            fdr.update(indices_s, locations_s, gates_s)
+            dispatched = fdr.encode(x)
+            output = fdr.decode(torch.tanh(dispatched))
+            grads = torch.autograd.grad((output ** 2).sum(), [x] + gates_s)
+            results.append([dispatched, output] + list(grads))
+        for expected, actual in zip(*results):
+            self.assertTrue(torch.allclose(expected, actual, atol=1e-5))
+
+    def test_moe_layer_forward_backward(self):
+        """Test a complete forward/backward step of moe_layer on CPU."""
+        for top_k in (1, 2):
+            moe = tutel_moe.moe_layer(
+                gate_type={'type': 'top', 'k': top_k},
+                model_dim=self.model_dim,
+                experts={'type': 'ffn', 'count_per_node': 2, 'hidden_size_per_expert': 16},
+            )
+            x = torch.randn([4, 16, self.model_dim], requires_grad=True)
+            y = moe(x)
+            self.assertEqual(y.shape, x.shape)
+            (y.sum() + moe.l_aux).backward()
+            self.assertTrue(torch.isfinite(x.grad).all())
+
+    def test_moe_layer_sample_buckets(self):
+        """Test moe_layer accepting variable-length batches with sample_buckets."""
+        moe = tutel_moe.moe_layer(
+            gate_type={'type': 'top', 'k': 2},
+            model_dim=self.model_dim,
+            experts={'type': 'ffn', 'count_per_node': 2, 'hidden_size_per_expert': 16},
+            sample_buckets=[16, 64],
+        )
+        for samples in (5, 17, 64, 100):
+            self.assertEqual(moe(torch.randn([samples, self.model_dim])).shape, (samples, self.model_dim))
+        stats = moe.get_bucket_padding_stats()
+        self.assertEqual(sorted(stats.keys()), [16, 64, 100])
+        self.assertEqual(stats[64]['padding'], 64 * 2 - 17 - 64)
+
+    def test_sample_buckets_agreement(self):
+        """Test ranks of different sample sizes agree on one bucket by all_reduce or by a host-side max_sample_size."""
+        run_distributed(check_sample_buckets, 2)
+
+    def test_moe_layer_dropless(self):
+        """Test dropless gate matches capacity-based gate when no token is dropped."""
+        x = torch.randn([4, 16, self.model_dim])
+        outputs = []
+        for gate_type in ({'type': 'top', 'k': 2, 'capacity_factor': 4.0}, {'type': 'top', 'k': 2, 'dropless': True}):
+            moe = tutel_moe.moe_layer(
+                gate_type=gate_type,
+                model_dim=self.model_dim,
+                experts={'type': 'ffn', 'count_per_node': 4, 'hidden_size_per_expert': 16},
+                seeds=(1, 1, 1),
+            )
+            outputs.append(moe(x))
+        self.assertTrue(torch.allclose(outputs[0], outputs[1], atol=1e-5))
+
+    def test_moe_layer_grouped_gemm(self):
+        """Test grouped GEMM experts match permuted batched experts over variable token counts, with or without `torch._grouped_mm`."""
+        from tutel.impls import grouped_gemm
+        for has_grouped_mm in sorted(set([False, grouped_gemm.has_grouped_mm])):
+            for gate_type, experts in (({'type': 'top', 'k': 2, 'dropless': True}, {}), ({'type': 'top', 'k': 2}, {'skip_empty': True})):
+                with self.subTest(has_grouped_mm=has_grouped_mm, gate_type=gate_type, experts=experts), unittest.mock.patch.object(grouped_gemm, 'has_grouped_mm', has_grouped_mm):
+                    self.assert_option_equivalent(gate_type, dict({'count_per_node': 4}, **experts), 'grouped_gemm', (False, True))
+
+    def test_moe_layer_expert_choice(self):
+        """Test expert choice gate lets each expert pick exactly `capacity` tokens, and matches a dense reference with gradients."""
+        S, E, M = self.samples, self.global_experts, self.model_dim
+        moe = tutel_moe.moe_layer(
+            gate_type={'type': 'expert_choice', 'capacity_factor': 1.0},
+            model_dim=M,
+            experts={'type': 'ffn', 'count_per_node': E, 'hidden_size_per_expert': 16},
+            seeds=(1, 1, 1),
+        )
+        x = torch.randn([S, M], requires_grad=True)
+        y = moe(x)
+        grads = torch.autograd.grad((y ** 2).sum(), [x] + list(moe.parameters()))
+
+        capacity = (S + E - 1) // E
+        indices, locations = torch.stack(moe.gate._fdr.indices_).long(), torch.stack(moe.gate._fdr.locations_).long()
+        selected = indices >= 0
+        self.assertTrue(torch.equal(torch.bincount(indices[selected], minlength=E), torch.full([E], capacity)))
+        self.assertEqual((indices[selected] * capacity + locations[selected]).unique().numel(), E * capacity)
+
+        # Dense reference: each expert weights its outputs of its top-capacity tokens by their scores
+        scores = torch.softmax(moe.gate.wg(x), dim=1)
+        chosen = torch.zeros([S, E]).scatter(0, torch.topk(scores, capacity, dim=0).indices, 1.0)
+        expert_outputs = moe.expert_fn(x.repeat(1, E, 1, 1)).view(E, S, M)
+        expected = torch.einsum('se,esm->sm', scores * chosen, expert_outputs)
+        expected_grads = torch.autograd.grad((expected ** 2).sum(), [x] + list(moe.parameters()))
+        self.assertTrue(torch.allclose(y, expected, atol=1e-5))
+        for expected_grad, grad in zip(expected_grads, grads):
+            self.assertTrue(torch.allclose(expected_grad, grad, atol=1e-5))
+
+        # Tokens chosen by no expert pass nothing forward or backward, while gradients reach the gate through selected tokens
+        unselected = chosen.sum(dim=1) == 0
+        self.assertTrue(unselected.any() and (chosen.sum(dim=1) > 1).any())
+        self.assertTrue(torch.equal(y[unselected], torch.zeros_like(y[unselected])))
+        self.assertTrue(torch.equal(grads[0][unselected], torch.zeros_like(grads[0][unselected])))
+        gate_grad = dict(zip([name for name, _ in moe.named_parameters()], grads[1:]))['gate.wg.weight']
+        self.assertGreater(float(gate_grad.abs().sum()), 0)
+
+    def test_moe_layer_skip_empty(self):
+        """Test computing occupied capacity slots only matches computing all slots for a few tokens over many experts."""
+        for gate_type in ({'type': 'top', 'k': 2}, {'type': 'expert_choice'}):
+            with self.subTest(gate_type=gate_type):
+                self.assert_option_equivalent(gate_type, {'count_per_node': 8}, 'skip_empty', (False, True), shape=(3,))
+
+    def test_moe_layer_fused_activation(self):
+        """Test fused bias + activation epilogue matches the same activation given as a function."""
+        swiglu = lambda x: torch.nn.functional.silu(x.chunk(2, dim=-1)[0]) * x.chunk(2, dim=-1)[1]
+        for name, activation_fn in (('relu', torch.nn.functional.relu), ('gelu', torch.nn.functional.gelu), ('swiglu', swiglu)):
+            with self.subTest(activation=name):
+                self.assert_option_equivalent({'type': 'top', 'k': 2}, {'fc1_copies': 2 if name == 'swiglu' else 1}, 'activation_fn', (activation_fn, name))
+        with self.assertRaises(AssertionError):
+            tutel_moe.moe_layer(gate_type={'type': 'top', 'k': 2}, model_dim=self.model_dim, experts={'type': 'ffn', 'count_per_node': 2, 'hidden_size_per_expert': 16, 'activation_fn': 'relu', 'implicit_dropout_p': 1.0})
+
+    def test_moe_layer_checkpoint(self):
+        """Test expert checkpointing recomputes fc1 and activation with unchanged outputs and gradients."""
+        for activation_fn in (torch.nn.functional.relu, 'gelu'):
+            with self.subTest(activation_fn=activation_fn):
+                self.assert_option_equivalent({'type': 'top', 'k': 2}, {'activation_fn': activation_fn}, 'checkpoint', (False, True))
+
+    def test_moe_layer_offload(self):
+        """Test memory-mapped expert weights of consecutive layers give the same inference results as in-memory weights."""
+        x = torch.randn([4, 16, self.model_dim])
+        outputs = []
+        for offload in (None, 'mmap', 'pinned'):
+            layers = [tutel_moe.moe_layer(
+                gate_type={'type': 'top', 'k': 2},
+                model_dim=self.model_dim,
+                experts={'type': 'ffn', 'count_per_node': 2, 'hidden_size_per_expert': 16, 'offload': offload},
+                seeds=(1, i + 1, 1),
+            ).eval() for i in range(2)]
+            with torch.no_grad():
+                for _ in range(2):
+                    y = layers[1](layers[0](x))
+            outputs.append(y)
+            if offload is not None:
+                self.assertFalse(layers[0].experts[0].fc1_weight.requires_grad)
+        for actual in outputs[1:]:
+            self.assertTrue(torch.allclose(outputs[0], actual, atol=1e-5))
+
+    def test_moe_layer_offload_path_reuse(self):
+        """Test memory-mapped expert weight files of an explicit offload_path are kept and reused by a restarted layer."""
+        with tempfile.TemporaryDirectory() as path:
+            layers = [tutel_moe.moe_layer(
+                gate_type={'type': 'top', 'k': 2},
+                model_dim=self.model_dim,
+                experts={'type': 'ffn', 'count_per_node': 2, 'hidden_size_per_expert': 16, 'offload': 'mmap', 'offload_path': path},
+                seeds=(1, seed, 1),
+            ).eval() for seed in (1, 2)]
+            self.assertEqual(sorted(os.listdir(path)), ['fc1_weight_rank0_float32.bin', 'fc2_weight_rank0_float32.bin'])
+            for name in ('fc1_weight', 'fc2_weight'):
+                self.assertTrue(torch.equal(getattr(layers[0].experts[0], name), getattr(layers[1].experts[0], name)))
+
+    def test_moe_layer_checkpoint_save_load(self):
+        """Test sharded checkpoint restores expert and gate parameters into a differently initialized layer."""
+        layers = [tutel_moe.moe_layer(
+            gate_type={'type': 'top', 'k': 2},
+            model_dim=self.model_dim,
+            experts={'type': 'ffn', 'count_per_node': 2, 'hidden_size_per_expert': 16, 'activation_fn': 'swiglu'},
+            seeds=(i, i, i),
+        ) for i in range(2)]
+        x = torch.randn([4, 16, self.model_dim])
+        with tempfile.TemporaryDirectory() as path:
+            layers[0].save_checkpoint(path)
+            layers[1].load_checkpoint(path)
+        self.assertTrue(torch.allclose(layers[0](x), layers[1](x), atol=1e-5))
+
+    def test_moe_layer_telemetry(self):
+        """Test telemetry reports per-expert counts and drops of routed tokens excluding padding once per interval."""
+        moe = tutel_moe.moe_layer(
+            gate_type={'type': 'top', 'k': 2, 'capacity_factor': 0.5},
+            model_dim=self.model_dim,
+            experts={'type': 'ffn', 'count_per_node': 4, 'hidden_size_per_expert': 16},
+            telemetry_interval=2,
+        )
+        reports = []
+        moe.register_telemetry_hook(reports.append)
+        for samples in (16, 12, 16):
+            moe(torch.randn([samples, self.model_dim]))
+        self.assertEqual(len(reports), 1)
+        self.assertEqual(reports[0]['steps'], 2)
+        self.assertEqual(reports[0]['tokens'], 28)
+        self.assertEqual(sum(reports[0]['expert_counts']), 28 * 2)
+        self.assertGreater(reports[0]['drop_rate'], 0)
+        self.assertLessEqual(reports[0]['capacity_utilization'], 1.0)
+        self.assertEqual(moe.get_telemetry(wait=True)['tokens'], 16)
+        self.assertEqual(len(reports), 2)
+
+    def test_moe_layer_profiler(self):
+        """Test profiler times forward and backward phases without changing results, and exports a Chrome trace."""
+        outputs = []
+        for profiler in (False, True):
+            moe = tutel_moe.moe_layer(
+                gate_type={'type': 'top', 'k': 2},
+                model_dim=self.model_dim,
+                experts={'type': 'ffn', 'count_per_node': 4, 'hidden_size_per_expert': 16},
+                seeds=(1, 1, 1),
+                profiler=profiler,
+            )
+            x = torch.randn([16, self.model_dim], generator=torch.Generator().manual_seed(1), requires_grad=True)
+            for _ in range(2):
+                y = moe(x)
+                y.sum().backward()
+            outputs.append((y, x.grad))
+        self.assertTrue(torch.allclose(outputs[0][0], outputs[1][0]))
+        self.assertTrue(torch.allclose(outputs[0][1], outputs[1][1]))
+
+        stats = moe.get_profile_stats()
+        for phase in ('gate', 'encode', 'a2a_dispatch', 'expert', 'a2a_combine', 'decode'):
+            self.assertEqual(stats[phase + '.forward']['count'], 2)
+            self.assertEqual(stats[phase + '.backward']['count'], 2)
+            self.assertLessEqual(stats[phase + '.forward']['p50_ms'], stats[phase + '.forward']['p99_ms'])
+        with tempfile.TemporaryDirectory() as path:
+            moe.export_profile_trace(os.path.join(path, 'trace.json'))
+            with open(os.path.join(path, 'trace.json')) as fp:
+                trace = json.load(fp)
+        self.assertEqual(len([x for x in trace['traceEvents'] if x['ph'] == 'X']), sum(x['count'] for x in stats.values()))
+
+    def test_moe_layer_fast_inference(self):
+        """Test fast inference matches the no_grad outputs of top-k gates, skips aux loss and keeps returned outputs intact."""
+        for top_k in (1, 2):
+            outputs = []
+            for fast_inference in (False, True):
+                moe = tutel_moe.moe_layer(
+                    gate_type={'type': 'top', 'k': top_k},
+                    model_dim=self.model_dim,
+                    experts={'type': 'ffn', 'count_per_node': 4, 'hidden_size_per_expert': 16},
+                    seeds=(1, 1, 1),
+                    sample_buckets='pow2',
+                    fast_inference=fast_inference,
+                )
+                with torch.no_grad():
+                    outputs.append([moe(torch.randn([samples, self.model_dim], generator=torch.Generator().manual_seed(samples))) for samples in (16, 5, 16)])
+            for default_output, fast_output in zip(*outputs):
+                self.assertTrue(torch.allclose(default_output, fast_output, atol=1e-6))
+            self.assertEqual(float(moe.l_aux), 0.0)
+
+            with torch.no_grad():
+                for _ in range(2):
+                    moe(torch.randn([16, self.model_dim]))
+            self.assertGreater(moe.gate.workspace.get_stats()['reused_bytes'], 0)
+            self.assertTrue(torch.allclose(outputs[0][0], outputs[1][0], atol=1e-6))
+
+    def test_benchmark_baseline(self):
+        """Test benchmark sweep reports every subsystem and configuration, and flags regressions against a baseline."""
+        from tutel.benchmark import run_sweep, compare_with_baseline, SUBSYSTEMS
+        sweep = {'tokens': [32, 64], 'model_dim': self.model_dim, 'hidden': 16, 'experts': 4, 'top_k': 2, 'capacity_factor': 1.0, 'dtype': 'float32', 'world_size': 1}
+        report = run_sweep(sweep, num_steps=2, num_warmups=1, log=lambda *args: None)
+        self.assertEqual(len(report['results']), 2 * len(SUBSYSTEMS))
+        for result in report['results']:
+            self.assertGreater(result['tokens_per_sec'], 0)
+            self.assertGreaterEqual(result['peak_memory_mb'], 0)
+            if result['subsystem'].startswith('all_to_all_'):
+                self.assertTrue(0 < result['metrics']['compression_error'] < 0.01)
+
+        baseline = json.loads(json.dumps(report))
+        self.assertEqual(compare_with_baseline(report, baseline, tolerance=0.1), [])
+        baseline['results'][0]['tokens_per_sec'] *= 2
+        baseline['results'][1]['peak_memory_mb'] = report['results'][1]['peak_memory_mb'] / 2 - 1
+        regressions = compare_with_baseline(report, baseline, tolerance=0.1)
+        self.assertEqual(len(regressions), 2)
+        self.assertIn('throughput', regressions[0])
+        self.assertIn('peak memory', regressions[1])
+
+    def test_moe_layer_adaptive_capacity(self):
+        """Test adaptive capacity settles on the smallest bucketed capacity factor without drops."""
+        moe = tutel_moe.moe_layer(
+            gate_type={'type': 'top', 'k': 2, 'capacity_factor': 0.5, 'adaptive_capacity': {'target_drop_rate': 0.0, 'factors': [0.5, 1.0, 2.0, 4.0, 8.0], 'interval': 2}},
+            model_dim=self.model_dim,
+            experts={'type': 'ffn', 'count_per_node': 4, 'hidden_size_per_expert': 16},
+            telemetry_interval=2,
+        )
+        x = torch.randn([32, self.model_dim])
+        for _ in range(6):
+            moe(x)
+        self.assertGreater(moe.gate.capacity_factor, 0.5)
+        self.assertEqual(moe.get_telemetry()['drop_rate'], 0.0)
+        self.assertLessEqual(len(moe.gate._fdr.kernel_pool), 5)
+
+    def test_moe_layer_workspace_arena(self):
+        """Test workspace arena reuses buffers across steps without changing results of overlapped micro-batches."""
+        outputs = []
+        for workspace_arena in (False, True):
+            moe = tutel_moe.moe_layer(
+                gate_type={'type': 'top', 'k': 2},
+                model_dim=self.model_dim,
+                experts={'type': 'ffn', 'count_per_node': 4, 'hidden_size_per_expert': 16},
+                seeds=(1, 1, 1),
+                workspace_arena=workspace_arena,
+            )
+            x = torch.randn([4, 16, self.model_dim], generator=torch.Generator().manual_seed(1), requires_grad=True)
+            for _ in range(3):
+                y1, y2 = moe(x), moe(x * 2)
+                ((y1 ** 2).sum() + (y2 ** 3).sum()).backward()
+            outputs.append([y1, y2, x.grad])
+        for expected, actual in zip(*outputs):
+            self.assertTrue(torch.allclose(expected, actual, atol=1e-5))
+        stats = moe.get_workspace_stats()
+        self.assertEqual(stats['allocated_bytes'], 0)
+        self.assertGreater(stats['reused_bytes'], 0)
+
+    def test_moe_layer_hash_gate(self):
+        """Test hash gate routes the same token ids to the same experts regardless of positions."""
+        moe = tutel_moe.moe_layer(
+            gate_type={'type': 'hash', 'k': 1, 'dropless': True},
+            model_dim=self.model_dim,
+            experts={'type': 'ffn', 'count_per_node': 4, 'hidden_size_per_expert': 16},
+        )
+        x = torch.randn([16, self.model_dim])
+        token_ids = torch.randint(0, 1000, [16])
+        permutation = torch.randperm(16)
+        y = moe(x, token_ids=token_ids)
+        self.assertTrue(torch.allclose(moe(x[permutation], token_ids=token_ids[permutation]), y[permutation], atol=1e-5))
+        self.assertEqual(float(moe.l_aux), 0.0)
+
+    def test_hash_gate_spread(self):
+        """Test hash gate spreads strided token ids over all experts instead of the same few."""
+        gate = tutel_moe.moe_layer(
+            gate_type={'type': 'hash', 'k': 2},
+            model_dim=self.model_dim,
+            experts={'type': 'ffn', 'count_per_node': 8, 'hidden_size_per_expert': 16},
+        ).gate
+        x = torch.randn([1024, self.model_dim])
+        indices = gate.get_topk_indices(x[:8], torch.arange(0, 64, 8))
+        self.assertGreaterEqual(indices[:, 0].unique().numel(), 4)
+        self.assertTrue(torch.equal(indices[:, 1], (indices[:, 0] + 1) % 8))
+        for stride in (1, 8, 64, 1024):
+            counts = torch.bincount(gate.get_topk_indices(x, torch.arange(0, 1024 * stride, stride))[:, 0], minlength=8)
+            self.assertTrue(counts.min() >= 64 and counts.max() <= 192, 'Unbalanced expert counts %s for stride %d' % (counts.tolist(), stride))
+
+    def test_random_gate_seed(self):
+        """Test random gate routing is reproducible under a fixed seed."""
+        def create_gate(seed):
+            return tutel_moe.moe_layer(
+                gate_type={'type': 'random', 'k': 2, 'seed': seed},
+                model_dim=self.model_dim,
+                experts={'type': 'ffn', 'count_per_node': 8, 'hidden_size_per_expert': 16},
+            ).gate
+        x = torch.randn([256, self.model_dim])
+        gate, same_gate, other_gate = create_gate(1), create_gate(1), create_gate(2)
+        steps = [gate.get_topk_indices(x, None) for _ in range(2)]
+        self.assertTrue(all(torch.equal(y, same_gate.get_topk_indices(x, None)) for y in steps))
+        self.assertFalse(torch.equal(steps[0], steps[1]))
+        self.assertFalse(torch.equal(steps[0], other_gate.get_topk_indices(x, None)))
+        self.assertTrue(torch.equal(steps[0][:, 1], (steps[0][:, 0] + 1) % 8))
+
+    def test_2dh_all_to_all(self):
+        """Test hierarchical all_to_all over 4 ranks with LOCAL_SIZE = 2 matches flat all_to_all in forward and backward."""
+        run_distributed(check_2dh_all_to_all, 4)
+
+    def test_dropless_distributed(self):
+        """Test dropless routing over 3 ranks of uneven sample sizes and expert counts matches routing without capacity drops."""
+        run_distributed(check_dropless, 3)
+
+    def test_pipelined_all_to_all(self):
+        """Test all_to_all pipelined over capacity chunks on 2 ranks matches a single all_to_all in forward and backward."""
+        run_distributed(check_pipelined_all_to_all, 2)
+
+    def test_compressed_all_to_all(self):
+        """Test all_to_all compressed to fp16, bf16 or int8 on 2 ranks stays close to uncompressed outputs and gradients."""
+        run_distributed(check_compressed_all_to_all, 2)
+
+    def test_checkpoint_reshard(self):
+        """Test sharded checkpoint reloads into a different world size or `count_per_node` with the same outputs."""
+        # (world size, count_per_node) of the saved and the loaded layer, with 2 global experts or 1 expert sharded over 2 ranks
+        for saved, loaded in (((2, 1), (1, 2)), ((1, 2), (2, 1)), ((2, -2), (1, 1)), ((1, 1), (2, -2))):
+            for activation_fn in ('relu', 'swiglu'):
+                with self.subTest(saved=saved, loaded=loaded, activation_fn=activation_fn), tempfile.TemporaryDirectory() as path:
+                    for (world_size, count_per_node), save in ((saved, True), (loaded, False)):
+                        if world_size == 1:
+                            check_checkpoint_reshard(0, 1, path, count_per_node, activation_fn, save)
+                        else:
+                            run_distributed(check_checkpoint_reshard, world_size, path, count_per_node, activation_fn, save)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,15 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+"""
+Microbenchmarks of MoE subsystems (gate, cumsum, encode_decode, all_to_all, expert, layer), with regression baselines,
+where compressed all_to_all subsystems (all_to_all_fp16, all_to_all_bf16, all_to_all_int8) also report `compression_error`:
+
+    report = run_sweep({'tokens': [512, 2048], 'model_dim': 256, 'hidden': 512, 'experts': 8, 'top_k': 2,
+                        'capacity_factor': 1.0, 'dtype': 'float32', 'world_size': [1, 2]}, device='cpu')
+    regressions = compare_with_baseline(report, load_report('baseline.json'), tolerance=0.1)
+"""
+
+from .runner import run_sweep, expand_sweep
+from .subsystems import SUBSYSTEMS
+from .baseline import compare_with_baseline, load_report, save_report
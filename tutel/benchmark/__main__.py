@@ -0,0 +1,73 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+"""
+Sweeps MoE subsystems and compares them with a stored baseline, e.g.
+
+    python3 -m tutel.benchmark --device cpu --tokens 512,2048 --world_size 1,2 --output result.json
+    python3 -m tutel.benchmark --device cpu --tokens 512,2048 --world_size 1,2 --baseline result.json
+"""
+
+import os
+import sys
+import argparse
+
+import torch
+import torch.distributed as dist
+
+from .runner import run_sweep
+from .subsystems import SUBSYSTEMS
+from .baseline import compare_with_baseline, load_report, save_report
+
+
+def parse_list(value_type):
+    return lambda value: [value_type(x) for x in value.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python3 -m tutel.benchmark')
+
+    parser.add_argument('--subsystems', type=parse_list(str), default=list(SUBSYSTEMS))
+    parser.add_argument('--tokens', type=parse_list(int), default=[1024])
+    parser.add_argument('--model_dim', type=parse_list(int), default=[256])
+    parser.add_argument('--hidden', type=parse_list(int), default=[512])
+    parser.add_argument('--experts', type=parse_list(int), default=[8])
+    parser.add_argument('--top_k', type=parse_list(int), default=[2])
+    parser.add_argument('--capacity_factor', type=parse_list(float), default=[1.0])
+    parser.add_argument('--dtype', type=parse_list(str), default=['float32'])
+    parser.add_argument('--world_size', type=parse_list(int), default=[1])
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--num_steps', type=int, default=20)
+    parser.add_argument('--num_warmups', type=int, default=5)
+    parser.add_argument('--output', type=str, default=None)
+    parser.add_argument('--baseline', type=str, default=None)
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    parser.add_argument('--memory_tolerance', type=float, default=None)
+    args = parser.parse_args()
+
+    # Launched by torchrun, runs configurations matching its world size instead of spawning ranks
+    if int(os.environ.get('WORLD_SIZE', '1')) > 1:
+        if args.device == 'cuda':
+            torch.cuda.set_device(int(os.environ.get('LOCAL_RANK', '0')))
+        dist.init_process_group('nccl' if args.device == 'cuda' else 'gloo')
+
+    sweep = {key: getattr(args, key) for key in ('tokens', 'model_dim', 'hidden', 'experts', 'top_k', 'capacity_factor', 'dtype', 'world_size')}
+    report = run_sweep(sweep, args.subsystems, device=args.device, num_steps=args.num_steps, num_warmups=args.num_warmups)
+    if dist.is_initialized() and dist.get_rank() != 0:
+        return
+
+    if args.output is not None:
+        save_report(report, args.output)
+        print('[Summary] %d results are saved to %s' % (len(report['results']), args.output))
+
+    if args.baseline is not None:
+        regressions = compare_with_baseline(report, load_report(args.baseline), args.tolerance, args.memory_tolerance)
+        for message in regressions:
+            print('[Regression] %s' % message)
+        print('[Summary] %d regressions against baseline %s (tolerance = %g)' % (len(regressions), args.baseline, args.tolerance))
+        sys.exit(1 if regressions else 0)
+
+
+# Spawned ranks re-import this module, so the sweep must only run in the launching process
+if __name__ == '__main__':
+    main()
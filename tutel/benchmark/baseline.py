@@ -0,0 +1,42 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import json
+
+
+def get_case_key(result):
+    return (result['subsystem'],) + tuple(sorted(result['config'].items()))
+
+
+def compare_with_baseline(report, baseline, tolerance=0.1, memory_tolerance=None):
+    """Compares a report of `run_sweep` with a stored one, returning a list of regression messages
+
+    A case regresses if its throughput drops below (1 - tolerance) of the baseline, or its peak memory grows above
+    (1 + memory_tolerance) of the baseline. Cases missing in either report are not compared.
+    """
+    memory_tolerance = tolerance if memory_tolerance is None else memory_tolerance
+    if report['device_name'] != baseline['device_name']:
+        return ['Baseline is recorded on device `%s`, while the current device is `%s`.' % (baseline['device_name'], report['device_name'])]
+
+    baseline_results = {get_case_key(x): x for x in baseline['results']}
+    regressions = []
+    for result in report['results']:
+        expected = baseline_results.get(get_case_key(result))
+        if expected is None:
+            continue
+        description = '%s (%s)' % (result['subsystem'], ', '.join('%s = %s' % (k, v) for k, v in result['config'].items()))
+        if result['tokens_per_sec'] < expected['tokens_per_sec'] * (1 - tolerance):
+            regressions.append('%s: throughput %.1f tokens/s is below baseline %.1f tokens/s' % (description, result['tokens_per_sec'], expected['tokens_per_sec']))
+        if result['peak_memory_mb'] > expected['peak_memory_mb'] * (1 + memory_tolerance):
+            regressions.append('%s: peak memory %.2f MB is above baseline %.2f MB' % (description, result['peak_memory_mb'], expected['peak_memory_mb']))
+    return regressions
+
+
+def load_report(path):
+    with open(path, 'r') as fp:
+        return json.load(fp)
+
+
+def save_report(report, path):
+    with open(path, 'w') as fp:
+        json.dump(report, fp, indent=2)
@@ -0,0 +1,165 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import os
+import json
+import time
+import socket
+import platform
+import itertools
+import tempfile
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from ..impls.communicate import get_world_size, get_world_rank
+from .subsystems import SUBSYSTEMS
+
+
+SWEEP_KEYS = ('tokens', 'model_dim', 'hidden', 'experts', 'top_k', 'capacity_factor', 'dtype', 'world_size')
+
+
+def expand_sweep(sweep):
+    """Cartesian product of `sweep` values, e.g. {'tokens': [512, 1024], ..} => [{'tokens': 512, ..}, {'tokens': 1024, ..}]"""
+    for key in SWEEP_KEYS:
+        if key not in sweep:
+            raise Exception('Benchmark sweep is missing key `%s`, while expecting keys: %s.' % (key, ', '.join(SWEEP_KEYS)))
+    values = [x if isinstance(x, (list, tuple)) else [x] for x in (sweep[key] for key in SWEEP_KEYS)]
+    return [dict(zip(SWEEP_KEYS, x)) for x in itertools.product(*values)]
+
+
+def get_device_name(device):
+    if device.type == 'cuda':
+        return torch.cuda.get_device_name(device)
+    try:
+        with open('/proc/cpuinfo', 'r') as fp:
+            return next(line.split(':', 1)[1].strip() for line in fp if line.startswith('model name'))
+    except:
+        return platform.processor() or platform.machine()
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def measure_peak_memory(step, device):
+    """Peak bytes allocated by one step beyond the memory already in use before it"""
+    synchronize(device)
+    if device.type == 'cuda':
+        base = torch.cuda.memory_allocated(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        step()
+        synchronize(device)
+        return torch.cuda.max_memory_allocated(device) - base
+    # CPU has no allocator statistics, so replay allocations and frees recorded by the profiler in time order
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+        step()
+    current, peak = 0, 0
+    for event in sorted(prof.events(), key=lambda event: event.time_range.start):
+        current += event.self_cpu_memory_usage
+        peak = max(peak, current)
+    return peak
+
+
+def run_case(subsystem, config, device, group, num_steps, num_warmups):
+    """Times one subsystem on one configuration, reducing step time and memory by max over ranks"""
+    step = SUBSYSTEMS[subsystem](config, device, group)
+    for _ in range(num_warmups):
+        step()
+    peak_memory = measure_peak_memory(step, device)
+
+    if get_world_size(group) > 1:
+        dist.barrier(group=group)
+    synchronize(device)
+    t_start = time.perf_counter()
+    for _ in range(num_steps):
+        step()
+    synchronize(device)
+    step_time = (time.perf_counter() - t_start) / num_steps
+    if get_world_size(group) > 1:
+        stats = torch.tensor([step_time, peak_memory], dtype=torch.float64, device=device)
+        dist.all_reduce(stats, op=dist.ReduceOp.MAX, group=group)
+        step_time, peak_memory = stats.tolist()
+
+    return {
+        'subsystem': subsystem,
+        'config': config,
+        'step_ms': step_time * 1e3,
+        'tokens_per_sec': config['tokens'] / step_time,
+        'peak_memory_mb': peak_memory / 2**20,
+        'metrics': getattr(step, 'metrics', {}),
+    }
+
+
+def run_cases(subsystems, configs, device, group=None, num_steps=20, num_warmups=5, log=print):
+    results = []
+    for config in configs:
+        if config['world_size'] != get_world_size(group):
+            continue
+        for subsystem in subsystems:
+            result = run_case(subsystem, config, device, group, num_steps, num_warmups)
+            log('[Statistics] %-15s %s: step = %.3f ms, throughput = %.1f tokens/s, peak memory = %.2f MB%s' % (
+                subsystem, ', '.join('%s = %s' % (k, v) for k, v in config.items()), result['step_ms'], result['tokens_per_sec'], result['peak_memory_mb'],
+                ''.join(', %s = %g' % (k.replace('_', ' '), v) for k, v in result['metrics'].items())))
+            results.append(result)
+    return results
+
+
+def get_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def spawned_worker(rank, world_size, port, device_type, subsystems, configs, num_steps, num_warmups, result_file):
+    backend = 'nccl' if device_type == 'cuda' else 'gloo'
+    if device_type == 'cuda':
+        torch.cuda.set_device(rank % torch.cuda.device_count())
+    dist.init_process_group(backend, init_method='tcp://127.0.0.1:%d' % port, rank=rank, world_size=world_size)
+    device = torch.device(device_type, torch.cuda.current_device()) if device_type == 'cuda' else torch.device('cpu')
+    try:
+        results = run_cases(subsystems, configs, device, dist.group.WORLD, num_steps, num_warmups, log=print if rank == 0 else lambda *args: None)
+        if rank == 0:
+            with open(result_file, 'w') as fp:
+                json.dump(results, fp)
+    finally:
+        dist.destroy_process_group()
+
+
+def run_sweep(sweep, subsystems=None, device='cpu', num_steps=20, num_warmups=5, log=print):
+    """Runs every subsystem on every configuration of `sweep`, returning a JSON-serializable report
+
+    If the process group is already initialized (e.g. launched by torchrun), only configurations matching its world size
+    are run. Otherwise, configurations of each world size are run in that many local processes spawned with gloo (on CPU)
+    or nccl (on CUDA) backend.
+    """
+    device = torch.device(device)
+    subsystems = subsystems or list(SUBSYSTEMS)
+    for subsystem in subsystems:
+        if subsystem not in SUBSYSTEMS:
+            raise Exception('Benchmark subsystem is not recognized: %s. Valid subsystems include: %s.' % (subsystem, ', '.join(SUBSYSTEMS)))
+    configs = expand_sweep(sweep)
+
+    if dist.is_available() and dist.is_initialized():
+        results = run_cases(subsystems, configs, device, dist.group.WORLD, num_steps, num_warmups, log=log if get_world_rank(dist.group.WORLD) == 0 else lambda *args: None)
+    else:
+        results = []
+        for world_size in sorted(set(config['world_size'] for config in configs)):
+            if world_size == 1:
+                results += run_cases(subsystems, configs, device, None, num_steps, num_warmups, log=log)
+                continue
+            with tempfile.TemporaryDirectory() as path:
+                result_file = os.path.join(path, 'results.json')
+                mp.spawn(spawned_worker, args=(world_size, get_free_port(), device.type, subsystems, configs, num_steps, num_warmups, result_file), nprocs=world_size)
+                with open(result_file, 'r') as fp:
+                    results += json.load(fp)
+
+    return {
+        'device': device.type,
+        'device_name': get_device_name(device),
+        'torch_version': torch.__version__,
+        'num_steps': num_steps,
+        'results': results,
+    }
@@ -0,0 +1,133 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import functools
+
+import torch
+
+from ..impls.communicate import AllToAll, get_compression_error, get_world_size
+from ..impls.fast_dispatch import fast_dispatcher
+from ..impls.moe_layer import moe_layer
+from ..jit_kernels.gating import fast_topk_locations
+
+
+def get_count_per_node(config, world_size):
+    """Local experts of each rank, or -N if there are fewer experts than ranks and each expert is sharded across N ranks"""
+    if config['experts'] % world_size == 0:
+        return config['experts'] // world_size
+    if world_size % config['experts'] == 0:
+        return -(world_size // config['experts'])
+    raise Exception('Cannot place %d experts on %d ranks.' % (config['experts'], world_size))
+
+
+def create_layer(config, device, group):
+    """Builtin ffn MoE layer of `config`, sharding each expert across ranks if there are fewer experts than ranks"""
+    layer = moe_layer(
+        gate_type={'type': 'top', 'k': config['top_k'], 'capacity_factor': config['capacity_factor']},
+        model_dim=config['model_dim'],
+        experts={'type': 'ffn', 'count_per_node': get_count_per_node(config, get_world_size(group)), 'hidden_size_per_expert': config['hidden']},
+        group=group,
+        seeds=(1, 1, 1),
+    )
+    return layer.to(device).to(getattr(torch, config['dtype']))
+
+
+def create_routing(config, device):
+    """Random top-k routing of `config`, as (indices_s, locations_s, capacity)"""
+    S, E, k = config['tokens'], config['experts'], config['top_k']
+    topk_indices = torch.topk(torch.randn([S, E], device=device), k, dim=1).indices
+    locations = fast_topk_locations(topk_indices, E)[0]
+    capacity = k * int(config['capacity_factor'] * ((S + E - 1) // E))
+    return list(topk_indices.t().contiguous().unbind(0)), list(locations.unbind(0)), capacity
+
+
+def build_gate(config, device, group):
+    """Gate projection, top-k selection, softmax and load balance loss of the top-k gate, in forward and backward"""
+    gate = create_layer(config, device, group).gate
+    x = torch.randn([config['tokens'], config['model_dim']], dtype=getattr(torch, config['dtype']), device=device, requires_grad=True)
+
+    def step():
+        _, gates_s, l_loss, _ = gate.compute_gates(x)
+        (sum(gates_s).sum() + l_loss).backward()
+    return step
+
+
+def build_cumsum(config, device, group):
+    """Locations of tokens in the capacity of each selected expert (forward only)"""
+    topk_indices = torch.topk(torch.randn([config['tokens'], config['experts']], device=device), config['top_k'], dim=1).indices
+
+    def step():
+        fast_topk_locations(topk_indices, config['experts'])
+    return step
+
+
+def build_encode_decode(config, device, group):
+    """Dispatcher update, encode and decode, in forward and backward"""
+    dtype = getattr(torch, config['dtype'])
+    indices_s, locations_s, capacity = create_routing(config, device)
+    gates_s = [torch.rand([config['tokens']], dtype=dtype, device=device, requires_grad=True) for _ in indices_s]
+    x = torch.randn([config['tokens'], config['model_dim']], dtype=dtype, device=device, requires_grad=True)
+    fdr = fast_dispatcher(config['experts'], capacity, config['model_dim'], dtype, device=device)
+
+    def step():
+        fdr.update(indices_s, locations_s, gates_s, capacity=capacity)
+        output = fdr.decode(fdr.encode(x))
+        output.backward(torch.ones_like(output))
+    return step
+
+
+def build_all_to_all(config, device, group, a2a_compress=None):
+    """All-to-all exchange of dispatched tokens (ranks x local experts x capacity x model_dim), in forward and backward
+
+    With `a2a_compress`, messages are compressed as in `moe_layer(.., a2a_compress=..)`, and the relative error bound
+    of the compressed payload is reported as a metric.
+    """
+    capacity = create_routing(config, device)[2]
+    # Sharded experts are dispatched once per shard, so that each rank still receives one buffer per peer
+    world_size = get_world_size(group)
+    local_experts = max(get_count_per_node(config, world_size), 1)
+    x = torch.randn([world_size * local_experts, capacity, config['model_dim']], dtype=getattr(torch, config['dtype']), device=device, requires_grad=True)
+
+    def step():
+        output = AllToAll.apply(group, x, None, a2a_compress)
+        output.backward(torch.ones_like(output))
+    if a2a_compress is not None:
+        step.metrics = {'compression_error': get_compression_error(x.detach(), a2a_compress)}
+    return step
+
+
+def build_expert(config, device, group):
+    """Local expert FFNs on the tokens received by this rank, in forward and backward"""
+    layer = create_layer(config, device, group)
+    capacity = create_routing(config, device)[2]
+    local_experts = layer.num_local_experts if layer.sharded_count == 1 else 1
+    x = torch.randn([get_world_size(group), local_experts, capacity, config['model_dim']], dtype=getattr(torch, config['dtype']), device=device, requires_grad=True)
+
+    def step():
+        output = layer.expert_fn(x)
+        output.backward(torch.ones_like(output))
+    return step
+
+
+def build_layer(config, device, group):
+    """Full MoE layer including gate, dispatch, all-to-all, experts and combine, in forward and backward"""
+    layer = create_layer(config, device, group)
+    x = torch.randn([config['tokens'], config['model_dim']], dtype=getattr(torch, config['dtype']), device=device, requires_grad=True)
+
+    def step():
+        output = layer(x)
+        (output.sum() + output.l_aux).backward()
+    return step
+
+
+SUBSYSTEMS = {
+    'gate': build_gate,
+    'cumsum': build_cumsum,
+    'encode_decode': build_encode_decode,
+    'all_to_all': build_all_to_all,
+    'all_to_all_fp16': functools.partial(build_all_to_all, a2a_compress='fp16'),
+    'all_to_all_bf16': functools.partial(build_all_to_all, a2a_compress='bf16'),
+    'all_to_all_int8': functools.partial(build_all_to_all, a2a_compress='int8'),
+    'expert': build_expert,
+    'layer': build_layer,
+}
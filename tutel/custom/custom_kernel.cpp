@@ -9,7 +9,16 @@
 #endif
 
 #include <vector>
+#include <string>
+#include <algorithm>
+#include <ctime>
 #include <pwd.h>
+#include <fcntl.h>
+#include <dirent.h>
+#include <unistd.h>
+#include <utime.h>
+#include <sys/file.h>
+#include <sys/stat.h>
 #include <sys/wait.h>
 
 #include <dlfcn.h>
@@ -41,6 +50,21 @@ static std::string file_read(const char *path) {
   return code;
 }
 
+static bool file_try_read(const char *path, std::string &code) {
+  FILE *fp = fopen(path, "rb");
+  if (fp == nullptr)
+    return false;
+  bool success = fseek(fp, 0, SEEK_END) == 0;
+  long code_size = success ? ftell(fp) : -1;
+  if (code_size > 0 && fseek(fp, 0, SEEK_SET) == 0) {
+    code.resize(code_size);
+    success = fread((void*)code.data(), 1, code_size, fp) == (size_t)code_size;
+  } else
+    success = false;
+  fclose(fp);
+  return success;
+}
+
 static void file_write(const char *path, const std::string &code) {
   FILE *fp = fopen(path, "wb");
   CHECK_EQ(true, fp != nullptr);
@@ -71,32 +95,57 @@ static std::string get_cache_path() {
   return cache_path;
 }
 
-static std::string nvcc_compile(const char* code, const std::string &arch, int code_id, int dev_id) {
-  std::string code_path = get_cache_path() + std::to_string(code_id) + "-" + std::to_string(dev_id) + ".cu";
-  file_write(code_path.data(), code);
-  pid_t  pid = fork();
-  if (pid == 0) {
 #if !defined(__HIP_PLATFORM_HCC__)
-    CHECK_EQ(-1, execl("/usr/local/cuda/bin/nvcc", "/usr/local/cuda/bin/nvcc", code_path.c_str(), "-o", (code_path + ".fatbin").c_str(), "--fatbin", "-O4", "-gencode", ("arch=compute_" + arch.substr(3) + ",code=" + arch).c_str(), (char *)NULL));
+static const char *nvcc_path = "/usr/local/cuda/bin/nvcc";
+#else
+static const char *nvcc_path = "/opt/rocm/bin/hipcc";
+#endif
+
+// Compiler options are also hashed into kernel cache keys, so that changing them never reuses stale images
+static std::vector<std::string> get_nvcc_options(const std::string &arch) {
+#if !defined(__HIP_PLATFORM_HCC__)
+  return {"--fatbin", "-O4", "-gencode", "arch=compute_" + arch.substr(3) + ",code=" + arch};
+#else
+  return {"--genco", "-O4", "-w", "--amdgpu-target=" + arch};
+#endif
+}
+
+static std::vector<std::string> get_nvrtc_options(const std::string &arch) {
+#if !defined(__HIP_PLATFORM_HCC__)
+  return {"--restrict", "--include-path=/usr/local/cuda/include", "--gpu-architecture=" + arch, "--use_fast_math", "--extra-device-vectorization"};
 #else
-    CHECK_EQ(-1, execl("/opt/rocm/bin/hipcc", "/opt/rocm/bin/hipcc", code_path.c_str(), "-o", (code_path + ".fatbin").c_str(), "--genco", "-O4", "-w" , ("--amdgpu-target=" + arch).c_str(), (char *)NULL));
+  return {"--gpu-architecture=" + arch, "-O4"};
 #endif
+}
+
+static std::string nvcc_compile(const char* code, const std::string &arch, const std::string &key) {
+  std::string code_path = get_cache_path() + key + "." + std::to_string(getpid()) + ".cu";
+  file_write(code_path.data(), code);
+  std::vector<std::string> args = {nvcc_path, code_path, "-o", code_path + ".fatbin"};
+  for (auto &option : get_nvcc_options(arch))
+    args.push_back(option);
+  std::vector<char*> argv;
+  for (auto &arg : args)
+    argv.push_back((char*)arg.c_str());
+  argv.push_back(nullptr);
+  pid_t  pid = fork();
+  if (pid == 0) {
+    CHECK_EQ(-1, execv(nvcc_path, argv.data()));
     exit(1);
   } else {
     wait(NULL);
   }
   auto image = file_read((code_path + ".fatbin").data());
   remove((code_path + ".fatbin").data());
+  remove(code_path.data());
   return image;
 }
 
 static std::string nvrtc_compile(const char* code, const std::string &arch) {
-  std::string arch_option = "--gpu-architecture=" + arch;
-#if !defined(__HIP_PLATFORM_HCC__)
-  std::vector<const char*> param_cstrings = {"--restrict", "--include-path=/usr/local/cuda/include", arch_option.c_str(), "--use_fast_math", "--extra-device-vectorization"};
-#else
-  std::vector<const char*> param_cstrings = {arch_option.c_str(), "-O4"};
-#endif
+  std::vector<std::string> params = get_nvrtc_options(arch);
+  std::vector<const char*> param_cstrings;
+  for (auto &param : params)
+    param_cstrings.push_back(param.c_str());
   nvrtcProgram prog;
 
   CHECK_EQ(0, nvrtcCreateProgram(&prog, code, nullptr, 0, nullptr, nullptr));
@@ -122,6 +171,132 @@ static std::string nvrtc_compile(const char* code, const std::string &arch) {
   return ptx;
 }
 
+// Content-addressed kernel cache shared by all processes on the same host:
+//   <cache_path>/<hash(source, arch, flags, toolchain, compiler options)>.image
+// Images are written to a private temp file then renamed (atomic on POSIX), and a per-key
+// flock() ensures only one local rank pays the compilation while the others wait and reuse it.
+// Lock files are never removed, so that all processes always lock the same inode of a key, and an image
+// is only evicted by a process holding its key's lock (skipping images whose lock is taken).
+
+static std::string get_nvcc_version() {
+  // The installed compiler may differ from the one this extension was built with, so that its version is queried once at runtime
+  static std::string version = [] {
+    std::string output;
+    FILE *fp = popen((std::string(nvcc_path) + " --version 2>/dev/null").c_str(), "r");
+    if (fp == nullptr)
+      return output;
+    char buffer[256];
+    for (size_t size; (size = fread(buffer, 1, sizeof(buffer), fp)) > 0; )
+      output.append(buffer, size);
+    pclose(fp);
+    return output;
+  }();
+  return version;
+}
+
+static std::string get_kernel_cache_key(const std::string &code, const std::string &arch, int flags) {
+#if !defined(__HIP_PLATFORM_HCC__)
+  int nvrtc_major = 0, nvrtc_minor = 0;
+  nvrtcVersion(&nvrtc_major, &nvrtc_minor);
+  std::string toolchain = "cuda-" + std::to_string(CUDA_VERSION) + "-nvrtc-" + std::to_string(nvrtc_major) + "." + std::to_string(nvrtc_minor);
+#else
+  std::string toolchain = "hip-" + std::to_string(HIP_VERSION);
+#endif
+  std::string content = code + "\n//" + arch + "\n//" + std::to_string(flags) + "\n//" + toolchain + "\n//" + get_nvcc_version();
+  for (auto &option : get_nvrtc_options(arch))
+    content += "\n//nvrtc " + option;
+  for (auto &option : get_nvcc_options(arch))
+    content += "\n//nvcc " + option;
+  unsigned long long hash = 14695981039346656037ULL;
+  for (unsigned char c : content)
+    hash = (hash ^ c) * 1099511628211ULL;
+  char key[32];
+  snprintf(key, sizeof(key), "%016llx", hash);
+  return std::string(key) + "-" + arch;
+}
+
+static long get_kernel_cache_limit(const char *name, long default_value) {
+  const char *value = getenv(name);
+  return value ? std::atol(value) : default_value;
+}
+
+static void kernel_cache_evict(const std::string &cache_path, const std::string &keep) {
+  // KERNEL_CACHE_AGE_DAYS: drop images unused for longer; KERNEL_CACHE_SIZE_MB: then drop least recently used images beyond this size
+  long max_age = get_kernel_cache_limit("KERNEL_CACHE_AGE_DAYS", 30) * 24L * 3600L;
+  long max_size = get_kernel_cache_limit("KERNEL_CACHE_SIZE_MB", 1024) << 20;
+
+  std::vector<std::pair<time_t, std::pair<long, std::string>>> entries;
+  DIR *dir = opendir(cache_path.c_str());
+  if (dir == nullptr)
+    return;
+  const std::string suffix = ".image";
+  for (struct dirent *ent; (ent = readdir(dir)) != nullptr; ) {
+    std::string name = ent->d_name;
+    if (name.size() <= suffix.size() || name.compare(name.size() - suffix.size(), suffix.size(), suffix) != 0)
+      continue;
+    name = name.substr(0, name.size() - suffix.size());
+    struct stat st;
+    if (name != keep && stat((cache_path + name + suffix).c_str(), &st) == 0)
+      entries.push_back({st.st_mtime, {(long)st.st_size, name}});
+  }
+  closedir(dir);
+
+  std::sort(entries.begin(), entries.end());
+  long total_size = 0;
+  for (auto &it : entries)
+    total_size += it.second.first;
+  time_t now = time(nullptr);
+  for (auto &it : entries) {
+    if (now - it.first <= max_age && total_size <= max_size)
+      break;
+    int lock_fd = open((cache_path + it.second.second + ".lock").c_str(), O_CREAT | O_RDWR, 0644);
+    if (lock_fd < 0)
+      continue;
+    if (flock(lock_fd, LOCK_EX | LOCK_NB) == 0) {
+      if (remove((cache_path + it.second.second + suffix).c_str()) == 0)
+        total_size -= it.second.first;
+      flock(lock_fd, LOCK_UN);
+    }
+    close(lock_fd);
+  }
+}
+
+static std::string kernel_cache_compile(const char* code, const std::string &arch, int flags) {
+  int no_nvrtc = flags & 1;
+  auto compile = [&](const std::string &key) {
+    std::string image;
+    if (no_nvrtc || (image = nvrtc_compile(code, arch)) == "")
+      image = nvcc_compile(code, arch, key);
+    return image;
+  };
+
+  std::string cache_path = get_cache_path(), key = get_kernel_cache_key(code, arch, flags);
+  if (get_kernel_cache_limit("KERNEL_CACHE_SIZE_MB", 1024) <= 0)
+    return compile(key);
+
+  std::string image_path = cache_path + key + ".image", image;
+  int lock_fd = open((cache_path + key + ".lock").c_str(), O_CREAT | O_RDWR, 0644);
+  if (lock_fd >= 0)
+    flock(lock_fd, LOCK_EX);
+
+  // An image that cannot be read (e.g. removed externally) is recompiled instead of failing
+  if (file_try_read(image_path.c_str(), image)) {
+    utime(image_path.c_str(), nullptr);
+  } else {
+    image = compile(key);
+    std::string temp_path = image_path + "." + std::to_string(getpid()) + ".tmp";
+    file_write(temp_path.c_str(), image);
+    CHECK_EQ(0, rename(temp_path.c_str(), image_path.c_str()));
+    kernel_cache_evict(cache_path, key);
+  }
+
+  if (lock_fd >= 0) {
+    flock(lock_fd, LOCK_UN);
+    close(lock_fd);
+  }
+  return image;
+}
+
 struct ModuleConfig {
   CUmodule hMod = nullptr;
   CUfunction hFunc = nullptr;
@@ -190,10 +365,7 @@ static void invoke_with_source(const std::vector<torch::Tensor> &ts, int code_id
 #endif
     const char *source = code.data(), *pos, *tail;
 
-    int no_nvrtc = flags & 1;
-    std::string image;
-    if (no_nvrtc || (image = nvrtc_compile(source, arch)) == "")
-        image = nvcc_compile(source, arch, code_id, dev);
+    std::string image = kernel_cache_compile(source, arch, flags);
 
     long launch_bound;
     { char tag[] = " __launch_bounds__(";  pos = strstr(source, tag); launch_bound = pos ? std::atol(pos + sizeof(tag) - 1) : 1024L; }
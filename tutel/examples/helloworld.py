@@ -19,6 +19,7 @@ import argparse
 import logging
 
 from tutel import moe as tutel_moe
+from tutel.impls.communicate import get_compression_error
 
 logging.basicConfig(level=logging.INFO)
 
@@ -34,16 +35,19 @@ parser.add_argument('--dtype', type=str, default='float32')
 parser.add_argument('--fp32_gate', default=False, action='store_true')
 parser.add_argument('--top', type=int, default=2)
 parser.add_argument('--l_aux_wt', type=float, default=0.0)
+parser.add_argument('--device', type=str, default='cuda')
+parser.add_argument('--a2a_compress', type=str, default=None)
 args = parser.parse_args()
 
 if args.local_rank < 0:
     args.local_rank = int(os.environ.get('LOCAL_RANK', 0))
 
-torch.cuda.set_device(args.local_rank)
+if args.device == 'cuda':
+    torch.cuda.set_device(args.local_rank)
 
 try:
     if dist.is_available():
-        dist.init_process_group('nccl')
+        dist.init_process_group('nccl' if args.device == 'cuda' else 'gloo')
     dist_rank = dist.get_rank()
     dist_world_size = dist.get_world_size()
 
@@ -64,7 +68,7 @@ top_value = args.top
 local_rank = args.local_rank
 
 
-device = torch.device('cuda', args.local_rank)
+device = torch.device('cuda', args.local_rank) if args.device == 'cuda' else torch.device(args.device)
 
 if args.dtype == 'float32':
     torch.set_default_dtype(torch.float32)
@@ -86,6 +90,7 @@ class ExampleModel(torch.nn.Module):
             model_dim = model_dim,
             scan_expert_func = lambda name, param: setattr(param, 'skip_allreduce', True),
             seeds = (1, dist_rank + 1, 1),
+            a2a_compress = args.a2a_compress,
         ).to(device)
 
         # Distinguish different parameter types: gate, local_experts
@@ -116,7 +121,8 @@ params_for_all_reduce = [p for p in model.parameters() if not hasattr(p, 'skip_a
 
 for i in range(num_steps):
 
-    torch.cuda.synchronize()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
     t_start = time.time()
     optimizer.zero_grad()
 
@@ -131,10 +137,17 @@ for i in range(num_steps):
             dist.all_reduce(p.grad)
     optimizer.step()
 
-    torch.cuda.synchronize()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
     t_stop = time.time()
     dist_print('STEP-%s: DONE, loss = %s, step_time = %s sec.' % (i, float(loss.data), t_stop - t_start))
 
+    if args.a2a_compress and i == 0:
+        # The all_to_all payload is the dispatched buffer of routed tokens, re-encoded from this step's routing
+        with torch.no_grad():
+            dispatched_input = model._moe_layer.gate._fdr.encode(x.reshape(-1, model_dim))
+        dist_print('[Statistics] a2a_compress = %s, relative error bound of compressed messages on dispatched input = %g.\n' % (args.a2a_compress, get_compression_error(dispatched_input, args.a2a_compress)))
+
     if i + 10 >= num_steps:
         average_time += t_stop - t_start
 
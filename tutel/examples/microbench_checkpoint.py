@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import time
+import torch
+import argparse
+
+from tutel import moe as tutel_moe
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('--batch_size', type=int, default=16)
+parser.add_argument('--num_tokens', type=int, default=512)
+parser.add_argument('--model_dim', type=int, default=512)
+parser.add_argument('--hidden_sizes', type=str, default='1024,2048,4096')
+parser.add_argument('--num_local_experts', type=int, default=2)
+parser.add_argument('--top', type=int, default=2)
+parser.add_argument('--activation_fn', type=str, default='gelu')
+parser.add_argument('--dtype', type=str, default='float32')
+parser.add_argument('--device', type=str, default='cuda')
+parser.add_argument('--num_steps', type=int, default=10)
+args = parser.parse_args()
+
+device = torch.device(args.device)
+dtype = getattr(torch, args.dtype)
+
+def synchronize():
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+def saved_activation_bytes(model, x):
+    """Bytes of distinct non-parameter tensors that autograd keeps alive between forward and backward"""
+    params, saved = set(p.data_ptr() for p in model.parameters()), dict()
+    def pack(tensor):
+        if tensor.data_ptr() not in params:
+            saved[tensor.data_ptr()] = max(saved.get(tensor.data_ptr(), 0), tensor.untyped_storage().nbytes())
+        return tensor
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        y = model(x)
+    y.backward(torch.ones_like(y))
+    return sum(saved.values())
+
+def benchmark(hidden_size, checkpoint):
+    torch.manual_seed(0)
+    model = tutel_moe.moe_layer(
+        gate_type={'type': 'top', 'k': args.top},
+        model_dim=args.model_dim,
+        experts={'type': 'ffn', 'count_per_node': args.num_local_experts, 'hidden_size_per_expert': hidden_size, 'activation_fn': args.activation_fn, 'checkpoint': checkpoint},
+    ).to(device).to(dtype)
+    x = torch.randn([args.batch_size, args.num_tokens, args.model_dim], dtype=dtype, device=device, requires_grad=True)
+    saved_bytes = saved_activation_bytes(model, x)
+
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    for step in range(args.num_steps + 3):
+        if step == 3:
+            synchronize(); t_start = time.time()
+        y = model(x)
+        y.backward(torch.ones_like(y))
+    synchronize()
+    step_time = (time.time() - t_start) / args.num_steps * 1e3
+    peak_bytes = torch.cuda.max_memory_allocated(device) if device.type == 'cuda' else 0
+    return step_time, saved_bytes, peak_bytes
+
+print('[Summary] samples = %d x %d, model_dim = %d, local_experts = %d, top = %d, activation = %s, dtype = %s, device = %s' % (
+    args.batch_size, args.num_tokens, args.model_dim, args.num_local_experts, args.top, args.activation_fn, args.dtype, device))
+for hidden_size in [int(x) for x in args.hidden_sizes.split(',')]:
+    results = [benchmark(hidden_size, checkpoint) for checkpoint in (False, True)]
+    peak_memory = ', peak memory = %.2f MB -> %.2f MB' % (results[0][2] / 2**20, results[1][2] / 2**20) if device.type == 'cuda' else ''
+    print('[Statistics] hidden_size = %5d: step time = %.3f ms -> %.3f ms, saved activations = %.2f MB -> %.2f MB%s' % (
+        hidden_size, results[0][0], results[1][0], results[0][1] / 2**20, results[1][1] / 2**20, peak_memory))
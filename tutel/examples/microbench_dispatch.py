@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import time
+import torch
+import argparse
+
+from tutel import moe as tutel_moe
+from tutel.jit_kernels.gating import fast_topk_locations
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('--num_tokens', type=int, default=4096)
+parser.add_argument('--model_dim', type=int, default=1024)
+parser.add_argument('--num_global_experts', type=int, default=16)
+parser.add_argument('--top', type=int, default=2)
+parser.add_argument('--capacity_factor', type=float, default=1.0)
+parser.add_argument('--dtype', type=str, default='float32')
+parser.add_argument('--device', type=str, default='cuda')
+parser.add_argument('--num_steps', type=int, default=50)
+args = parser.parse_args()
+
+device = torch.device(args.device)
+dtype = getattr(torch, args.dtype)
+S, M, E, k = args.num_tokens, args.model_dim, args.num_global_experts, args.top
+capacity = k * int(args.capacity_factor * ((S + E - 1) // E))
+
+torch.manual_seed(0)
+x = torch.randn([S, M], dtype=dtype, device=device, requires_grad=True)
+topk_indices = torch.topk(torch.randn([S, E], device=device), k, dim=1).indices
+locations = fast_topk_locations(topk_indices, E)[0]
+indices_s, locations_s = list(topk_indices.t().contiguous().unbind(0)), list(locations.unbind(0))
+gates_s = [torch.rand([S], dtype=dtype, device=device, requires_grad=True) for _ in range(k)]
+
+def synchronize():
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+def benchmark(index_gather):
+    fdr = tutel_moe.fast_dispatcher(E, capacity, M, dtype, device=device, index_gather=index_gather)
+    elapsed = {'update': 0.0, 'encode': 0.0, 'decode': 0.0, 'backward': 0.0}
+    for step in range(args.num_steps + 5):
+        if step == 5:
+            elapsed = {x: 0.0 for x in elapsed}
+        synchronize(); t_start = time.time()
+        fdr.update(indices_s, locations_s, gates_s, capacity=capacity)
+        synchronize(); t_update = time.time()
+        dispatched_input = fdr.encode(x)
+        synchronize(); t_encode = time.time()
+        output = fdr.decode(dispatched_input)
+        synchronize(); t_decode = time.time()
+        output.backward(torch.ones_like(output))
+        synchronize(); t_backward = time.time()
+        elapsed['update'] += t_update - t_start
+        elapsed['encode'] += t_encode - t_update
+        elapsed['decode'] += t_decode - t_encode
+        elapsed['backward'] += t_backward - t_decode
+    return {x: elapsed[x] / args.num_steps * 1e3 for x in elapsed}
+
+print('[Summary] tokens = %d, model_dim = %d, experts = %d, top = %d, capacity = %d, dtype = %s, device = %s' % (S, M, E, k, capacity, args.dtype, device))
+for name, index_gather in (('scatter (atomic)', False), ('index-gather', True)):
+    result = benchmark(index_gather)
+    print('[Statistics] %-16s update = %.3f ms, encode = %.3f ms, decode = %.3f ms, backward = %.3f ms, total = %.3f ms' % (name, result['update'], result['encode'], result['decode'], result['backward'], sum(result.values())))
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import time
+import torch
+import argparse
+
+from tutel import moe as tutel_moe
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('--num_tokens', type=int, default=4096)
+parser.add_argument('--model_dim', type=int, default=512)
+parser.add_argument('--hidden_size', type=int, default=512)
+parser.add_argument('--world_size', type=int, default=2)
+parser.add_argument('--local_experts', type=str, default='2,4,8,16,32,64')
+parser.add_argument('--dtype', type=str, default='float32')
+parser.add_argument('--device', type=str, default='cuda')
+parser.add_argument('--num_steps', type=int, default=20)
+args = parser.parse_args()
+
+device = torch.device(args.device)
+dtype = getattr(torch, args.dtype)
+W, M, V = args.world_size, args.model_dim, args.hidden_size
+
+def synchronize():
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+def benchmark(fn, *inputs):
+    for step in range(args.num_steps + 3):
+        if step == 3:
+            synchronize(); t_start = time.time()
+        output = fn(*inputs)
+        output.backward(torch.ones_like(output))
+    synchronize()
+    return (time.time() - t_start) / args.num_steps * 1e3
+
+def create_experts(E):
+    torch.manual_seed(0)
+    layer = tutel_moe.moe_layer(gate_type={'type': 'top', 'k': 1}, model_dim=M, experts={'type': 'ffn', 'count_per_node': E, 'hidden_size_per_expert': V, 'grouped_gemm': True})
+    return layer.experts[0].to(device).to(dtype)
+
+print('[Summary] tokens = %d, world_size = %d, model_dim = %d, hidden_size = %d, dtype = %s, device = %s' % (args.num_tokens, W, M, V, args.dtype, device))
+for E in [int(x) for x in args.local_experts.split(',')]:
+    C = max(args.num_tokens // (W * E), 1)
+    grouped = create_experts(E)
+
+    # Variable per-expert token counts as produced by dropless routing, against padding all experts to the max count
+    counts = torch.distributions.Exponential(1.0).sample([E]).add(0.2)
+    counts = (counts / counts.sum() * W * E * C).long().clamp(min=1).tolist()
+    x_var = torch.randn([sum(counts), M], dtype=dtype, device=device, requires_grad=True)
+    x_pad = torch.randn([1, E, max(counts), M], dtype=dtype, device=device, requires_grad=True)
+
+    print('[Statistics] local_experts = %3d, avg tokens = %5d, max/avg tokens = %.2f: padded = %.3f ms, grouped = %.3f ms' % (
+        E, C * W, max(counts) * E / sum(counts), benchmark(grouped, x_pad), benchmark(grouped.forward_grouped, x_var, counts)))
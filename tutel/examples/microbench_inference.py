@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import time
+import torch
+import argparse
+
+from tutel import moe as tutel_moe
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('--num_tokens', type=str, default='1,4,16,64,256,1024,4096')
+parser.add_argument('--model_dim', type=int, default=512)
+parser.add_argument('--hidden_size', type=int, default=1024)
+parser.add_argument('--num_local_experts', type=int, default=8)
+parser.add_argument('--top', type=int, default=2)
+parser.add_argument('--capacity_factor', type=float, default=1.0)
+parser.add_argument('--dtype', type=str, default='float32')
+parser.add_argument('--device', type=str, default='cpu')
+parser.add_argument('--num_steps', type=int, default=20)
+args = parser.parse_args()
+
+device = torch.device(args.device)
+dtype = getattr(torch, args.dtype)
+
+def synchronize():
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+def benchmark(model, x):
+    latencies = []
+    with torch.no_grad():
+        for step in range(args.num_steps + 3):
+            synchronize(); t_start = time.perf_counter()
+            model(x)
+            synchronize(); t_stop = time.perf_counter()
+            if step >= 3:
+                latencies.append((t_stop - t_start) * 1e3)
+    return sorted(latencies)[len(latencies) // 2]
+
+def create_model(fast_inference):
+    torch.manual_seed(0)
+    # Serving sees variable batch sizes, so both models pad to power-of-2 buckets instead of the first seen size
+    return tutel_moe.moe_layer(
+        gate_type={'type': 'top', 'k': args.top, 'capacity_factor': args.capacity_factor},
+        model_dim=args.model_dim,
+        experts={'type': 'ffn', 'count_per_node': args.num_local_experts, 'hidden_size_per_expert': args.hidden_size},
+        sample_buckets='pow2',
+        fast_inference=fast_inference,
+    ).to(device).to(dtype).eval()
+
+default, fast = create_model(False), create_model(True)
+
+print('[Summary] model_dim = %d, hidden_size = %d, local_experts = %d, top = %d, dtype = %s, device = %s' % (args.model_dim, args.hidden_size, args.num_local_experts, args.top, args.dtype, device))
+for num_tokens in [int(x) for x in args.num_tokens.split(',')]:
+    x = torch.randn([num_tokens, args.model_dim], dtype=dtype, device=device)
+    default_latency, fast_latency = benchmark(default, x), benchmark(fast, x)
+    print('[Statistics] tokens = %4d: no_grad = %.3f ms, fast_inference = %.3f ms (p50, %.2fx)' % (num_tokens, default_latency, fast_latency, default_latency / fast_latency))
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import time
+import torch
+import argparse
+
+from tutel import moe as tutel_moe
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('--num_tokens', type=str, default='1,4,16,64,256')
+parser.add_argument('--model_dim', type=int, default=1024)
+parser.add_argument('--hidden_size', type=int, default=4096)
+parser.add_argument('--num_local_experts', type=int, default=16)
+parser.add_argument('--top', type=int, default=2)
+parser.add_argument('--capacity_factor', type=float, default=1.0)
+parser.add_argument('--dtype', type=str, default='float32')
+parser.add_argument('--device', type=str, default='cuda')
+parser.add_argument('--num_steps', type=int, default=20)
+args = parser.parse_args()
+
+device = torch.device(args.device)
+dtype = getattr(torch, args.dtype)
+
+def synchronize():
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+def benchmark(model, x):
+    with torch.no_grad():
+        for step in range(args.num_steps + 3):
+            if step == 3:
+                synchronize(); t_start = time.time()
+            model(x)
+    synchronize()
+    return (time.time() - t_start) / args.num_steps * 1e3
+
+def create_model(skip_empty):
+    torch.manual_seed(0)
+    return tutel_moe.moe_layer(
+        gate_type={'type': 'top', 'k': args.top, 'capacity_factor': args.capacity_factor},
+        model_dim=args.model_dim,
+        experts={'type': 'ffn', 'count_per_node': args.num_local_experts, 'hidden_size_per_expert': args.hidden_size, 'skip_empty': skip_empty},
+    ).to(device).to(dtype).eval()
+
+print('[Summary] model_dim = %d, hidden_size = %d, local_experts = %d, top = %d, dtype = %s, device = %s' % (args.model_dim, args.hidden_size, args.num_local_experts, args.top, args.dtype, device))
+for num_tokens in [int(x) for x in args.num_tokens.split(',')]:
+    x = torch.randn([num_tokens, args.model_dim], dtype=dtype, device=device)
+    full, occupied = create_model(False), create_model(True)
+    capacity = full.gate.get_capacity(num_tokens)
+    print('[Statistics] tokens = %4d, capacity = %4d: all slots = %.3f ms, occupied slots = %.3f ms' % (num_tokens, capacity, benchmark(full, x), benchmark(occupied, x)))
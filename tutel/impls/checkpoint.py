@@ -0,0 +1,143 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import os
+import json
+
+import torch
+import torch.distributed as dist
+
+from .communicate import get_world_size, get_world_rank
+
+
+INDEX_FILE = 'index.json'
+SHARD_FILE = 'shard_%05d.bin'
+ALIGNMENT = 64
+
+# Axis of hidden slices in per-expert tensors of builtin ffn experts sharded by a negative `count_per_node`
+FFN_HIDDEN_AXES = {'fc1_weight': 1, 'fc1_bias': 1, 'fc2_weight': 0, 'fc2_bias': None}
+
+
+def get_local_expert_ids(layer, rank):
+    """(global expert, shard) of each local expert, following how dispatched buffers are split by all_to_all"""
+    if layer.sharded_count > 1:
+        return [(rank % layer.num_global_experts, rank // layer.num_global_experts)]
+    return [(rank * layer.num_local_experts + i, 0) for i in range(layer.num_local_experts)]
+
+
+def is_builtin_ffn(layer):
+    return len(layer.experts) == 1 and hasattr(layer.experts[0], 'fc1_weight') and hasattr(layer.experts[0], 'local_experts')
+
+
+def iterate_local_experts(layer, rank):
+    """Yields (name, global expert, shard, tensor) of each per-expert tensor owned by this rank"""
+    expert_ids = get_local_expert_ids(layer, rank)
+    if is_builtin_ffn(layer):
+        ffn = layer.experts[0]
+        for name in FFN_HIDDEN_AXES:
+            param = getattr(ffn, name)
+            per_expert = param.view(ffn.local_experts, *param.shape[-2:]) if ffn.local_experts > 1 else param.unsqueeze(0)
+            for (expert_id, shard), tensor in zip(expert_ids, per_expert.unbind(0)):
+                yield name, expert_id, shard, tensor
+    elif len(layer.experts) == layer.num_local_experts and layer.sharded_count == 1:
+        for (expert_id, shard), expert in zip(expert_ids, layer.experts):
+            for name, tensor in expert.state_dict().items():
+                yield name, expert_id, shard, tensor
+    else:
+        raise Exception('Sharded checkpoint requires builtin ffn experts, or custom experts with one module per local expert.')
+
+
+def save_sharded_checkpoint(layer, path):
+    """Writes local experts of each rank to its own shard file, with a global index written by rank 0
+
+    Tensors are streamed to disk one expert at a time, so that no host copy of the whole layer is created.
+    Non-expert tensors (e.g. gate weights) are replicated across ranks and only saved by rank 0.
+    """
+    rank, world_size = get_world_rank(layer.group), get_world_size(layer.group)
+    os.makedirs(path, exist_ok=True)
+
+    tensors = [(name, expert_id, shard, tensor) for name, expert_id, shard, tensor in iterate_local_experts(layer, rank)]
+    if rank == 0:
+        tensors += [(name, None, 0, tensor) for name, tensor in layer.state_dict().items() if not name.startswith('experts.')]
+
+    entries, offset = [], 0
+    with open(os.path.join(path, SHARD_FILE % rank), 'wb') as fp:
+        for name, expert_id, shard, tensor in tensors:
+            data = tensor.detach().to('cpu').contiguous()
+            data.view(-1).view(torch.uint8).numpy().tofile(fp)
+            entries.append({'name': name, 'expert': expert_id, 'shard': shard, 'file': SHARD_FILE % rank, 'offset': offset,
+                            'shape': list(data.shape), 'dtype': str(data.dtype).split('.')[-1]})
+            # Keep every tensor aligned in the shard file, so that loading can view mapped bytes as any dtype
+            padding = -(data.numel() * data.element_size()) % ALIGNMENT
+            fp.write(bytes(padding))
+            offset += data.numel() * data.element_size() + padding
+
+    if world_size > 1:
+        all_entries = [None] * world_size
+        dist.all_gather_object(all_entries, entries, group=layer.group)
+        entries = sum(all_entries, [])
+    if rank == 0:
+        fc1_copies = layer.experts[0].fc1_weight.size(-1) // layer.experts[0].hidden_size if is_builtin_ffn(layer) else 1
+        index = {'num_global_experts': layer.num_global_experts, 'sharded_count': layer.sharded_count, 'world_size': world_size, 'fc1_copies': fc1_copies, 'entries': entries}
+        with open(os.path.join(path, INDEX_FILE), 'w') as fp:
+            json.dump(index, fp)
+    if world_size > 1:
+        dist.barrier(group=layer.group)
+
+
+def reslice_expert(name, slices, sharded_count, shard, fc1_copies=1):
+    """Merges hidden slices of one saved expert, then takes the `shard`-th of `sharded_count` slices"""
+    if len(slices) == sharded_count:
+        return slices[shard]
+    axis = FFN_HIDDEN_AXES.get(name, -1)
+    if axis is None:
+        # Outputs of expert shards are summed, so that each shard takes an equal part of the output bias
+        return sum(x.float() for x in slices).div(sharded_count).to(slices[0].dtype)
+    if axis < 0:
+        raise Exception('Tensor `%s` of custom experts cannot be re-sliced from %d to %d shards.' % (name, len(slices), sharded_count))
+    # fc1 keeps `fc1_copies` contiguous blocks per slice (e.g. gate and up projections of swiglu), which are merged block-wise
+    copies = fc1_copies if name.startswith('fc1') else 1
+    blocks = [x.reshape(*x.shape[:axis], copies, -1, *x.shape[axis + 1:]) for x in slices]
+    merged = torch.cat(blocks, dim=axis + 1)
+    part = merged.chunk(sharded_count, dim=axis + 1)[shard]
+    return part.reshape(*part.shape[:axis], -1, *part.shape[axis + 2:])
+
+
+def load_sharded_checkpoint(layer, path):
+    """Loads a checkpoint of `save_sharded_checkpoint`, re-slicing experts for a different world size or `count_per_node`
+
+    Shard files are memory-mapped, so that each rank only pages in the experts it owns.
+    """
+    with open(os.path.join(path, INDEX_FILE), 'r') as fp:
+        index = json.load(fp)
+    if index['num_global_experts'] != layer.num_global_experts:
+        raise Exception('Checkpoint has %d global experts, while this layer has %d global experts.' % (index['num_global_experts'], layer.num_global_experts))
+
+    mapped_files = dict()
+    def load_entry(entry):
+        if entry['file'] not in mapped_files:
+            filename = os.path.join(path, entry['file'])
+            mapped_files[entry['file']] = torch.from_file(filename, shared=False, size=os.path.getsize(filename), dtype=torch.uint8)
+        dtype = getattr(torch, entry['dtype'])
+        nbytes = torch.Size(entry['shape']).numel() * torch.empty([], dtype=dtype).element_size()
+        return mapped_files[entry['file']][entry['offset']:entry['offset'] + nbytes].view(dtype).view(entry['shape'])
+
+    tensor_entries = dict()
+    for entry in index['entries']:
+        tensor_entries.setdefault((entry['name'], entry['expert']), []).append(entry)
+
+    with torch.no_grad():
+        for name, tensor in layer.state_dict().items():
+            if not name.startswith('experts.'):
+                if (name, None) not in tensor_entries:
+                    raise Exception('Tensor `%s` is not found in checkpoint %s.' % (name, path))
+                tensor.copy_(load_entry(tensor_entries[(name, None)][0]))
+
+        for name, expert_id, shard, tensor in iterate_local_experts(layer, get_world_rank(layer.group)):
+            if (name, expert_id) not in tensor_entries:
+                raise Exception('Tensor `%s` of expert %d is not found in checkpoint %s.' % (name, expert_id, path))
+            slices = [load_entry(entry) for entry in sorted(tensor_entries[(name, expert_id)], key=lambda entry: entry['shard'])]
+            source = reslice_expert(name, slices, layer.sharded_count, shard, index['fc1_copies'])
+            if source.shape != tensor.shape:
+                raise Exception('Tensor `%s` of expert %d has shape %s in checkpoint, while expecting %s.' % (name, expert_id, list(source.shape), list(tensor.shape)))
+            tensor.copy_(source)
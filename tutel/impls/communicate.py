@@ -12,6 +12,7 @@ from torch import Tensor
 import torch.distributed as dist
 
 from .jit_compiler import tutel_custom_kernel
+from .workspace import allocate
 
 def get_world_size(group):
     try:
@@ -26,9 +27,78 @@ def get_world_rank(group):
         return 0
 
 
+def get_2dh_groups(group):
+    """Intra-node and inter-node groups for hierarchical all_to_all, or None if the topology is flat"""
+    if not hasattr(get_2dh_groups, 'cache'):
+        get_2dh_groups.cache = dict()
+    if group in get_2dh_groups.cache:
+        return get_2dh_groups.cache[group]
+
+    world_size, world_rank = get_world_size(group), get_world_rank(group)
+    local_size = int(os.environ.get('LOCAL_SIZE', os.environ.get('LOCAL_WORLD_SIZE', torch.cuda.device_count() if torch.cuda.is_available() else 1)))
+    # new_group() must be called by all processes of the default group, so only a full-world group is supported
+    if local_size <= 1 or local_size >= world_size or world_size % local_size != 0 or world_size != dist.get_world_size():
+        if world_rank == 0:
+            logging.warning('Hierarchical AllToAll is not applicable for world size = %d and LOCAL_SIZE = %d, using flat AllToAll instead.' % (world_size, local_size))
+        get_2dh_groups.cache[group] = None
+        return None
+
+    num_nodes = world_size // local_size
+    local_group, cross_group = None, None
+    for node in range(num_nodes):
+        ranks_group = dist.new_group(ranks=list(range(node * local_size, (node + 1) * local_size)))
+        if world_rank // local_size == node:
+            local_group = ranks_group
+    for local_rank in range(local_size):
+        ranks_group = dist.new_group(ranks=list(range(local_rank, world_size, local_size)))
+        if world_rank % local_size == local_rank:
+            cross_group = ranks_group
+    get_2dh_groups.cache[group] = (local_group, cross_group, num_nodes, local_size)
+    return get_2dh_groups.cache[group]
+
+
+def all_to_all_2dh(input, groups):
+    local_group, cross_group, num_nodes, local_size = groups
+    # Stage 1: intra-node exchange, so that each local rank collects messages for peers with the same local rank
+    input = input.view(num_nodes, local_size, -1).transpose(0, 1).contiguous()
+    output = torch.empty_like(input)
+    dist.all_to_all_single(output, input, group=local_group)
+    # Stage 2: one inter-node exchange between peers with the same local rank
+    input = output.view(local_size, num_nodes, -1).transpose(0, 1).contiguous()
+    output = torch.empty_like(input)
+    dist.all_to_all_single(output, input, group=cross_group)
+    return output
+
+
+def compress_payload(input, a2a_compress):
+    """Per-row compression of all_to_all messages: 'fp16'/'bf16' downcast, or 'int8' with per-row float32 scales"""
+    if a2a_compress in ('fp16', 'bf16'):
+        return input.to(torch.float16 if a2a_compress == 'fp16' else torch.bfloat16)
+    elif a2a_compress == 'int8':
+        rows = input.reshape(-1, input.size(-1)).float()
+        scales = rows.abs().amax(dim=-1, keepdim=True).clamp(min=torch.finfo(torch.float32).tiny) / 127
+        quantized = torch.round(rows / scales).clamp(-127, 127).to(torch.int8)
+        # Append each row's scale as 4 raw bytes, so that quantized data and scales travel in one message
+        return torch.cat([quantized, scales.view(torch.int8)], dim=-1)
+    raise Exception("Unrecognized a2a_compress type: %s. Valid `a2a_compress` includes: fp16, bf16, int8." % a2a_compress)
+
+def decompress_payload(payload, a2a_compress, shape, dtype):
+    if a2a_compress == 'int8':
+        scales = payload[:, -4:].contiguous().view(torch.float32)
+        return (payload[:, :-4].float() * scales).to(dtype).view(shape)
+    return payload.to(dtype).view(shape)
+
+def get_compression_error(input, a2a_compress):
+    """Relative max-abs error of a compress/decompress round trip, used to report error bound of compressed all_to_all"""
+    if a2a_compress is None:
+        return 0.0
+    restored = decompress_payload(compress_payload(input, a2a_compress), a2a_compress, input.shape, input.dtype)
+    return float((restored.float() - input.float()).abs().max() / input.float().abs().max().clamp(min=torch.finfo(torch.float32).tiny))
+
+
 class AllToAll(torch.autograd.Function):
     @staticmethod
-    def forward(ctx: Any, group: dist.ProcessGroup, input: Tensor):
+    def forward(ctx: Any, group: dist.ProcessGroup, input: Tensor, use_2dh: Optional[bool] = None, a2a_compress: Optional[str] = None, workspace: Optional[Any] = None):
         if not hasattr(AllToAll, '__prepared__'):
             AllToAll.__prepared__ = True
             if not hasattr(dist, 'all_to_all_single') and (AllToAll.a2a_type & 1) == 1:
@@ -42,28 +112,102 @@ class AllToAll(torch.autograd.Function):
                 tutel_custom_kernel.external_all2all(host_unique_id.cpu(), 1)
 
         ctx.group = group
+        ctx.use_2dh, ctx.a2a_compress, ctx.workspace = use_2dh, a2a_compress, workspace
         ctx.world_size = get_world_size(group)
         if ctx.world_size <= 1 or AllToAll.a2a_type == 0:
             return input
+        if use_2dh is None:
+            use_2dh = (AllToAll.a2a_type & 4) == 4
+        original_shape, original_dtype = input.shape, input.dtype
+        if a2a_compress is not None:
+            input = compress_payload(input, a2a_compress)
         input = input.contiguous()
         if (AllToAll.a2a_type & 8) == 8:
-            torch.cuda.synchronize(input.device)
+            if input.is_cuda:
+                torch.cuda.synchronize(input.device)
             t_start = time.time()
-        if (AllToAll.a2a_type & 1) == 1:
-          output = torch.empty_like(input)
+        groups = get_2dh_groups(group) if use_2dh and (AllToAll.a2a_type & 1) == 1 else None
+        if groups is not None:
+          output = all_to_all_2dh(input, groups).view(input.shape)
+        elif (AllToAll.a2a_type & 1) == 1:
+          output = allocate(workspace, 'a2a', input.shape, input.dtype, input.device)
           dist.all_to_all_single(output, input, group=group)
         else:
           output = tutel_custom_kernel.external_all2all(input, -1)
         if (AllToAll.a2a_type & 8) == 8:
-            torch.cuda.synchronize(input.device)
+            if input.is_cuda:
+                torch.cuda.synchronize(input.device)
             t_stop = time.time()
             if get_world_rank(group) == 0:
                 logging.info('AllToAll on message size (%d x %s) costs %g sec.' % (torch.numel(input), input.dtype, t_stop - t_start))
+        if a2a_compress is not None:
+            output = decompress_payload(output, a2a_compress, original_shape, original_dtype)
         return output
 
     @staticmethod
     def backward(ctx: Any, grad_output: Tensor):
-        return (None, AllToAll.apply(ctx.group, grad_output))
+        return (None, AllToAll.apply(ctx.group, grad_output, ctx.use_2dh, ctx.a2a_compress, ctx.workspace), None, None, None)
+
+
+class AllToAllStatus:
+    """Shared handle between AllToAllAsync and AllToAllWait of the same message"""
+    def __init__(self):
+        self.work = None
+
+
+class AllToAllAsync(torch.autograd.Function):
+    """Launch all_to_all without waiting, the result is only valid after AllToAllWait"""
+    @staticmethod
+    def forward(ctx: Any, group: dist.ProcessGroup, status: AllToAllStatus, input: Tensor):
+        ctx.group, ctx.status = group, status
+        input = input.contiguous()
+        output = torch.empty_like(input)
+        status.work = dist.all_to_all_single(output, input, group=group, async_op=True)
+        return output
+
+    @staticmethod
+    def backward(ctx: Any, grad_output: Tensor):
+        ctx.status.work.wait()
+        return (None, None, grad_output)
+
+
+class AllToAllWait(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx: Any, group: dist.ProcessGroup, status: AllToAllStatus, input: Tensor):
+        ctx.group, ctx.status = group, status
+        status.work.wait()
+        return input
+
+    @staticmethod
+    def backward(ctx: Any, grad_output: Tensor):
+        grad_output = grad_output.contiguous()
+        grad_input = torch.empty_like(grad_output)
+        ctx.status.work = dist.all_to_all_single(grad_input, grad_output, group=ctx.group, async_op=True)
+        return (None, None, grad_input)
+
+
+class AllToAllV(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx: Any, group: dist.ProcessGroup, input: Tensor, input_splits, output_splits):
+        ctx.group = group
+        ctx.input_splits, ctx.output_splits = input_splits, output_splits
+        if get_world_size(group) <= 1:
+            return input
+        output = torch.empty([sum(output_splits)] + list(input.shape[1:]), dtype=input.dtype, device=input.device)
+        dist.all_to_all_single(output, input.contiguous(), output_split_sizes=output_splits, input_split_sizes=input_splits, group=group)
+        return output
+
+    @staticmethod
+    def backward(ctx: Any, grad_output: Tensor):
+        return (None, AllToAllV.apply(ctx.group, grad_output, ctx.output_splits, ctx.input_splits), None, None)
+
+
+def exchange_counts(group, counts):
+    if get_world_size(group) <= 1:
+        return counts
+    output = torch.empty_like(counts)
+    dist.all_to_all_single(output, counts.contiguous(), group=group)
+    return output
 
 
 class PreAllreduceSum(torch.autograd.Function):
@@ -112,5 +256,5 @@ class PostAllreduceSum(torch.autograd.Function):
         return (None, dinput)
 
 
-# A2A_TYPE: 0 for skip AllToAll, 1 for standard Pytorch AllToAll, 9 for standard Pytorch AllToAll with Timing
+# A2A_TYPE: 0 for skip AllToAll, 1 for standard Pytorch AllToAll, 5 for hierarchical (intra-node + inter-node) Pytorch AllToAll, 9 for standard Pytorch AllToAll with Timing
 AllToAll.a2a_type = int(os.environ.get('A2A_TYPE', '1'))
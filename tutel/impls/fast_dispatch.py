@@ -7,95 +7,183 @@ import torch
 from torch import Tensor
 
 from .jit_compiler import IS_HIP_EXTENSION
+from .workspace import allocate
 from ..jit_kernels import sparse as jit_kernel
 
+def encode_forward(config, reshaped_input):
+    dispatched_input = allocate(config.workspace, 'dispatch', [config.num_global_experts * config.capacity, config.model_dim], reshaped_input.dtype, reshaped_input.device, zero=True)
+    config.func_fwd(config.ones_helper, config.indices_flat, config.locations_flat, reshaped_input, dispatched_input)
+    return dispatched_input
+
+
+def get_kernel_gates(gates_):
+    gates_flat = torch.cat(gates_)
+    return gates_flat.view(-1, 1).repeat(1, 2) if gates_flat.dtype == torch.float16 else gates_flat
+
+
+def decode_forward(config, expert_output, gates_h2):
+    combined_output = allocate(config.workspace, 'combine', [config.expected_sample_size, config.model_dim], expert_output.dtype, expert_output.device)
+    config.func_bwd_data(gates_h2, expert_output, config.indices_flat, config.locations_flat, combined_output)
+    return combined_output
+
+
+def gather_encode_forward(config, reshaped_input):
+    # Each slot gathers its source token once, so only empty slots need explicit zero-filling
+    dispatched_input = allocate(config.workspace, 'dispatch', [config.slot_sources.size(0), config.model_dim], reshaped_input.dtype, reshaped_input.device)
+    torch.index_select(reshaped_input, 0, config.slot_sources, out=dispatched_input)
+    dispatched_input.index_fill_(0, config.empty_slots, 0)
+    return dispatched_input
+
+
+def gather_decode_forward(config, expert_output, gates):
+    combined_output = allocate(config.workspace, 'combine', [config.expected_sample_size, config.model_dim], expert_output.dtype, expert_output.device, zero=True)
+    combined_output.index_add_(0, config.token_ids, expert_output.index_select(0, config.slot_ids) * gates.unsqueeze(-1))
+    return combined_output
+
+
 class GatingEncoder(torch.autograd.Function):
     @staticmethod
     def forward(ctx: Any, config: Any, reshaped_input: Tensor):
-        ctx.reshaped_input = reshaped_input
+        # Backward only needs the input shape, so the input itself is not kept alive by this function
+        ctx.input_shape = reshaped_input.shape
         ctx.config = config
-
-        dispatched_input = torch.zeros([ctx.config.num_global_experts * ctx.config.capacity, ctx.config.model_dim], dtype=reshaped_input.dtype, device=reshaped_input.device)
-        for i in range(len(ctx.config.indices_)):
-          ctx.config.func_fwd(ctx.config.ones_helper, ctx.config.indices_[i], ctx.config.locations_[i], reshaped_input, dispatched_input)
-        return dispatched_input
+        return encode_forward(config, reshaped_input)
 
     @staticmethod
     def backward(ctx: Any, dispatched_input: Tensor):
         dispatched_input = dispatched_input.contiguous()
-        last_result = None
-        for i in range(len(ctx.config.indices_)):
-          grad_data = torch.empty(ctx.reshaped_input.shape, dtype=dispatched_input.dtype, device=dispatched_input.device)
-          ctx.config.func_bwd_data(ctx.config.ones_helper, dispatched_input, ctx.config.indices_[i], ctx.config.locations_[i], grad_data)
-          last_result = grad_data if last_result is None else last_result + grad_data
-        return (None, last_result)
+        grad_data = allocate(ctx.config.workspace, 'grad_input', ctx.input_shape, dispatched_input.dtype, dispatched_input.device)
+        ctx.config.func_bwd_data(ctx.config.ones_helper, dispatched_input, ctx.config.indices_flat, ctx.config.locations_flat, grad_data)
+        return (None, grad_data)
 
 
 class GatingDecoder(torch.autograd.Function):
     @staticmethod
     def forward(ctx: Any, config: Any, expert_output: Tensor, *gates_: Tensor):
         ctx.expert_output = expert_output
-        ctx.gates_h2 = [x.view(-1, 1).repeat(1, 2) if x.dtype == torch.float16 else x for x in gates_]
+        ctx.gates_h2 = get_kernel_gates(gates_)
         ctx.config = config
-
-        last_result = None
-        for i in range(len(config.indices_)):
-          single_output = torch.empty([config.expected_sample_size, config.model_dim], dtype=expert_output.dtype, device=expert_output.device)
-          config.func_bwd_data(ctx.gates_h2[i], expert_output, config.indices_[i], config.locations_[i], single_output)
-          last_result = single_output if last_result is None else last_result + single_output
-        return last_result
+        return decode_forward(config, expert_output, ctx.gates_h2)
 
     @staticmethod
     def backward(ctx: Any, combined_output: Tensor):
         combined_output = combined_output.contiguous()
-        grad_expert_output = torch.zeros(ctx.expert_output.shape, dtype=combined_output.dtype, device=combined_output.device)
-        for i in range(len(ctx.config.indices_)):
-          ctx.config.func_fwd(ctx.gates_h2[i], ctx.config.indices_[i], ctx.config.locations_[i], combined_output, grad_expert_output)
+        grad_expert_output = allocate(ctx.config.workspace, 'grad_expert', ctx.expert_output.shape, combined_output.dtype, combined_output.device, zero=True)
+        ctx.config.func_fwd(ctx.gates_h2, ctx.config.indices_flat, ctx.config.locations_flat, combined_output, grad_expert_output)
+
+        grad_gates = allocate(ctx.config.workspace, 'grad_gates', [ctx.config.top_k * ctx.config.expected_sample_size], combined_output.dtype, combined_output.device)
+        ctx.config.func_bwd_gate(ctx.expert_output, ctx.config.indices_flat, ctx.config.locations_flat, combined_output, grad_gates)
+        return (None, grad_expert_output, *grad_gates.chunk(ctx.config.top_k))
+
+
+class GatingGatherEncoder(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx: Any, config: Any, reshaped_input: Tensor):
+        ctx.config = config
+        ctx.input_shape = reshaped_input.shape
+        return gather_encode_forward(config, reshaped_input)
+
+    @staticmethod
+    def backward(ctx: Any, dispatched_input: Tensor):
+        grad_data = allocate(ctx.config.workspace, 'grad_input', ctx.input_shape, dispatched_input.dtype, dispatched_input.device, zero=True)
+        grad_data.index_add_(0, ctx.config.token_ids, dispatched_input.index_select(0, ctx.config.slot_ids))
+        return (None, grad_data)
+
+
+class GatingGatherDecoder(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx: Any, config: Any, expert_output: Tensor, *gates_: Tensor):
+        ctx.config = config
+        ctx.gates = torch.cat(gates_).index_select(0, config.assign_ids)
+        ctx.expert_output = expert_output
+        return gather_decode_forward(config, expert_output, ctx.gates)
+
+    @staticmethod
+    def backward(ctx: Any, combined_output: Tensor):
+        config = ctx.config
+        slot_gates = torch.zeros([ctx.expert_output.size(0)], dtype=ctx.gates.dtype, device=ctx.gates.device).index_copy_(0, config.slot_ids, ctx.gates)
+        grad_expert_output = allocate(config.workspace, 'grad_expert', ctx.expert_output.shape, combined_output.dtype, combined_output.device)
+        torch.index_select(combined_output, 0, config.slot_sources, out=grad_expert_output).mul_(slot_gates.unsqueeze(-1))
 
-        grad_gates = []
-        for i in range(len(ctx.config.indices_)):
-          grad_gates1_s = torch.empty([ctx.config.expected_sample_size,], dtype=combined_output.dtype, device=combined_output.device)
-          ctx.config.func_bwd_gate(ctx.expert_output, ctx.config.indices_[i], ctx.config.locations_[i], combined_output, grad_gates1_s)
-          grad_gates.append(grad_gates1_s)
-        return (None, grad_expert_output, *grad_gates)
+        grad_assigned_gates = (ctx.expert_output.index_select(0, config.slot_ids) * combined_output.index_select(0, config.token_ids)).sum(dim=1)
+        grad_gates = allocate(config.workspace, 'grad_gates', [len(config.indices_) * config.expected_sample_size], combined_output.dtype, combined_output.device, zero=True)
+        grad_gates.index_copy_(0, config.assign_ids, grad_assigned_gates)
+        return (None, grad_expert_output, *grad_gates.chunk(len(config.indices_)))
 
 
 class TutelMoeFastDispatcher:
 
-    def __init__(self, num_global_experts, capacity, model_dim, dispatch_dtype):
+    def __init__(self, num_global_experts, capacity, model_dim, dispatch_dtype, device=None, index_gather=False, workspace=None):
         self.expected_sample_size = -1
+        self.workspace = workspace
+        self.index_gather = index_gather
         self.num_global_experts = num_global_experts
         self.capacity = capacity
         self.model_dim = model_dim
         self.kernel_pool = dict()
         self.dtype = dispatch_dtype
-        if IS_HIP_EXTENSION or dispatch_dtype != torch.float16:
+        self.is_cuda = device is None or torch.device(device).type == 'cuda'
+        # Index-gather dispatch runs on plain tensor ops, which accept any dtype
+        if not index_gather and (IS_HIP_EXTENSION or dispatch_dtype != torch.float16 or not self.is_cuda):
             self.dtype = torch.float32
         self.original_dtype = dispatch_dtype
         self.aligned_dim = model_dim // (2 if self.dtype == torch.float16 else 1)
 
     def update(self, indices_, locations_, gates_, capacity=None):
         self.indices_ = [x.to(torch.int32).view(-1) for x in indices_]
-        self.locations_ = [x.to(torch.int32) for x in locations_]
+        self.locations_ = [x.to(torch.int32).view(-1) for x in locations_]
         self.gates_ = [x.to(self.dtype) for x in gates_]
         sample_size = self.indices_[0].size(0)
         capacity = capacity or self.capacity
 
-        if sample_size != self.expected_sample_size or capacity != self.capacity:
+        if self.index_gather:
             self.expected_sample_size, self.capacity = sample_size, capacity
-            if tuple((sample_size, capacity)) not in self.kernel_pool:
-                self.func_fwd = jit_kernel.create_forward(sample_size, self.num_global_experts, self.capacity, self.aligned_dim, self.dtype)
-                self.func_bwd_data = jit_kernel.create_backward_data(sample_size, self.num_global_experts, self.capacity, self.aligned_dim, self.dtype)
-                self.func_bwd_gate = jit_kernel.create_backward_gate(sample_size, self.num_global_experts, self.capacity, self.aligned_dim, self.dtype)
-                self.ones_helper = torch.ones([sample_size, 2], dtype=self.dtype, device=self.indices_[0].device)
-                self.kernel_pool[tuple((sample_size, capacity))] = self.func_fwd, self.func_bwd_data, self.func_bwd_gate, self.ones_helper
+            return self.update_gather_indices()
+
+        # All k assignments are flattened into one list, so that each kernel handles them in a single launch
+        self.top_k = len(self.indices_)
+        self.indices_flat = torch.cat(self.indices_) if self.top_k > 1 else self.indices_[0]
+        self.locations_flat = torch.cat(self.locations_) if self.top_k > 1 else self.locations_[0]
+
+        kernel_key = tuple((sample_size, capacity, self.top_k))
+        if kernel_key != getattr(self, 'kernel_key', None):
+            self.expected_sample_size, self.capacity, self.kernel_key = sample_size, capacity, kernel_key
+            if kernel_key not in self.kernel_pool:
+                self.func_fwd = jit_kernel.create_forward(sample_size, self.num_global_experts, self.capacity, self.aligned_dim, self.dtype, top_k=self.top_k, is_cuda=self.is_cuda)
+                self.func_bwd_data = jit_kernel.create_backward_data(sample_size, self.num_global_experts, self.capacity, self.aligned_dim, self.dtype, top_k=self.top_k, is_cuda=self.is_cuda)
+                self.func_bwd_gate = jit_kernel.create_backward_gate(sample_size, self.num_global_experts, self.capacity, self.aligned_dim, self.dtype, top_k=self.top_k, is_cuda=self.is_cuda)
+                self.ones_helper = torch.ones([self.top_k * sample_size, 2], dtype=self.dtype, device=self.indices_[0].device)
+                self.kernel_pool[kernel_key] = self.func_fwd, self.func_bwd_data, self.func_bwd_gate, self.ones_helper
             else:
-                self.func_fwd, self.func_bwd_data, self.func_bwd_gate, self.ones_helper = self.kernel_pool[tuple((sample_size, capacity))]
+                self.func_fwd, self.func_bwd_data, self.func_bwd_gate, self.ones_helper = self.kernel_pool[kernel_key]
+
+    def update_gather_indices(self):
+        """Compact (token, slot) assignment lists, valid when each expert slot is taken by at most one token"""
+        indices, locations = torch.stack(self.indices_).long(), torch.stack(self.locations_).long()
+        self.assign_ids = ((locations < self.capacity) & (indices >= 0)).view(-1).nonzero().view(-1)
+        self.token_ids = self.assign_ids % self.expected_sample_size
+        self.slot_ids = (indices * self.capacity + locations).view(-1).index_select(0, self.assign_ids)
+
+        slot_sources = torch.full([self.num_global_experts * self.capacity], -1, dtype=torch.int64, device=indices.device).index_copy_(0, self.slot_ids, self.token_ids)
+        self.empty_slots = (slot_sources < 0).nonzero().view(-1)
+        self.slot_sources = slot_sources.clamp(min=0)
 
     def encode(self, data):
+        # Without autograd, kernels are called directly, so that no autograd context keeps tensors alive for backward
+        if not torch.is_grad_enabled():
+            encode_fn = gather_encode_forward if self.index_gather else encode_forward
+            return encode_fn(self, data.to(self.dtype)).to(self.original_dtype)
+        if self.index_gather:
+            return GatingGatherEncoder.apply(self, data.to(self.dtype)).to(self.original_dtype)
         return GatingEncoder.apply(self, data.to(self.dtype)).to(self.original_dtype)
 
     def decode(self, data):
+        if not torch.is_grad_enabled():
+            if self.index_gather:
+                return gather_decode_forward(self, data.to(self.dtype), torch.cat(self.gates_).index_select(0, self.assign_ids)).to(self.original_dtype)
+            return decode_forward(self, data.to(self.dtype), get_kernel_gates(self.gates_)).to(self.original_dtype)
+        if self.index_gather:
+            return GatingGatherDecoder.apply(self, data.to(self.dtype), *self.gates_).to(self.original_dtype)
         return GatingDecoder.apply(self, data.to(self.dtype), *self.gates_).to(self.original_dtype)
 
 fast_dispatcher = TutelMoeFastDispatcher
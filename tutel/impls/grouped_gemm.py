@@ -0,0 +1,41 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import torch
+
+
+# `torch._grouped_mm` is a private API of recent torch builds, so that every use falls back to per-expert GEMMs without it
+has_grouped_mm = hasattr(torch, '_grouped_mm')
+
+# (device type, dtype) whose grouped GEMM is not supported by this torch build, e.g. fp32 on some CUDA architectures
+grouped_mm_unsupported = set()
+
+
+class ContiguousGrad(torch.autograd.Function):
+    """Identity passing a contiguous gradient backward, e.g. instead of an expanded gradient of sum()"""
+    @staticmethod
+    def forward(ctx, input):
+        return input.view_as(input)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        return grad_output.contiguous()
+
+
+def is_grouped_mm_applicable(x, weight):
+    if not has_grouped_mm or (x.device.type, x.dtype) in grouped_mm_unsupported or x.size(0) == 0:
+        return False
+    # Grouped GEMM requires 16-byte aligned row strides of both operands
+    return (x.size(1) * x.element_size()) % 16 == 0 and (weight.size(-1) * weight.element_size()) % 16 == 0
+
+
+def grouped_matmul(x, weight, counts):
+    """x: [N, K] rows grouped by expert with `counts` rows each, weight: [E, K, V] => [N, V] as one grouped GEMM if available"""
+    if is_grouped_mm_applicable(x, weight):
+        offsets = torch.tensor(counts, dtype=torch.int32).cumsum(0, dtype=torch.int32).to(x.device, non_blocking=True)
+        try:
+            # Backward of grouped GEMM rejects broadcast gradients
+            return ContiguousGrad.apply(torch._grouped_mm(x.contiguous(), weight.contiguous(), offs=offsets))
+        except RuntimeError:
+            grouped_mm_unsupported.add((x.device.type, x.dtype))
+    return torch.cat([torch.mm(chunk, w) for chunk, w in zip(x.split(counts), weight.unbind(0))])
@@ -4,12 +4,10 @@
 import torch
 import os, tempfile
 
-assert torch.cuda.is_available() == True, "This version of Tutel MoE only supports CUDA. More backends will be supported soon."
-
 try:
     import tutel_custom_kernel
 except:
-    raise Exception("Cannot import JIT optimized kernels. Did you forget to install Custom Kernel Extension?")
+    tutel_custom_kernel = None
 
 try:
     from torch.utils.cpp_extension import IS_HIP_EXTENSION
@@ -19,6 +17,10 @@ except:
 class JitCompiler:
     @staticmethod
     def create_raw(source):
+        if tutel_custom_kernel is None:
+            raise Exception("Cannot import JIT optimized kernels. Did you forget to install Custom Kernel Extension?")
+        assert torch.cuda.is_available() == True, "JIT optimized kernels require CUDA/ROCm devices, please use CPU tensors to run on CPU backend."
+
         if not hasattr(JitCompiler, '__CTX__'):
             torch.cuda.init()
             JitCompiler.__CTX__ = 0
@@ -46,3 +48,12 @@ class JitCompiler:
       for key in keyword_dict:
         template = template.replace('@%s@' % key, str(keyword_dict[key]))
       return JitCompiler.create_raw(template)
+
+    @staticmethod
+    def generate_cpu_kernel(keyword_dict, template_fn):
+      # CPU backend: instead of compiling the CUDA template, bind the same keyword
+      # values to an equivalent vectorized torch implementation.
+      def func(*inputs):
+        with torch.no_grad():
+          template_fn(*inputs, **keyword_dict)
+      return func
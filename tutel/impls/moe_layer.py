@@ -15,10 +15,18 @@ from torch import Tensor
 import torch.distributed as dist
 from torch.nn import ModuleList
 import torch.nn.functional as F
+import torch.utils.checkpoint
 
 from ..impls.fast_dispatch import fast_dispatcher
-from ..jit_kernels.gating import fast_cumsum_sub_one
-from ..impls.communicate import AllToAll, PreAllreduceSum, PostAllreduceSum, get_world_size, get_world_rank
+from ..impls.workspace import BufferArena, allocate
+from ..impls.offload import ExpertWeightOffloader
+from ..impls.checkpoint import save_sharded_checkpoint, load_sharded_checkpoint
+from ..impls.telemetry import RoutingTelemetry
+from ..impls.profiler import PhaseProfiler
+from ..impls.grouped_gemm import grouped_matmul
+from ..jit_kernels.gating import fast_topk_locations
+from ..jit_kernels.activation import bias_activation_dropout, supported_activations
+from ..impls.communicate import AllToAll, AllToAllV, AllToAllAsync, AllToAllWait, AllToAllStatus, PreAllreduceSum, PostAllreduceSum, exchange_counts, get_world_size, get_world_rank
 
 
 def one_hot_with_dtype(data, num_classes, dtype):
@@ -37,8 +45,303 @@ def load_balance(gates, mask1, num_global_experts, fp32_gate):
         l_loss = torch.sum(me * ce) * num_global_experts
     return l_loss
 
+def load_balance_from_indices(gates, indices1_s, num_global_experts, fp32_gate):
+    """Same as `load_balance` with the one-hot mask of top-1 expert indices, while counting experts without building the mask"""
+    expert_counts = torch.bincount(indices1_s.view(-1).long(), minlength=num_global_experts)
+    if gates.dtype == torch.float32 or fp32_gate:
+        me = torch.sum(gates.float(), dim=0)
+        ce = expert_counts.to(me.dtype)
+        l_loss = torch.sum(me * ce) * (num_global_experts / (gates.size(0) * gates.size(0)))
+    else:
+        me = torch.mean(gates, dim=0)
+        ce = (expert_counts.float() / gates.size(0)).to(gates.dtype)
+        l_loss = torch.sum(me * ce) * num_global_experts
+    return l_loss
+
+
+class BaseGate(torch.nn.Module):
+    """Base of MoE gates dispatching tokens through fast dispatcher and all_to_all
+    """
+
+    def __init__(
+        self,
+        num_global_experts,
+        capacity_factor=1.0,
+        top_k=1,
+        **kwargs,
+    ):
+        super().__init__()
+        top_k = min(top_k, num_global_experts)
+        self.top_k = top_k
+        assert self.top_k > 0, "Top-k value %d is not valid." % self.top_k
+
+        self.capacity_factor = float(os.environ.get('CAP_FACTOR', capacity_factor))
+        self.is_ones_gate = (int(os.environ.get('ONES_GATE', 0)) == 1)
+        self.num_global_experts = num_global_experts
+
+        self.dropless = kwargs.get('dropless', False)
+        self.index_gather = kwargs.get('index_gather', False)
+        self.workspace = None
+        self.telemetry = None
+        self.profiler = None
+        self.fast_inference = False
+
+        self._overlap_timings = dict()
+        self._auto_overlap_degree = None
+        self._warnings = set()
+
+        # Adaptive capacity picks capacity factors from a few bucketed values only, so that dispatch kernels stay bounded
+        adaptive_capacity = kwargs.get('adaptive_capacity', None)
+        self._capacity_candidates = None
+        if adaptive_capacity:
+            adaptive_capacity = dict() if adaptive_capacity is True else adaptive_capacity
+            assert not self.dropless, "Gate option `adaptive_capacity` doesn't apply to dropless routing."
+            factors = sorted(adaptive_capacity.get('factors', (0.5, 0.75, 1.0, 1.25, 1.5, 2.0, 3.0, 4.0)))
+            min_factor, max_factor = adaptive_capacity.get('min_factor', factors[0]), adaptive_capacity.get('max_factor', factors[-1])
+            self._capacity_candidates = [x for x in factors if min_factor <= x <= max_factor]
+            assert self._capacity_candidates, "No capacity factor of %s is within [%s, %s]." % (factors, min_factor, max_factor)
+            self._target_drop_rate = adaptive_capacity.get('target_drop_rate', 0.01)
+            self._capacity_interval = adaptive_capacity.get('interval', 10)
+            self._capacity_stats, self._capacity_steps, self._candidate_capacities = None, 0, dict()
+            self.capacity_factor = next((x for x in self._capacity_candidates if x >= self.capacity_factor), self._capacity_candidates[-1])
+
+    def warn_once(self, group, message):
+        if message not in self._warnings:
+            self._warnings.add(message)
+            if get_world_rank(group) == 0:
+                logging.warning(message)
+
+    def profile_begin(self, phase, tensor):
+        if self.profiler is None:
+            return tensor, None
+        return self.profiler.begin(phase, tensor)
+
+    def profile_end(self, span, tensor):
+        return tensor if span is None else self.profiler.end(span, tensor)
+
+    def get_overlap_degree(self, a2a_ffn_overlap_degree, capacity, group, device):
+        if a2a_ffn_overlap_degree != 'auto':
+            return max(min(int(a2a_ffn_overlap_degree), capacity), 1), False
+        if self._auto_overlap_degree is not None:
+            return self._auto_overlap_degree, False
+        # Auto mode: one untimed warm-up step, then time one step per candidate and pick the fastest across all ranks
+        candidates = [x for x in (1, 2, 4, 8) if x <= capacity]
+        if not self._overlap_timings:
+            self._overlap_timings[None] = None
+            return 1, False
+        untried = [x for x in candidates if x not in self._overlap_timings]
+        if untried:
+            return untried[0], True
+        timings = torch.tensor([self._overlap_timings[x] for x in candidates], dtype=torch.float64, device=device)
+        if get_world_size(group) > 1:
+            dist.all_reduce(timings, group=group)
+        self._auto_overlap_degree = candidates[int(timings.argmin())]
+        if get_world_rank(group) == 0:
+            logging.info('Auto a2a_ffn_overlap_degree selects %d from step timings: %s' % (self._auto_overlap_degree, dict(zip(candidates, timings.tolist()))))
+        return self._auto_overlap_degree, False
+
+    def pipelined_expert_fn(self, dispatched_input, expert_fn, group, capacity, overlap_degree, dtype):
+        """Split along capacity, so that all_to_all of one chunk overlaps with expert computation of another"""
+        world_size, M = get_world_size(group), dispatched_input.size(-1)
+        chunks = dispatched_input.view(-1, capacity, M).chunk(overlap_degree, dim=1)
+        statuses = [AllToAllStatus() for _ in chunks]
+        chunks = [AllToAllAsync.apply(group, status, x) for status, x in zip(statuses, chunks)]
+
+        outputs = []
+        for status, x in zip(statuses, chunks):
+            x = AllToAllWait.apply(group, status, x)
+            y = expert_fn(x.view(world_size, -1, x.size(1), M)).to(dtype)
+            status = AllToAllStatus()
+            outputs.append((status, AllToAllAsync.apply(group, status, y.reshape(-1, x.size(1), M))))
+        return torch.cat([AllToAllWait.apply(group, status, y) for status, y in outputs], dim=1)
+
+    def occupied_expert_fn(self, dispatched_input, expert_fn, occupied_counts):
+        """Run experts over the occupied prefix of each capacity buffer only, as a grouped GEMM over exact row counts"""
+        W, E, C, M = dispatched_input.shape
+        occupied_counts = occupied_counts.view(W, E, 1)
+        # Rows ordered by (local expert, source rank, slot), leaving empty slots zero in the expert output
+        occupied = torch.arange(C, device=occupied_counts.device) < occupied_counts
+        slot_ids = torch.arange(W * E * C, device=occupied_counts.device).view(W, E, C).permute(1, 0, 2)[occupied.permute(1, 0, 2)]
+        expert_output = expert_fn(dispatched_input.reshape(-1, M).index_select(0, slot_ids), occupied_counts.view(W, E).sum(dim=0).tolist())
+        return torch.zeros([W * E * C, M], dtype=expert_output.dtype, device=expert_output.device).index_copy(0, slot_ids, expert_output).view(W, E, C, M)
+
+    def adapt_capacity_factor(self, topk_indices, sample_size, group):
+        """Switches to the smallest candidate capacity factor whose drop rate over recent steps stays under the target"""
+        if self._capacity_steps >= self._capacity_interval:
+            stats = self._capacity_stats
+            if get_world_size(group) > 1:
+                dist.all_reduce(stats, group=group)
+            stats = stats.tolist()
+            capacity_factor = next((x for x, dropped in zip(self._capacity_candidates, stats[:-1]) if dropped <= self._target_drop_rate * stats[-1]), self._capacity_candidates[-1])
+            if capacity_factor != self.capacity_factor and get_world_rank(group) == 0:
+                logging.info('Adaptive capacity switches capacity_factor from %s to %s with drop rates: %s' % (self.capacity_factor, capacity_factor, dict(zip(self._capacity_candidates, [x / max(stats[-1], 1) for x in stats[:-1]]))))
+            self.capacity_factor, self._capacity_stats, self._capacity_steps = capacity_factor, None, 0
+
+        # Per-expert loads are independent of capacity, so that drops of every candidate capacity are counted exactly
+        if sample_size not in self._candidate_capacities:
+            self._candidate_capacities[sample_size] = torch.tensor([self.top_k * int(x * ((sample_size + self.num_global_experts - 1) // self.num_global_experts)) for x in self._capacity_candidates], device=topk_indices.device)
+        if self._capacity_stats is None:
+            self._capacity_stats = torch.zeros([len(self._capacity_candidates) + 1], dtype=torch.float64, device=topk_indices.device)
+        expert_counts = torch.bincount(topk_indices.view(-1), minlength=self.num_global_experts)
+        self._capacity_stats[:-1] += (expert_counts.unsqueeze(1) - self._candidate_capacities[sample_size]).clamp(min=0).sum(dim=0)
+        self._capacity_stats[-1] += topk_indices.numel()
+        self._capacity_steps += 1
+
+    def get_capacity(self, sample_size):
+        # Capacity follows the sample size, so that each sample bucket owns its kernels in `_fdr.kernel_pool`
+        return self.top_k * int(self.capacity_factor * ((sample_size + self.num_global_experts - 1) // self.num_global_experts))
+
+    def apply_topk_routing(self, input, topk_indices, gates_s, expert_fn, group, sharded_count, importance_scores=None, a2a_ffn_overlap_degree=1, use_2dh=None, a2a_compress=None):
+        indices_s = list(topk_indices.t().contiguous().unbind(0))
+        if self.dropless:
+            if use_2dh or a2a_compress is not None:
+                self.warn_once(group, 'Dropless routing exchanges variable-size messages by flat AllToAllV, ignoring `use_2dh` and `a2a_compress`.')
+            if self.is_ones_gate:
+                gates_s = [torch.ones_like(x) for x in gates_s]
+            return self.apply_dropless_on_expert_fn(input, indices_s, gates_s, expert_fn, group, sharded_count)
+
+        _, span = self.profile_begin('locations', topk_indices)
+        locations_s = list(fast_topk_locations(topk_indices, self.num_global_experts, importance_scores)[0].unbind(0))
+        if self._capacity_candidates is not None:
+            self.adapt_capacity_factor(topk_indices, input.size(0), group)
+        capacity = self.get_capacity(input.size(0))
+        self.profile_end(span, locations_s[0])
+        return self.dispatch_on_expert_fn(input, indices_s, locations_s, gates_s, capacity, expert_fn, group, sharded_count, a2a_ffn_overlap_degree, use_2dh, a2a_compress)
+
+    def dispatch_on_expert_fn(self, input, indices_s, locations_s, gates_s, capacity, expert_fn, group, sharded_count, a2a_ffn_overlap_degree=1, use_2dh=None, a2a_compress=None):
+        indices_s = [x.to(torch.int32) for x in indices_s]
+
+        S, M, GE = input.size(0), input.size(1), self.num_global_experts
+        world_size = get_world_size(group)
+        if self.telemetry is not None:
+            self.telemetry.record_routing(indices_s, locations_s, capacity)
+
+        if not hasattr(self, '_fdr'):
+            self._fdr = fast_dispatcher(num_global_experts=GE, capacity=capacity, model_dim=M, dispatch_dtype=input.dtype, device=input.device, index_gather=self.index_gather, workspace=self.workspace)
+
+        input, span = self.profile_begin('encode', input)
+        if self.is_ones_gate:
+            gates_s = [torch.ones_like(x) for x in gates_s]
+        self._fdr.update(indices_s, locations_s, gates_s, capacity=capacity)
+
+        dispatched_input = self._fdr.encode(input)
+        dispatched_input = dispatched_input.repeat(sharded_count, 1)
+        dispatched_input = self.profile_end(span, dispatched_input)
+
+        overlap_degree, is_tuning = self.get_overlap_degree(a2a_ffn_overlap_degree, capacity, group, input.device)
+        if is_tuning:
+            if input.is_cuda:
+                torch.cuda.synchronize(input.device)
+            t_start = time.time()
+
+        if overlap_degree > 1 and world_size > 1 and (use_2dh or a2a_compress is not None):
+            self.warn_once(group, 'Pipelined all_to_all (a2a_ffn_overlap_degree > 1) only runs flat and uncompressed messages, so it is disabled by `use_2dh` or `a2a_compress`.')
+        if overlap_degree > 1 and world_size > 1 and AllToAll.a2a_type == 1 and not use_2dh and a2a_compress is None:
+            dispatched_input, span = self.profile_begin('a2a_expert_pipeline', dispatched_input)
+            expert_output = self.pipelined_expert_fn(dispatched_input, expert_fn, group, capacity, overlap_degree, input.dtype)
+            expert_output = self.profile_end(span, expert_output)
+        else:
+            dispatched_input, span = self.profile_begin('a2a_dispatch', dispatched_input)
+            dispatched_input = AllToAll.apply(group, dispatched_input, use_2dh, a2a_compress, self.workspace)
+            dispatched_input = dispatched_input.reshape(world_size, -1, capacity, M)
+            dispatched_input = self.profile_end(span, dispatched_input)
+            dispatched_input, span = self.profile_begin('expert', dispatched_input)
+
+            if getattr(expert_fn, 'skips_empty_slots', False):
+                # Occupied prefix length of each expert's capacity is the max assigned location + 1
+                indices, locations = torch.cat(indices_s).long(), torch.cat(locations_s).long()
+                valid = (locations < capacity) & (indices >= 0)
+                occupied_counts = torch.zeros([GE], dtype=torch.int64, device=input.device).scatter_reduce(0, indices[valid], locations[valid] + 1, reduce='amax')
+                occupied_counts = exchange_counts(group, occupied_counts.repeat(sharded_count))
+                expert_output = self.occupied_expert_fn(dispatched_input, expert_fn, occupied_counts)
+            else:
+                expert_output = expert_fn(dispatched_input)
+            expert_output = expert_output.to(input.dtype)
+            expert_output = self.profile_end(span, expert_output)
+
+            expert_output, span = self.profile_begin('a2a_combine', expert_output)
+            expert_output = AllToAll.apply(group, expert_output, use_2dh, a2a_compress, self.workspace)
+            expert_output = self.profile_end(span, expert_output)
+
+        if is_tuning:
+            if input.is_cuda:
+                torch.cuda.synchronize(input.device)
+            self._overlap_timings[overlap_degree] = time.time() - t_start
+
+        expert_output, span = self.profile_begin('decode', expert_output)
+        expert_output = expert_output.reshape(-1, GE, capacity, M)
+        expert_output = torch.sum(expert_output, dim=0)
+
+        result_output = self._fdr.decode(expert_output.view(GE * self._fdr.capacity, M))
+        return self.profile_end(span, result_output)
+
+
+    def apply_dropless_on_expert_fn(self, input, indices_s, gates_s, expert_fn, group, sharded_count):
+        """Capacity-free dispatch: only real token assignments are exchanged via variable-size all_to_all"""
+        S, M, GE = input.size(0), input.size(1), self.num_global_experts
+        world_size = get_world_size(group)
+        num_local_experts = GE * sharded_count // world_size
+        if self.telemetry is not None:
+            self.telemetry.record_routing(indices_s)
+
+        # Group all (token, k) assignments by their global expert
+        input, span = self.profile_begin('encode', input)
+        expert_ids, order = torch.sort(torch.cat(indices_s).long())
+        token_ids = torch.arange(S, device=input.device).repeat(self.top_k)[order]
+        gates = torch.cat(gates_s)[order]
+        expert_counts = torch.bincount(expert_ids, minlength=GE)
+
+        send_input = input.index_select(0, token_ids)
+        send_counts = expert_counts
+        if sharded_count > 1:
+            send_input, send_counts = send_input.repeat(sharded_count, 1), send_counts.repeat(sharded_count)
+        recv_counts = exchange_counts(group, send_counts).view(world_size, num_local_experts)
+        send_splits = send_counts.view(world_size, num_local_experts).sum(dim=1).tolist()
+        recv_splits = recv_counts.sum(dim=1).tolist()
+        send_input = self.profile_end(span, send_input)
+
+        send_input, span = self.profile_begin('a2a_dispatch', send_input)
+        dispatched_input = AllToAllV.apply(group, send_input, send_splits, recv_splits)
+        dispatched_input = self.profile_end(span, dispatched_input)
+        dispatched_input, span = self.profile_begin('expert', dispatched_input)
+
+        # Received rows are ordered by (source rank, local expert): pack them into [1, local_experts, capacity, M]
+        # where capacity is the exact max token count of local experts in this step
+        expert_tokens = recv_counts.sum(dim=0)
+        capacity = max(int(expert_tokens.max()), 1)
+        segment_counts = recv_counts.view(-1)
+        segment_ids = torch.repeat_interleave(torch.arange(segment_counts.numel(), device=input.device), segment_counts)
+        segment_starts = torch.cumsum(segment_counts, dim=0) - segment_counts
+        expert_starts = (torch.cumsum(recv_counts, dim=0) - recv_counts).view(-1)
+        local_ids = segment_ids % num_local_experts
+        slots = local_ids * capacity + expert_starts[segment_ids] + torch.arange(segment_ids.numel(), device=input.device) - segment_starts[segment_ids]
+
+        if getattr(expert_fn, 'accepts_expert_counts', False):
+            # Reorder rows by (local expert, source rank) for grouped GEMM over exact token counts without padding
+            expert_rows = torch.sort(local_ids, stable=True).indices
+            expert_output = expert_fn(dispatched_input.index_select(0, expert_rows), expert_tokens.tolist())
+            expert_output = torch.empty_like(expert_output).index_copy(0, expert_rows, expert_output).to(input.dtype)
+        else:
+            expert_input = torch.zeros([num_local_experts * capacity, M], dtype=dispatched_input.dtype, device=dispatched_input.device)
+            expert_input = expert_input.index_copy(0, slots, dispatched_input)
+            expert_output = expert_fn(expert_input.view(1, num_local_experts, capacity, M))
+            expert_output = expert_output.to(input.dtype).view(-1, M).index_select(0, slots)
+        expert_output = self.profile_end(span, expert_output)
+
+        expert_output, span = self.profile_begin('a2a_combine', expert_output)
+        expert_output = AllToAllV.apply(group, expert_output, recv_splits, send_splits)
+        expert_output = self.profile_end(span, expert_output)
+
+        expert_output, span = self.profile_begin('decode', expert_output)
+        if sharded_count > 1:
+            expert_output = expert_output.view(sharded_count, -1, M).sum(dim=0)
+
+        result_output = torch.zeros([S, M], dtype=input.dtype, device=input.device)
+        result_output = result_output.index_add(0, token_ids, expert_output * gates.unsqueeze(-1).to(input.dtype))
+        return self.profile_end(span, result_output)
+
 
-class TopKGate(torch.nn.Module):
+class TopKGate(BaseGate):
     """General-purpose Top-K Gate for MoE
     """
  
@@ -51,10 +354,7 @@ class TopKGate(torch.nn.Module):
         batch_prioritized_routing=False,
         **kwargs,
     ):
-        super().__init__()
-        top_k = min(top_k, num_global_experts)
-        self.top_k = top_k
-        assert self.top_k > 0, "Top-k value %d is not valid." % self.top_k
+        super().__init__(num_global_experts=num_global_experts, capacity_factor=capacity_factor, top_k=top_k, **kwargs)
 
         self.wg = torch.nn.Linear(model_dim, num_global_experts, bias=False)
 
@@ -62,90 +362,180 @@ class TopKGate(torch.nn.Module):
         if self.fp32_gate:
           self.wg = self.wg.float()
 
-        self.capacity_factor = float(os.environ.get('CAP_FACTOR', capacity_factor))
-        self.is_ones_gate = (int(os.environ.get('ONES_GATE', 0)) == 1)
-        self.num_global_experts = num_global_experts
-
         self.batch_prioritized_routing = batch_prioritized_routing
         if int(os.environ.get('BATCH_PRIO', 0)) != 0:
             self.batch_prioritized_routing = True
 
         input_dropout_p = kwargs.get('input_dropout_p', 0)
         self.input_dropout = torch.nn.Dropout(p=input_dropout_p) if input_dropout_p else None
+        self.l_zero = None
 
-    def compute_sorted_location(self, x, importance_scores):
-        sorted_x = x[importance_scores.argsort(dim=0)]
-        sorted_cumsum = fast_cumsum_sub_one(sorted_x) * sorted_x
-        return sorted_cumsum[importance_scores.argsort(dim=0).argsort(dim=0)]
+    def apply_inference_on_expert_fn(self, input, expert_fn, group, sharded_count, a2a_ffn_overlap_degree=1, use_2dh=None, a2a_compress=None):
+        _, span = self.profile_begin('gate', input)
+        logits = self.wg(input.to(next(iter(self.wg.parameters())).dtype))
+
+        # Normalized top-k gates only depend on top-k logits, so that softmax runs on [samples, k] instead of [samples, experts]
+        top_logits, topk_indices = torch.topk(logits, self.top_k, dim=1)
+        if self.top_k > 1:
+            gates = F.softmax(top_logits, dim=1)
+        else:
+            gates = torch.exp(top_logits - torch.logsumexp(logits, dim=1, keepdim=True))
+        gates = self.profile_end(span, gates)
+        if self.telemetry is not None:
+            self.telemetry.record_gates(F.softmax(logits, dim=1))
+        gates_s = list(gates.t().unbind(0))
+
+        importance_scores = -1 * torch.exp(top_logits[:, 0] - torch.logsumexp(logits, dim=1)) if self.batch_prioritized_routing else None
+        result_output = self.apply_topk_routing(input, topk_indices, gates_s, expert_fn, group, sharded_count, importance_scores, a2a_ffn_overlap_degree, use_2dh, a2a_compress)
+        if self.l_zero is None or self.l_zero.device != input.device:
+            self.l_zero = torch.zeros([], dtype=input.dtype, device=input.device)
+        return result_output, self.l_zero
+
+    def apply_on_expert_fn(self, input, expert_fn, group, sharded_count, a2a_ffn_overlap_degree=1, use_2dh=None, a2a_compress=None, **kwargs):
+        if self.fast_inference and not torch.is_grad_enabled():
+            return self.apply_inference_on_expert_fn(input, expert_fn, group, sharded_count, a2a_ffn_overlap_degree, use_2dh, a2a_compress)
 
-    def apply_on_expert_fn(self, input, expert_fn, group, sharded_count):
         if self.input_dropout:
             input = self.input_dropout(input)
 
-        logits = self.wg(input.to(next(iter(self.wg.parameters())).dtype))
+        topk_indices, gates_s, l_loss, importance_scores = self.compute_gates(input)
+        result_output = self.apply_topk_routing(input, topk_indices, gates_s, expert_fn, group, sharded_count, importance_scores, a2a_ffn_overlap_degree, use_2dh, a2a_compress)
+        return result_output, l_loss
 
-        topk_indices = torch.topk(logits, self.top_k, dim=1).indices
+    def compute_gates(self, input):
+        """Top-k expert indices, normalized top-k gates, load balance loss and importance scores (if BPR) of tokens"""
+        gate_input, span = self.profile_begin('gate', input)
+        logits = self.wg(gate_input.to(next(iter(self.wg.parameters())).dtype))
 
-        indices_s = [x.view(-1) for x in topk_indices.chunk(self.top_k, dim=1)]
-        masks_se = [one_hot_with_dtype(x, num_classes=self.num_global_experts, dtype=x.dtype) for x in indices_s]
+        topk_indices = torch.topk(logits, self.top_k, dim=1).indices
 
         gates = F.softmax(logits, dim=1)
-        gates_s = [(gates * x).sum(dim=1) for x in masks_se]
+        gates = self.profile_end(span, gates)
+        if self.telemetry is not None:
+            self.telemetry.record_gates(gates)
+        gates_s = list(gates.gather(1, topk_indices).t().unbind(0))
 
-        l_loss = load_balance(gates, masks_se[0], self.num_global_experts, self.fp32_gate)
+        l_loss = load_balance_from_indices(gates, topk_indices[:, 0], self.num_global_experts, self.fp32_gate)
 
-        if self.batch_prioritized_routing:
-            importance_scores = -1 * gates.max(dim=1)[0]
-            self.compute_location = lambda x: self.compute_sorted_location(x, importance_scores)
-        else:
-            self.compute_location = fast_cumsum_sub_one
+        if self.top_k > 1:
+          # Normalize Gate
+          denom_s = torch.clamp(sum(gates_s), min=torch.finfo(gates_s[0].dtype).eps)
+          gates_s = [x / denom_s for x in gates_s]
 
-        locations1 = self.compute_location(masks_se[0])
+        importance_scores = -1 * gates.max(dim=1)[0] if self.batch_prioritized_routing else None
+        return topk_indices, gates_s, l_loss, importance_scores
 
-        locations_s = [torch.sum(locations1 * masks_se[0], dim=1).to(torch.int32)]
 
-        if self.top_k > 1:
-          acc_base = None
+class HashGate(BaseGate):
+    """Hash Gate for MoE, routing token ids (or sample positions) to experts by a fixed hash without gating computation
+    """
 
-          for k in range(1, self.top_k):
-            acc_base = torch.sum(masks_se[k - 1], dim=0, keepdim=True) if acc_base is None else acc_base + torch.sum(masks_se[k - 1], dim=0, keepdim=True)
-            locations2 = self.compute_location(masks_se[k])
-            locations2 += acc_base
-            locations_s.append(torch.sum(locations2 * masks_se[k], dim=1).to(torch.int32))
+    def __init__(
+        self,
+        num_global_experts,
+        capacity_factor=1.0,
+        top_k=1,
+        **kwargs,
+    ):
+        super().__init__(num_global_experts=num_global_experts, capacity_factor=capacity_factor, top_k=top_k, **kwargs)
+
+    @staticmethod
+    def mix_hash(x):
+        # MurmurHash3 32-bit finalizer, where 32-bit products are split in 16-bit halves to not overflow int64
+        mul32 = lambda x, c: (x * (c & 0xffff) + (((x * (c >> 16)) & 0xffff) << 16)) & 0xffffffff
+        x = x & 0xffffffff
+        x = mul32(x ^ (x >> 16), 0x85ebca6b)
+        x = mul32(x ^ (x >> 13), 0xc2b2ae35)
+        return x ^ (x >> 16)
+
+    def get_topk_indices(self, input, token_ids):
+        if token_ids is None:
+            token_ids = torch.arange(input.size(0), device=input.device)
+        # Experts are picked by high bits of the mixed hash, since low bits of multiplicative hashes repeat for strided ids,
+        # and the k-th choice takes the k-th next expert to keep choices distinct
+        hashed = (self.mix_hash(token_ids.view(-1, 1).long()) * self.num_global_experts) >> 32
+        return (hashed + torch.arange(self.top_k, device=input.device)) % self.num_global_experts
+
+    def apply_on_expert_fn(self, input, expert_fn, group, sharded_count, a2a_ffn_overlap_degree=1, use_2dh=None, a2a_compress=None, token_ids=None, **kwargs):
+        _, span = self.profile_begin('gate', input)
+        topk_indices = self.profile_end(span, self.get_topk_indices(input, token_ids))
+        gates_s = [torch.full([input.size(0)], 1.0 / self.top_k, dtype=input.dtype, device=input.device)] * self.top_k
+        result_output = self.apply_topk_routing(input, topk_indices, gates_s, expert_fn, group, sharded_count, None, a2a_ffn_overlap_degree, use_2dh, a2a_compress)
+        return result_output, torch.zeros([], dtype=input.dtype, device=input.device)
+
+
+class RandomGate(HashGate):
+    """Random Gate for MoE, routing each token to uniformly random experts from a seeded generator
+    """
 
-          # Normalize Gate
-          denom_s = torch.clamp(sum(gates_s), min=torch.finfo(gates_s[0].dtype).eps)
-          gates_s = [x / denom_s for x in gates_s]
+    def __init__(
+        self,
+        num_global_experts,
+        capacity_factor=1.0,
+        top_k=1,
+        seed=None,
+        **kwargs,
+    ):
+        super().__init__(num_global_experts=num_global_experts, capacity_factor=capacity_factor, top_k=top_k, **kwargs)
+        self.seed = seed
+        self._generator = None
+
+    def get_topk_indices(self, input, token_ids):
+        if self._generator is None or self._generator.device != input.device:
+            self._generator = torch.Generator(device=input.device)
+            if self.seed is not None:
+                self._generator.manual_seed(self.seed)
+            else:
+                self._generator.seed()
+        choices = torch.randint(self.num_global_experts, [input.size(0), 1], generator=self._generator, device=input.device)
+        return (choices + torch.arange(self.top_k, device=input.device)) % self.num_global_experts
 
-        indices_s = [x.to(torch.int32) for x in indices_s]
 
-        S, M, GE = input.size(0), input.size(1), self.num_global_experts
-        world_size = get_world_size(group)
+class ExpertChoiceGate(TopKGate):
+    """Expert-Choice Gate for MoE, where each expert selects its top-capacity tokens
+    """
 
-        if not hasattr(self, '_fdr'):
-            capacity = self.top_k * int(self.capacity_factor * ((S + self.num_global_experts - 1) // self.num_global_experts))
-            self._fdr = fast_dispatcher(num_global_experts=GE, capacity=capacity, model_dim=M, dispatch_dtype=input.dtype)
-        else:
-            capacity = self._fdr.capacity
+    def __init__(
+        self,
+        model_dim,
+        num_global_experts,
+        capacity_factor=1.0,
+        **kwargs,
+    ):
+        kwargs.pop('top_k', None)
+        assert not kwargs.get('adaptive_capacity', None), "Gate option `adaptive_capacity` doesn't apply to expert_choice gate."
+        super().__init__(model_dim=model_dim, num_global_experts=num_global_experts, capacity_factor=capacity_factor, top_k=1, **kwargs)
 
-        if self.is_ones_gate:
-            gates_s = [torch.ones_like(x) for x in gates_s]
-        self._fdr.update(indices_s, locations_s, gates_s, capacity=capacity)
+    def apply_on_expert_fn(self, input, expert_fn, group, sharded_count, a2a_ffn_overlap_degree=1, use_2dh=None, a2a_compress=None, **kwargs):
+        if self.input_dropout:
+            input = self.input_dropout(input)
 
-        dispatched_input = self._fdr.encode(input)
-        dispatched_input = dispatched_input.repeat(sharded_count, 1)
-        dispatched_input = AllToAll.apply(group, dispatched_input)
-        dispatched_input = dispatched_input.reshape(world_size, -1, capacity, M)
+        gate_input, span = self.profile_begin('gate', input)
+        logits = self.wg(gate_input.to(next(iter(self.wg.parameters())).dtype))
+        scores = self.profile_end(span, F.softmax(logits, dim=1))
+        if self.telemetry is not None:
+            self.telemetry.record_gates(scores)
 
-        expert_output = expert_fn(dispatched_input)
-        expert_output = expert_output.to(input.dtype)
+        S, GE = input.size(0), self.num_global_experts
+        capacity = min(max(int(self.capacity_factor * ((S + GE - 1) // GE)), 1), S)
+        expert_gates, expert_tokens = torch.topk(scores.t(), capacity, dim=1)
 
-        expert_output = AllToAll.apply(group, expert_output)
-        expert_output = expert_output.reshape(-1, GE, capacity, M)
-        expert_output = torch.sum(expert_output, dim=0)
+        # A token may be chosen by several experts (or none): its r-th choice goes to the r-th dispatch list,
+        # and unused entries keep index -1 to be skipped by the dispatcher
+        token_ids = expert_tokens.reshape(-1)
+        choice_ranks, token_counts = fast_topk_locations(token_ids.view(-1, 1), S)
+        num_lists = max(int(token_counts.max()), 1)
+        slots = choice_ranks.view(-1).long() * S + token_ids
+        expert_ids = torch.arange(GE, dtype=torch.int32, device=input.device).repeat_interleave(capacity)
+        expert_locations = torch.arange(capacity, dtype=torch.int32, device=input.device).repeat(GE)
 
-        result_output = self._fdr.decode(expert_output.view(GE * self._fdr.capacity, M))
-        return result_output, l_loss
+        indices_s = torch.full([num_lists * S], -1, dtype=torch.int32, device=input.device).scatter(0, slots, expert_ids)
+        locations_s = torch.zeros([num_lists * S], dtype=torch.int32, device=input.device).scatter(0, slots, expert_locations)
+        gates_s = torch.zeros([num_lists * S], dtype=scores.dtype, device=input.device).scatter(0, slots, expert_gates.reshape(-1))
+
+        result_output = self.dispatch_on_expert_fn(input, indices_s.view(num_lists, S).unbind(0), locations_s.view(num_lists, S).unbind(0), gates_s.view(num_lists, S).unbind(0),
+            capacity, expert_fn, group, sharded_count, a2a_ffn_overlap_degree, use_2dh, a2a_compress)
+        return result_output, torch.zeros([], dtype=scores.dtype, device=input.device)
 
 
 class MegatronLMGate():
@@ -161,7 +551,7 @@ class MegatronLMGate():
     def named_parameters(self):
         return []
 
-    def apply_on_expert_fn(self, input, expert_fn, group, sharded_count):
+    def apply_on_expert_fn(self, input, expert_fn, group, sharded_count, **kwargs):
         if self.l_zero is None:
             self.l_zero = torch.tensor(0, dtype=input.dtype, device=input.device)
         assert sharded_count == 1
@@ -175,26 +565,40 @@ class MOELayer(torch.nn.Module):
     """Tutel optimized MOELayer
 
     Args:
-        gate_type        : dict-type gate description, e.g. {'type': 'top', 'k': 2, ..}, or {'type': 'megatron'}
+        gate_type        : dict-type gate description, e.g. {'type': 'top', 'k': 2, ..}, {'type': 'expert_choice', 'capacity_factor': 2.0}, {'type': 'hash', 'k': 1}, or {'type': 'megatron'}
         model_dim        : the number of channels for MOE's input tensor
         experts          : a dict-type config for builtin expert network, or a torch.nn.Module-type custom expert network
         scan_expert_func : allow users to specify a lambda function to iterate each experts param, e.g. `scan_expert_func = lambda name, param: setattr(param, 'expert', True)`
         result_func      : allow users to specify a lambda function to format the MoE output and aux_loss, e.g. `result_func = lambda output: (output, output.l_aux)`
         group            : specify the explicit communication group of all_to_all
         seeds            : a tuple containing a tripple of int to specify manual seed of (shared params, local params, others params after MoE's)
+        sample_buckets   : pad variable-length batches to the nearest bucket instead of the first seen sample size, e.g. `'pow2'` or a list like `[512, 1024, 4096]`,
+                           which costs one all_reduce and host sync per forward step to agree on the bucket over `group`, unless `moe_layer(x, max_sample_size=n)`
+                           passes the largest sample size of all ranks known by the host (e.g. from the data loader)
+        a2a_ffn_overlap_degree : the number of capacity chunks to pipeline all_to_all with expert computation, or `'auto'` to pick it from measured step timings
+        use_2dh          : use hierarchical all_to_all (intra-node, then inter-node over LOCAL_SIZE ranks per node), by default follows `A2A_TYPE`
+        a2a_compress     : compress all_to_all messages in forward and backward, e.g. `'bf16'`, `'fp16'` or `'int8'` (per-token scale)
+        workspace_arena  : reuse dispatch, combine and all_to_all buffers of this layer across steps instead of allocating them per step
+        telemetry_interval : accumulate routing statistics on device and fetch them asynchronously every this many steps (0 to disable)
+        profiler         : time gate, locations, encode, a2a_dispatch, expert, a2a_combine and decode phases in forward and backward without synchronization
+        fast_inference   : when gradients are disabled, call dispatch kernels without autograd, reuse dispatch, combine and padding buffers across calls,
+                           and for top-k gates, skip aux loss (returning zero `l_aux`) and input dropout, and fuse softmax with top-k
     """
 
-    def __init__(self, gate_type, model_dim: int, experts = None, scan_expert_func = None, result_func = None, group: Optional[Any] = None, seeds = None, **kwargs):
+    def __init__(self, gate_type, model_dim: int, experts = None, scan_expert_func = None, result_func = None, group: Optional[Any] = None, seeds = None, sample_buckets = None, a2a_ffn_overlap_degree = 1, use_2dh = None, a2a_compress = None, workspace_arena = False, telemetry_interval = 0, profiler = False, fast_inference = False, **kwargs):
         super().__init__()
         assert model_dim % 2 == 0, "Model_dim (%s) must be even value, while this Model_dim mod 2 > 0." % model_dim
         group = group or dist.group.WORLD
 
         self.group = group
         self.result_func = result_func
+        self.a2a_ffn_overlap_degree = a2a_ffn_overlap_degree
+        self.use_2dh = use_2dh
+        self.a2a_compress = a2a_compress
         self.skip_moe = (int(os.environ.get('SKIP_MOE', '0')) != 0)
 
         if not isinstance(experts, dict):
-            self.num_local_experts = len(self.experts)
+            self.num_local_experts = len(experts)
         else:
             self.num_local_experts = experts.get('count_per_node', 1)
             if not isinstance(self.num_local_experts, int):
@@ -246,8 +650,18 @@ class MOELayer(torch.nn.Module):
                 fused_custom_fn = experts.get('fused_custom_fn')
                 if fused_custom_fn is None:
                     activation_fn = experts.get('activation_fn', lambda x: F.relu(x))
+                # A builtin activation name runs bias, activation and dropout of fc1 as one fused epilogue
+                fused_activation = experts.get('activation_fn') if isinstance(experts.get('activation_fn'), str) else None
+                if fused_activation is not None and fused_activation not in supported_activations:
+                    raise Exception('Fused activation is not recognized: %s. Valid activations include: %s.' % (fused_activation, ', '.join(supported_activations)))
                 implicit_dropout_p = experts.get('implicit_dropout_p', 0)
-                fc1_copies = experts.get('fc1_copies', 1)
+                assert fused_activation is None or 0 <= implicit_dropout_p < 1, "Fused activation requires `implicit_dropout_p` in [0, 1), while receiving %s." % implicit_dropout_p
+                fc1_copies = experts.get('fc1_copies', 2 if fused_activation == 'swiglu' else 1)
+                assert fused_activation != 'swiglu' or fc1_copies == 2, "Fused activation `swiglu` requires `fc1_copies` == 2 in expert attributions."
+                grouped_gemm = experts.get('grouped_gemm', False)
+                checkpoint_ffn = experts.get('checkpoint', False)
+                offload = experts.get('offload')
+                assert offload is None or fused_custom_fn is None, "Expert offload doesn't support `fused_custom_fn` in expert attributions."
 
                 class FusedExpertsNetwork(torch.nn.Module):
                     def __init__(self, model_dim, hidden_size, local_experts):
@@ -283,44 +697,113 @@ class MOELayer(torch.nn.Module):
                         self.register_parameter(name='fc1_bias', param=torch.nn.Parameter(fc1_bias))
                         self.register_parameter(name='fc2_bias', param=torch.nn.Parameter(fc2_bias))
 
+                        # Offloaded fc weights stay on host for inference, and are streamed to the device of inputs on each forward
+                        self.offloader = ExpertWeightOffloader(offload, experts.get('offload_path'), get_world_rank(group)) if offload is not None else None
+                        if self.offloader is not None:
+                            for name in ('fc1_weight', 'fc2_weight'):
+                                self._parameters[name] = torch.nn.Parameter(self.offloader.offload(name, self._parameters[name]), requires_grad=False)
+
                         if implicit_dropout_p:
                             self.dropout_fc1 = torch.nn.Dropout(p=implicit_dropout_p)
                             self.dropout_fc2 = torch.nn.Dropout(p=implicit_dropout_p)
                         else:
                             self.dropout_fc1 = self.dropout_fc2 = lambda x: x
 
+                    def get_weights(self, device):
+                        if self.offloader is None:
+                            return self.fc1_weight, self.fc2_weight
+                        weights = self.offloader.fetch(device)
+                        return weights['fc1_weight'], weights['fc2_weight']
+
+                    def fused_fc1(self, x, fc1_weight, fc1_bias):
+                        # x: [E, R, M], fc1_weight: [E, M, V], fc1_bias: [E, 1, V], so that the [E, R, V] hidden tensor is written once by the epilogue
+                        return bias_activation_dropout(torch.matmul(x, fc1_weight), fc1_bias, fused_activation, implicit_dropout_p if self.training else 0)
+
+                    def forward_grouped(self, x, expert_counts):
+                        # Variable-size grouped GEMM: rows of x are grouped by local expert with `expert_counts` rows each
+                        if self.skip_expert:
+                            return x
+                        if checkpoint_ffn and torch.is_grad_enabled():
+                            return torch.utils.checkpoint.checkpoint(self.compute_grouped, x, expert_counts, use_reentrant=False)
+                        return self.compute_grouped(x, expert_counts)
+
+                    def compute_grouped(self, x, expert_counts):
+                        fc1_weight, fc2_weight = self.get_weights(x.device)
+                        fc1_weight = fc1_weight.view(self.local_experts, self.model_dim, -1)
+                        fc2_weight = fc2_weight.view(self.local_experts, -1, self.model_dim)
+                        # Biases are gathered per row, since rows of each expert form a variable-size segment
+                        expert_ids = torch.repeat_interleave(torch.arange(self.local_experts, device=x.device), torch.tensor(expert_counts, device=x.device), output_size=x.size(0))
+                        x = grouped_matmul(x, fc1_weight, expert_counts) + self.fc1_bias.view(self.local_experts, -1).index_select(0, expert_ids)
+                        if fused_activation is not None:
+                            x = bias_activation_dropout(x.unsqueeze(0), x.new_zeros([1, 1, x.size(-1)]), fused_activation, implicit_dropout_p if self.training else 0).squeeze(0)
+                        else:
+                            x = activation_fn(x.unsqueeze(0)).squeeze(0)
+                            x = self.dropout_fc1(x)
+                        x = grouped_matmul(x, fc2_weight, expert_counts) + self.fc2_bias.view(self.local_experts, -1).index_select(0, expert_ids)
+                        return self.dropout_fc2(x)
+
                     def extra_repr(self):
                         return 'model_dim=%d, hidden_size=%d, local_experts=%d, bias=%s, fc1_copies=%d' % (self.model_dim, self.hidden_size, self.local_experts, self.fc1_bias is not None, fc1_copies)
 
                     def forward(self, x):
                         if self.skip_expert:
                             return x
+                        # Recompute fc1/activation (and fc2) in backward instead of keeping the [.., hidden_size] activation alive
+                        if checkpoint_ffn and torch.is_grad_enabled():
+                            return torch.utils.checkpoint.checkpoint(self.compute, x, use_reentrant=False)
+                        return self.compute(x)
+
+                    def compute(self, x):
                         if fused_custom_fn is not None:
-                            x = fused_custom_fn(self, x)
-                        elif self.local_experts == 1:
+                            return fused_custom_fn(self, x)
+                        fc1_weight, fc2_weight = self.get_weights(x.device)
+                        if self.local_experts == 1:
                             original_shape, x = x.shape, x.view(-1, self.model_dim)
-                            x = torch.addmm(self.fc1_bias, x, self.fc1_weight)
-                            x = activation_fn(x.unsqueeze(0)).squeeze(0)
-                            x = self.dropout_fc1(x)
-                            x = torch.addmm(self.fc2_bias, x, self.fc2_weight)
+                            if fused_activation is not None:
+                                x = self.fused_fc1(x.unsqueeze(0), fc1_weight, self.fc1_bias.unsqueeze(0)).squeeze(0)
+                            else:
+                                x = torch.addmm(self.fc1_bias, x, fc1_weight)
+                                x = activation_fn(x.unsqueeze(0)).squeeze(0)
+                                x = self.dropout_fc1(x)
+                            x = torch.addmm(self.fc2_bias, x, fc2_weight)
                             x = self.dropout_fc2(x)
                             x = x.view(original_shape)
                         else:
                             x = x.permute(1, 0, 2, 3)
                             original_shape, x = x.shape, x.reshape(self.local_experts, -1, self.model_dim)
-                            x = torch.matmul(x, self.fc1_weight) + self.fc1_bias
-                            x = activation_fn(x)
-                            x = self.dropout_fc1(x)
-                            x = torch.matmul(x, self.fc2_weight) + self.fc2_bias
+                            if fused_activation is not None:
+                                x = self.fused_fc1(x, fc1_weight, self.fc1_bias)
+                            else:
+                                x = torch.matmul(x, fc1_weight) + self.fc1_bias
+                                x = activation_fn(x)
+                                x = self.dropout_fc1(x)
+                            x = torch.matmul(x, fc2_weight) + self.fc2_bias
                             x = self.dropout_fc2(x)
                             x = x.reshape(self.local_experts, original_shape[1], original_shape[2], self.model_dim)
                             x = x.permute(1, 0, 2, 3)
                         return x
 
+                    def _apply(self, fn, *args, **kwargs):
+                        if self.offloader is None:
+                            return super()._apply(fn, *args, **kwargs)
+                        # Keep offloaded weights on host, and only follow dtype conversions of the module
+                        host_weights = {name: self._parameters[name] for name in ('fc1_weight', 'fc2_weight')}
+                        self._parameters.update({name: None for name in host_weights})
+                        try:
+                            super()._apply(fn, *args, **kwargs)
+                        finally:
+                            for name, weight in host_weights.items():
+                                dtype = fn(torch.empty([0], dtype=weight.dtype)).dtype
+                                if dtype != weight.dtype:
+                                    weight = torch.nn.Parameter(self.offloader.offload(name, weight.to(dtype)), requires_grad=False)
+                                self._parameters[name] = weight
+                        return self
+
                     def to(self, *args, **kwargs):
                         self = super().to(*args, **kwargs)
-                        self.fc1_weight = self.fc1_weight.to(*args, **kwargs)
-                        self.fc2_weight = self.fc2_weight.to(*args, **kwargs)
+                        if self.offloader is None:
+                            self.fc1_weight = self.fc1_weight.to(*args, **kwargs)
+                            self.fc2_weight = self.fc2_weight.to(*args, **kwargs)
                         self.fc1_bias = self.fc1_bias.to(*args, **kwargs)
                         self.fc2_bias = self.fc2_bias.to(*args, **kwargs)
                         return self
@@ -351,6 +834,15 @@ class MOELayer(torch.nn.Module):
                 gate_type["fp32_gate"] = kwargs["fp32_gate"]
 
             self.gate = TopKGate(model_dim=model_dim, top_k=gate_type['k'], num_global_experts=self.num_global_experts, **gate_type)
+        elif gate_type['type'] == 'expert_choice':
+            if seeds is not None and seeds[0] is not None:
+                torch.manual_seed(seeds[0])
+            self.gate = ExpertChoiceGate(model_dim=model_dim, num_global_experts=self.num_global_experts, **gate_type)
+        elif gate_type['type'] in ('hash', 'random'):
+            if gate_type['type'] == 'random' and 'seed' not in gate_type and seeds is not None:
+                gate_type = dict(gate_type, seed=seeds[0])
+            gate_class = HashGate if gate_type['type'] == 'hash' else RandomGate
+            self.gate = gate_class(top_k=gate_type.get('k', 1), num_global_experts=self.num_global_experts, **gate_type)
         elif gate_type['type'] == 'megatron':
             self.gate = MegatronLMGate(**gate_type)
             assert isinstance(experts, dict), "Gate type `megatron` requires dict-type expert description."
@@ -359,10 +851,25 @@ class MOELayer(torch.nn.Module):
         else:
             raise Exception("Unrecognized gate_type: %s" % gate_type)
 
+        if workspace_arena or fast_inference:
+            assert isinstance(self.gate, BaseGate), "Gate type `%s` doesn't support workspace_arena or fast_inference." % gate_type['type']
+            self.gate.workspace = BufferArena()
+            self.gate.fast_inference = fast_inference
+
+        if telemetry_interval:
+            assert isinstance(self.gate, BaseGate), "Gate type `%s` doesn't support telemetry." % gate_type['type']
+            self.gate.telemetry = RoutingTelemetry(self.num_global_experts, telemetry_interval)
+
+        if profiler:
+            assert isinstance(self.gate, BaseGate), "Gate type `%s` doesn't support profiler." % gate_type['type']
+            self.gate.profiler = PhaseProfiler()
+
         if seeds is not None and len(seeds) > 2 and seeds[2] is not None:
             torch.manual_seed(seeds[2])
 
-        def expert_fn(dispatched_input):
+        def expert_fn(dispatched_input, expert_counts=None):
+            if expert_counts is not None:
+                return self.experts[0].forward_grouped(dispatched_input, expert_counts)
             if len(self.experts) == 1:
                 expert_output = self.experts[0](dispatched_input)
             else:
@@ -370,9 +877,75 @@ class MOELayer(torch.nn.Module):
                 expert_output = torch.cat([expert(chunk) for chunk, expert in zip(chunks, self.experts)], dim=1)
             return expert_output
 
+        # Dropless routing passes exact per-expert token counts to builtin experts using grouped GEMM
+        expert_fn.accepts_expert_counts = isinstance(experts, dict) and experts.get('grouped_gemm', False) and experts.get('fused_custom_fn') is None
+        expert_fn.skips_empty_slots = isinstance(experts, dict) and experts.get('skip_empty', False)
+        if expert_fn.skips_empty_slots:
+            assert experts['type'] == 'ffn' and experts.get('fused_custom_fn') is None, "Expert option `skip_empty` requires builtin ffn experts without `fused_custom_fn`."
         self.expert_fn = expert_fn
         self.expected_sample_size = 0
 
+        if sample_buckets is not None and sample_buckets != 'pow2':
+            sample_buckets = sorted([int(x) for x in sample_buckets])
+        self.sample_buckets = sample_buckets
+        self.bucket_stats = dict()
+
+    def get_bucket_size(self, sample_size, device=None, agreed=False):
+        if self.sample_buckets == 'pow2':
+            bucket_size = 1 << max(sample_size - 1, 0).bit_length()
+        else:
+            bucket_size = next((x for x in self.sample_buckets if x >= sample_size), sample_size)
+        if not agreed and get_world_size(self.group) > 1:
+            # All ranks must agree on bucket size to keep all_to_all message sizes consistent, which costs a host sync per step
+            bucket_size = torch.tensor([bucket_size], dtype=torch.int64, device=device)
+            dist.all_reduce(bucket_size, op=dist.ReduceOp.MAX, group=self.group)
+            bucket_size = int(bucket_size.item())
+        return bucket_size
+
+    def get_bucket_padding_stats(self):
+        result = dict()
+        for bucket_size, (steps, samples) in sorted(self.bucket_stats.items()):
+            padding = steps * bucket_size - samples
+            result[bucket_size] = {'steps': steps, 'samples': samples, 'padding': padding, 'waste_ratio': padding / (steps * bucket_size)}
+        return result
+
+    def get_workspace_stats(self):
+        workspace = getattr(self.gate, 'workspace', None)
+        return workspace.get_stats() if workspace is not None else None
+
+    def register_telemetry_hook(self, hook):
+        """Calls `hook(metrics)` with the routing metrics of this rank once per telemetry interval"""
+        assert getattr(self.gate, 'telemetry', None) is not None, "Telemetry hook requires `telemetry_interval` > 0 in MOELayer."
+        self.gate.telemetry.hooks.append(hook)
+
+    def get_telemetry(self, wait=False):
+        """Returns the last fetched routing metrics, or with `wait`, flushes and returns metrics of steps since the last interval"""
+        telemetry = getattr(self.gate, 'telemetry', None)
+        if telemetry is None:
+            return None
+        if wait:
+            telemetry.flush()
+        telemetry.poll(wait=wait)
+        return telemetry.last_metrics
+
+    def get_profile_stats(self):
+        """Returns count, mean and percentiles (in ms) of each completed phase, e.g. {'expert.forward': {'p50_ms': ..}, ..}"""
+        profiler = getattr(self.gate, 'profiler', None)
+        return profiler.get_stats() if profiler is not None else None
+
+    def export_profile_trace(self, path):
+        """Writes completed phases as Chrome trace JSON (viewable in chrome://tracing or Perfetto), using the rank as pid"""
+        assert getattr(self.gate, 'profiler', None) is not None, "Profile trace requires `profiler` = True in MOELayer."
+        self.gate.profiler.export_chrome_trace(path, pid=get_world_rank(self.group))
+
+    def save_checkpoint(self, path):
+        """Saves local experts of each rank as its own shard under directory `path` (collective across ranks of `group`)"""
+        save_sharded_checkpoint(self, path)
+
+    def load_checkpoint(self, path):
+        """Loads a checkpoint of `save_checkpoint`, which may be saved with a different world size or `count_per_node`"""
+        load_sharded_checkpoint(self, path)
+
     def get_parameter_iterator(self, param_type):
         if param_type == 'gate':
             return self.gate.named_parameters()
@@ -387,24 +960,51 @@ class MOELayer(torch.nn.Module):
             result_output.l_aux = None
             return self.result_func(result_output) if self.result_func is not None else result_output
 
+        if getattr(self.gate, 'workspace', None) is not None:
+            self.gate.workspace.new_step()
+        if getattr(self.gate, 'profiler', None) is not None:
+            self.gate.profiler.new_step()
+
         original_shape, original_dtype  = input.shape, input.dtype
         assert len(input.shape) >= 2, "Input data must be at least 2D tensor: (s)amples, .., (m)odel_dim"
         reshaped_input = input.reshape(-1, input.shape[-1])
         reshaped_input_samples = reshaped_input.shape[0]
+        token_ids = kwargs.get('token_ids', None)
+        if token_ids is not None:
+            token_ids = token_ids.reshape(-1)
+            assert token_ids.size(0) == reshaped_input_samples, "Token_ids must contain one id per sample, while receiving %d ids for %d samples." % (token_ids.size(0), reshaped_input_samples)
+
+        if self.sample_buckets is not None:
+            max_sample_size = kwargs.get('max_sample_size', None)
+            if max_sample_size is not None:
+                assert max_sample_size >= reshaped_input.size(0), "Max_sample_size (%d) must cover the local sample size (%d)." % (max_sample_size, reshaped_input.size(0))
+                self.expected_sample_size = self.get_bucket_size(int(max_sample_size), agreed=True)
+            else:
+                self.expected_sample_size = self.get_bucket_size(reshaped_input.size(0), reshaped_input.device)
+            steps, samples = self.bucket_stats.get(self.expected_sample_size, (0, 0))
+            self.bucket_stats[self.expected_sample_size] = (steps + 1, samples + reshaped_input.size(0))
+        else:
+            self.expected_sample_size = self.expected_sample_size or reshaped_input.size(0)
 
-        self.expected_sample_size = self.expected_sample_size or reshaped_input.size(0)
         if reshaped_input.size(0) != self.expected_sample_size:
             if reshaped_input.size(0) > self.expected_sample_size:
                 raise Exception('MoE JIT is designed to work on sample size = %s, while receiving sample size = %s (> %s)' % (self.expected_sample_size, reshaped_input.size(0), self.expected_sample_size))
             else:
-                if get_world_rank(self.group) == 0:
+                if self.sample_buckets is None and get_world_rank(self.group) == 0:
                     logging.warning('MoE is initialized to keep working on sample size = %s, while receiving sample size = %s (will slow down this forward step)' % (self.expected_sample_size, reshaped_input.size(0)))
-                pad_input = torch.zeros([self.expected_sample_size, self.model_dim], dtype=reshaped_input.dtype, layout=reshaped_input.layout, device=reshaped_input.device)
+                pad_input = allocate(getattr(self.gate, 'workspace', None), 'pad_input', [self.expected_sample_size, self.model_dim], reshaped_input.dtype, reshaped_input.device, zero=True)
                 pad_input[:reshaped_input.size(0)] = reshaped_input
                 reshaped_input = pad_input
+                if token_ids is not None:
+                    token_ids = torch.cat([token_ids, token_ids.new_zeros([self.expected_sample_size - token_ids.size(0)])])
 
         reshaped_input = reshaped_input.to(next(iter(self.experts.parameters())).dtype)
-        result_output, l_aux = self.gate.apply_on_expert_fn(reshaped_input, self.expert_fn, self.group, sharded_count=self.sharded_count)
+        telemetry = getattr(self.gate, 'telemetry', None)
+        if telemetry is not None:
+            telemetry.valid_samples = reshaped_input_samples
+        result_output, l_aux = self.gate.apply_on_expert_fn(reshaped_input, self.expert_fn, self.group, sharded_count=self.sharded_count, a2a_ffn_overlap_degree=self.a2a_ffn_overlap_degree, use_2dh=self.use_2dh, a2a_compress=self.a2a_compress, token_ids=token_ids)
+        if telemetry is not None:
+            telemetry.end_step()
 
         result_output = result_output[:reshaped_input_samples, :]
         result_output = result_output.view(original_shape).to(original_dtype)
@@ -0,0 +1,101 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import os
+import mmap
+import tempfile
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+
+# Offloaded layers in the order of their first forward, so that each layer prefetches the next one
+offload_order = []
+prefetch_executor = ThreadPoolExecutor(max_workers=1)
+copy_streams = dict()
+
+
+def get_copy_stream(device):
+    if device not in copy_streams:
+        copy_streams[device] = torch.cuda.Stream(device)
+    return copy_streams[device]
+
+
+class ExpertWeightOffloader:
+    """Keeps expert weights in pinned host memory (`mode='pinned'`) or memory-mapped files (`mode='mmap'`)
+
+    Weights are streamed to the compute device on `fetch`, which also prefetches the weights of the next offloaded
+    layer in forward order: host-to-device copies run on a side CUDA stream, while CPU compute devices read the
+    host tensors in place, with readahead of evicted pages of memory-mapped weights requested by madvise(MADV_WILLNEED).
+
+    Files of an explicit `path` are kept as `<name>_rank<rank>_<dtype>.bin`, and mapped again as they are if they exist
+    with the same size, so that a restarted process reuses them, otherwise files are temporary.
+    """
+
+    def __init__(self, mode, path=None, rank=0):
+        if mode not in ('pinned', 'mmap'):
+            raise Exception('Expert offload mode is not recognized: %s. Valid modes include: pinned, mmap.' % mode)
+        self.mode, self.path, self.rank = mode, path, rank
+        self.host_tensors, self.mmaps = dict(), dict()
+        self.pending = None
+
+    def map_file(self, name, tensor):
+        nbytes = tensor.numel() * tensor.element_size()
+        if self.path is None:
+            fd, filename = tempfile.mkstemp(prefix='tutel_expert_%s_' % name, suffix='.bin')
+            os.close(fd)
+        else:
+            filename = os.path.join(self.path, '%s_rank%d_%s.bin' % (name, self.rank, str(tensor.dtype).split('.')[-1]))
+        if not os.path.exists(filename) or os.path.getsize(filename) != nbytes:
+            with open(filename, 'wb') as fp:
+                tensor.view(-1).view(torch.uint8).numpy().tofile(fp)
+        with open(filename, 'r+b') as fp:
+            # The shared mapping stays file-backed after closing (or unlinking), so that its pages can be evicted and paged in again
+            self.mmaps[name] = mmap.mmap(fp.fileno(), nbytes)
+        if self.path is None:
+            os.remove(filename)
+        return torch.frombuffer(self.mmaps[name], dtype=tensor.dtype).view(tensor.shape)
+
+    def offload(self, name, tensor):
+        tensor = tensor.detach().to('cpu').contiguous()
+        if self.mode == 'pinned':
+            host_tensor = tensor.pin_memory() if torch.cuda.is_available() else tensor
+        else:
+            host_tensor = self.map_file(name, tensor)
+        self.host_tensors[name], self.pending = host_tensor, None
+        return host_tensor
+
+    def load(self, device):
+        if device.type == 'cpu':
+            if self.mode == 'mmap' and hasattr(mmap, 'MADV_WILLNEED'):
+                for mapped in self.mmaps.values():
+                    mapped.madvise(mmap.MADV_WILLNEED)
+            return dict(self.host_tensors), None
+        stream = get_copy_stream(device)
+        with torch.cuda.stream(stream):
+            tensors = {name: tensor.to(device, non_blocking=True) for name, tensor in self.host_tensors.items()}
+            event = torch.cuda.Event()
+            event.record(stream)
+        return tensors, event
+
+    def prefetch(self, device):
+        if self.pending is None or self.pending[0] != device:
+            self.pending = (device, prefetch_executor.submit(self.load, device))
+
+    def fetch(self, device):
+        device = torch.device(device)
+        self.prefetch(device)
+        tensors, event = self.pending[1].result()
+        self.pending = None
+        if event is not None:
+            stream = torch.cuda.current_stream(device)
+            stream.wait_event(event)
+            for tensor in tensors.values():
+                tensor.record_stream(stream)
+
+        offload_order[:] = [ref for ref in offload_order if ref() is not None]
+        if weakref.ref(self) not in offload_order:
+            offload_order.append(weakref.ref(self))
+        offload_order[(offload_order.index(weakref.ref(self)) + 1) % len(offload_order)]().prefetch(device)
+        return tensors
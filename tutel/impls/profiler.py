@@ -0,0 +1,112 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import json
+import time
+import collections
+
+import torch
+
+
+class BackwardMark(torch.autograd.Function):
+    """Identity in forward, calling `callback` once gradients reach this point in backward"""
+    @staticmethod
+    def forward(ctx, callback, input):
+        ctx.callback = callback
+        return input.view_as(input)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        ctx.callback()
+        return (None, grad_output)
+
+
+class PhaseProfiler:
+    """Times phases of MoE steps in forward and backward, without any device synchronization
+
+    Each phase is a span between two timestamps: CUDA events recorded on the current stream for CUDA tensors, or wall
+    clock for CPU tensors. Backward spans are delimited by identity autograd functions placed on the phase output and
+    input. Spans are only resolved once their events have completed, so that querying never blocks the device.
+    """
+
+    def __init__(self, max_samples=1000):
+        self.durations = collections.defaultdict(lambda: collections.deque(maxlen=max_samples))
+        self.trace_events = collections.deque(maxlen=max_samples * 16)
+        self.max_pending = max_samples * 16
+        self.pending = []
+        self.reference = None
+
+    def timestamp(self, device):
+        if device.type != 'cuda':
+            return time.perf_counter()
+        event = torch.cuda.Event(enable_timing=True)
+        event.record()
+        return event
+
+    def begin(self, phase, tensor):
+        """Starts the forward span of `phase` on `tensor`, and returns the tensor marked to end its backward span"""
+        if self.reference is None:
+            self.reference = self.timestamp(tensor.device)
+        span = {'phase': phase, 'forward': [self.timestamp(tensor.device), None], 'backward': None, 'device': tensor.device}
+        self.pending.append(span)
+        if tensor.requires_grad and torch.is_grad_enabled():
+            span['backward'] = [None, None]
+            def end_backward():
+                span['backward'][1] = self.timestamp(span['device'])
+            tensor = BackwardMark.apply(end_backward, tensor)
+        return tensor, span
+
+    def end(self, span, tensor):
+        """Ends the forward span, and returns the tensor marked to start the backward span of the same phase"""
+        span['forward'][1] = self.timestamp(span['device'])
+        if span['backward'] is not None and tensor.requires_grad and torch.is_grad_enabled():
+            def begin_backward():
+                span['backward'][0] = self.timestamp(span['device'])
+            tensor = BackwardMark.apply(begin_backward, tensor)
+        else:
+            span['backward'] = None
+        return tensor
+
+    def elapsed(self, start, stop):
+        if isinstance(start, float):
+            return (stop - start) * 1e3
+        return start.elapsed_time(stop)
+
+    def is_ready(self, markers):
+        return all(x is not None and (isinstance(x, float) or x.query()) for x in markers)
+
+    def resolve(self):
+        """Moves completed spans into statistics and trace events, skipping the ones whose events are still in flight"""
+        pending = []
+        for span in self.pending:
+            for tid, direction in enumerate(('forward', 'backward')):
+                markers = span[direction]
+                if markers is None or not self.is_ready(markers + [self.reference]):
+                    continue
+                start, stop = markers
+                self.durations[(span['phase'], direction)].append(self.elapsed(start, stop))
+                self.trace_events.append({'name': span['phase'], 'cat': direction, 'ph': 'X', 'tid': tid,
+                    'ts': self.elapsed(self.reference, start) * 1e3, 'dur': self.elapsed(start, stop) * 1e3})
+                span[direction] = None
+            if span['forward'] is not None or span['backward'] is not None:
+                pending.append(span)
+        # Spans whose backward never runs (e.g. forward with gradients but without backward) are eventually discarded
+        self.pending = pending[-self.max_pending:]
+
+    def new_step(self):
+        self.resolve()
+
+    def get_stats(self):
+        self.resolve()
+        stats = dict()
+        for (phase, direction), durations in self.durations.items():
+            values = sorted(durations)
+            percentile = lambda p: values[min(int(p / 100.0 * len(values)), len(values) - 1)]
+            stats['%s.%s' % (phase, direction)] = {'count': len(values), 'mean_ms': sum(values) / len(values), 'p50_ms': percentile(50), 'p90_ms': percentile(90), 'p99_ms': percentile(99)}
+        return stats
+
+    def export_chrome_trace(self, path, pid=0):
+        self.resolve()
+        with open(path, 'w') as fp:
+            thread_names = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': direction}} for tid, direction in enumerate(('forward', 'backward'))]
+            json.dump({'traceEvents': thread_names + [dict(event, pid=pid) for event in self.trace_events]}, fp)
@@ -0,0 +1,102 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import math
+
+import torch
+
+
+class RoutingTelemetry:
+    """Accumulates routing statistics of a gate on device, and fetches them asynchronously every `interval` steps
+
+    Statistics are kept in one device tensor, so that each interval only issues one non-blocking device-to-host copy,
+    whose results are reported to hooks by a later step once the copy has completed.
+    """
+
+    def __init__(self, num_global_experts, interval=100):
+        assert interval > 0, "Telemetry interval must be positive, while receiving %s." % interval
+        self.num_global_experts, self.interval = num_global_experts, interval
+        self.hooks = []
+        self.totals = None
+        self.steps, self.capacity_slots, self.has_entropy = 0, 0, False
+        self.valid_samples = None
+        self.pending = None
+        self.last_metrics = None
+
+    def get_totals(self, device):
+        # [0, GE): routed assignments, [GE, 2 * GE): kept assignments, then tokens, unrouted tokens and gate entropy sum
+        if self.totals is None or self.totals.device != device:
+            self.totals = torch.zeros([2 * self.num_global_experts + 3], dtype=torch.float64, device=device)
+        return self.totals
+
+    def record_routing(self, indices_s, locations_s=None, capacity=None):
+        GE = self.num_global_experts
+        indices = torch.stack([x.view(-1) for x in indices_s]).long()
+        S = indices.size(1)
+        valid = (indices >= 0) & (torch.arange(S, device=indices.device) < (self.valid_samples or S))
+        kept = valid if locations_s is None else valid & (torch.stack([x.view(-1) for x in locations_s]) < capacity)
+
+        totals = self.get_totals(indices.device)
+        totals[:GE] += torch.bincount(indices[valid], minlength=GE).to(totals.dtype)
+        totals[GE:2 * GE] += torch.bincount(indices[kept], minlength=GE).to(totals.dtype)
+        tokens = min(self.valid_samples or S, S)
+        totals[2 * GE] += tokens
+        totals[2 * GE + 1] += tokens - kept.any(dim=0).sum()
+        if capacity is not None:
+            self.capacity_slots += GE * capacity
+
+    def record_gates(self, gates):
+        gates = gates.detach()[:self.valid_samples].float()
+        totals = self.get_totals(gates.device)
+        totals[-1] -= (gates * torch.log(gates.clamp(min=1e-9))).sum()
+        self.has_entropy = True
+
+    def end_step(self):
+        self.steps += 1
+        self.poll()
+        if self.steps >= self.interval:
+            self.flush()
+
+    def flush(self):
+        if self.totals is None:
+            return
+        self.poll(wait=True)
+        totals, self.totals = self.totals, None
+        if totals.is_cuda:
+            host_totals = totals.to('cpu', non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+        else:
+            host_totals, event = totals, None
+        self.pending = (host_totals, event, self.steps, self.capacity_slots, self.has_entropy)
+        self.steps, self.capacity_slots, self.has_entropy = 0, 0, False
+
+    def poll(self, wait=False):
+        if self.pending is None:
+            return
+        host_totals, event, steps, capacity_slots, has_entropy = self.pending
+        if event is not None and not wait and not event.query():
+            return
+        if event is not None:
+            event.synchronize()
+        self.pending = None
+        self.last_metrics = self.get_metrics(host_totals.tolist(), steps, capacity_slots, has_entropy)
+        for hook in self.hooks:
+            hook(self.last_metrics)
+
+    def get_metrics(self, totals, steps, capacity_slots, has_entropy):
+        GE = self.num_global_experts
+        expert_counts, kept_counts = totals[:GE], totals[GE:2 * GE]
+        tokens, unrouted, entropy = totals[2 * GE:]
+        routed, kept = sum(expert_counts), sum(kept_counts)
+        return {
+            'steps': steps,
+            'tokens': int(tokens),
+            'expert_counts': [int(x) for x in expert_counts],
+            'drop_rate': (routed - kept) / routed if routed else 0.0,
+            'unrouted_rate': unrouted / tokens if tokens else 0.0,
+            'capacity_utilization': kept / capacity_slots if capacity_slots else None,
+            'load_imbalance': max(expert_counts) * GE / routed if routed else None,
+            'gate_entropy': entropy / tokens if has_entropy and tokens else None,
+            'max_gate_entropy': math.log(GE),
+        }
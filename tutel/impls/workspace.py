@@ -0,0 +1,64 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import torch
+
+
+def _storage_use_count(tensor):
+    return torch._C._storage_Use_Count(tensor.untyped_storage()._cdata)
+
+try:
+    _storage_use_count(torch.empty([1]))
+    IS_USE_COUNT_AVAILABLE = True
+except:
+    IS_USE_COUNT_AVAILABLE = False
+
+
+class BufferArena:
+    """Per-layer workspace that reuses step buffers of the same (name, shape, dtype, device) across steps
+
+    A buffer is handed out as a fresh view, and is only reused once no tensor (including the ones saved by autograd)
+    still shares its storage, so that buffers alive in a pending backward or another micro-batch are never overwritten.
+    """
+
+    def __init__(self):
+        self.buffers = dict()
+        self.step_bytes = {'allocated': 0, 'reused': 0}
+        self.last_step_bytes = dict(self.step_bytes)
+
+    def get(self, name, shape, dtype, device, zero=False):
+        shape = tuple(shape)
+        nbytes = torch.Size(shape).numel() * torch.empty([], dtype=dtype).element_size()
+        if not IS_USE_COUNT_AVAILABLE:
+            self.step_bytes['allocated'] += nbytes
+            return torch.zeros(shape, dtype=dtype, device=device) if zero else torch.empty(shape, dtype=dtype, device=device)
+
+        candidates = self.buffers.setdefault((name, shape, dtype, torch.device(device)), [])
+        for buffer, idle_count in candidates:
+            if _storage_use_count(buffer) <= idle_count:
+                self.step_bytes['reused'] += nbytes
+                break
+        else:
+            buffer = torch.empty(shape, dtype=dtype, device=device)
+            candidates.append((buffer, _storage_use_count(buffer)))
+            self.step_bytes['allocated'] += nbytes
+        output = buffer.view(shape)
+        return output.zero_() if zero else output
+
+    def new_step(self):
+        self.last_step_bytes, self.step_bytes = self.step_bytes, {'allocated': 0, 'reused': 0}
+
+    def reserved_bytes(self):
+        return sum(buffer.numel() * buffer.element_size() for candidates in self.buffers.values() for buffer, _ in candidates)
+
+    def get_stats(self):
+        return {'allocated_bytes': self.last_step_bytes['allocated'], 'reused_bytes': self.last_step_bytes['reused'], 'reserved_bytes': self.reserved_bytes()}
+
+    def clear(self):
+        self.buffers.clear()
+
+
+def allocate(workspace, name, shape, dtype, device, zero=False):
+    if workspace is None:
+        return torch.zeros(shape, dtype=dtype, device=device) if zero else torch.empty(shape, dtype=dtype, device=device)
+    return workspace.get(name, shape, dtype, device, zero=zero)
@@ -0,0 +1,171 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import torch
+import torch.nn.functional as F
+from ..impls.jit_compiler import JitCompiler
+
+
+epilogue_kernels = dict()
+supported_activations = ('relu', 'gelu', 'swiglu')
+
+# Dropout keeps element i if hash(i + seed) >= threshold, so that backward regenerates the mask from the seed instead of
+# saving it; hash constants stay below 2^31 to let the CPU implementation emulate uint32 arithmetic with int64 tensors
+HASH_FUNC = '''
+    __device__ __forceinline__ unsigned int keep_hash(unsigned int x) {
+      x ^= x >> 16; x *= 0x7feb352du;
+      x ^= x >> 15; x *= 0x2c1b3c6du;
+      x ^= x >> 16;
+      return x;
+    }
+'''
+
+def keep_hash(x):
+  x = x & 0xFFFFFFFF
+  x = ((x ^ (x >> 16)) * 0x7feb352d) & 0xFFFFFFFF
+  x = ((x ^ (x >> 15)) * 0x2c1b3c6d) & 0xFFFFFFFF
+  return x ^ (x >> 16)
+
+
+def get_dropout_threshold(dropout_p):
+  return min(int(dropout_p * 4294967296.0), 4294967295)
+
+
+# Reference epilogue on plain tensor ops, used for CPU and for dtypes without CUDA kernels (e.g. bfloat16, which runs unfused)
+def reference_epilogue_forward(hidden, bias, seed, activation, dropout_p):
+  x = hidden + bias
+  if activation == 'relu':
+    y = F.relu(x)
+  elif activation == 'gelu':
+    y = F.gelu(x)
+  else:
+    gate, up = x.chunk(2, dim=-1)
+    y = F.silu(gate) * up
+  if dropout_p > 0:
+    index = torch.arange(y.numel(), dtype=torch.int64, device=y.device).view(y.shape)
+    keep = keep_hash(index + seed) >= get_dropout_threshold(dropout_p)
+    y = torch.where(keep, y * (1.0 / (1.0 - dropout_p)), torch.zeros_like(y))
+  return y
+
+
+def reference_epilogue_backward(hidden, bias, seed, grad_output, activation, dropout_p):
+  with torch.enable_grad():
+    hidden = hidden.detach().requires_grad_()
+    output = reference_epilogue_forward(hidden, bias.detach(), seed, activation, dropout_p)
+  return torch.autograd.grad(output, hidden, grad_output)[0]
+
+
+def get_epilogue_kernels(activation, dropout_p, dtype):
+  # Shapes are runtime arguments, so that variable per-step row counts (e.g. dropless or grouped experts) reuse one kernel
+  key = (activation, dropout_p, dtype)
+  if key in epilogue_kernels:
+    return epilogue_kernels[key]
+
+  keyword_dict = {
+    'in_hidden_copies': 2 if activation == 'swiglu' else 1,
+    'dtype': {torch.float32: 'float', torch.float16: '__half'}[dtype],
+    'ACTIVATION': supported_activations.index(activation), 'DROPOUT': 1 if dropout_p > 0 else 0,
+    'threshold': get_dropout_threshold(dropout_p), 'scale': repr(1.0 / (1.0 - dropout_p)),
+  }
+  # params = [numel, rows, hidden, seed]
+  header = '''
+    #define numel (params[0])
+    #define rows (params[1])
+    #define hidden (params[2])
+    #define seed (params[3])
+    #define in_hidden (hidden * @in_hidden_copies@)
+    #define __dtype @dtype@
+  ''' + HASH_FUNC
+
+  # output[e, r, v] = dropout(activation(input[e, r, v] + bias[e, v])), with gate/up halves of input for swiglu
+  forward = JitCompiler.generate_kernel(keyword_dict, header + '''
+    extern "C" __global__ __launch_bounds__(1024) void execute(__dtype* __restrict__ input, __dtype* __restrict__ bias, long long* __restrict__ params, __dtype* __restrict__ output) {
+      // [thread_extent] blockIdx.x = 512
+      // [thread_extent] threadIdx.x = 1024
+      for (long long i = blockIdx.x * 1024LL + threadIdx.x; i < numel; i += gridDim.x * 1024LL) {
+        long long row = i / hidden, col = i % hidden, bias_offset = (row / rows) * in_hidden + col;
+        float x = float(input[row * in_hidden + col]) + float(bias[bias_offset]), y;
+    #if @ACTIVATION@ == 0
+        y = x > 0.0f ? x : 0.0f;
+    #elif @ACTIVATION@ == 1
+        y = 0.5f * x * (1.0f + erff(x * 0.70710678118654752f));
+    #else
+        y = x / (1.0f + expf(-x)) * (float(input[row * in_hidden + hidden + col]) + float(bias[bias_offset + hidden]));
+    #endif
+    #if @DROPOUT@
+        y = keep_hash((unsigned int)i + (unsigned int)seed) >= @threshold@u ? y * @scale@f : 0.0f;
+    #endif
+        output[i] = __dtype(y);
+      }
+    }
+  ''')
+
+  backward = JitCompiler.generate_kernel(keyword_dict, header + '''
+    extern "C" __global__ __launch_bounds__(1024) void execute(__dtype* __restrict__ input, __dtype* __restrict__ bias, long long* __restrict__ params, __dtype* __restrict__ grad_output, __dtype* __restrict__ grad_input) {
+      // [thread_extent] blockIdx.x = 512
+      // [thread_extent] threadIdx.x = 1024
+      for (long long i = blockIdx.x * 1024LL + threadIdx.x; i < numel; i += gridDim.x * 1024LL) {
+        long long row = i / hidden, col = i % hidden, bias_offset = (row / rows) * in_hidden + col;
+        float x = float(input[row * in_hidden + col]) + float(bias[bias_offset]), gy = float(grad_output[i]);
+    #if @DROPOUT@
+        gy = keep_hash((unsigned int)i + (unsigned int)seed) >= @threshold@u ? gy * @scale@f : 0.0f;
+    #endif
+    #if @ACTIVATION@ == 0
+        grad_input[row * in_hidden + col] = __dtype(x > 0.0f ? gy : 0.0f);
+    #elif @ACTIVATION@ == 1
+        float cdf = 0.5f * (1.0f + erff(x * 0.70710678118654752f)), pdf = expf(-0.5f * x * x) * 0.39894228040143268f;
+        grad_input[row * in_hidden + col] = __dtype(gy * (cdf + x * pdf));
+    #else
+        float up = float(input[row * in_hidden + hidden + col]) + float(bias[bias_offset + hidden]), sig = 1.0f / (1.0f + expf(-x));
+        grad_input[row * in_hidden + col] = __dtype(gy * up * sig * (1.0f + x * (1.0f - sig)));
+        grad_input[row * in_hidden + hidden + col] = __dtype(gy * x * sig);
+    #endif
+      }
+    }
+  ''')
+  epilogue_kernels[key] = forward, backward
+  return forward, backward
+
+
+class BiasActivationDropout(torch.autograd.Function):
+  """Fused epilogue of expert fc1: dropout(activation(input + bias)), writing the hidden tensor once
+
+  Input is [E, R, V] (or [E, R, 2 * V] for swiglu) with bias of [E, 1, V]; only input and bias are saved for backward,
+  and dropout masks are regenerated from the seed. CUDA kernels cover float32 and float16, while other dtypes (e.g. bfloat16)
+  and CPU tensors run the unfused reference epilogue.
+  """
+  @staticmethod
+  def forward(ctx, input, bias, activation, dropout_p):
+    input, bias = input.contiguous(), bias.contiguous()
+    # Seed is drawn from the host generator, so that no device synchronization is needed
+    ctx.seed = int(torch.randint(1 << 30, [1])) if dropout_p > 0 else 0
+    ctx.activation, ctx.dropout_p = activation, dropout_p
+    ctx.save_for_backward(input, bias)
+    if not input.is_cuda or input.dtype not in (torch.float32, torch.float16):
+      return reference_epilogue_forward(input, bias, ctx.seed, activation, dropout_p)
+
+    E, R, in_hidden = input.shape
+    hidden = in_hidden // (2 if activation == 'swiglu' else 1)
+    output = torch.empty([E, R, hidden], dtype=input.dtype, device=input.device)
+    ctx.kernels = get_epilogue_kernels(activation, dropout_p, input.dtype)
+    ctx.params = torch.tensor([output.numel(), R, hidden, ctx.seed], dtype=torch.int64).to(input.device, non_blocking=True)
+    ctx.kernels[0](input, bias, ctx.params, output)
+    return output
+
+  @staticmethod
+  def backward(ctx, grad_output):
+    input, bias = ctx.saved_tensors
+    grad_output = grad_output.contiguous()
+    if not hasattr(ctx, 'kernels'):
+      grad_input = reference_epilogue_backward(input, bias, ctx.seed, grad_output, ctx.activation, ctx.dropout_p)
+    else:
+      grad_input = torch.empty_like(input)
+      ctx.kernels[1](input, bias, ctx.params, grad_output, grad_input)
+    grad_bias = grad_input.sum(dim=1, keepdim=True)
+    return (grad_input, grad_bias, None, None)
+
+
+def bias_activation_dropout(input, bias, activation, dropout_p=0.0):
+  assert activation in supported_activations, "Unsupported fused activation: %s. Valid activations include: %s." % (activation, ', '.join(supported_activations))
+  assert 0 <= dropout_p < 1, "Fused dropout probability must be in [0, 1), while receiving %s." % dropout_p
+  return BiasActivationDropout.apply(input, bias, activation, float(dropout_p))
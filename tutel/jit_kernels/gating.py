@@ -10,7 +10,12 @@ from ..impls.jit_compiler import JitCompiler
 disable_fast_cumsum = int(os.environ.get('FAST_CUMSUM', '1')) == 0
 cumsum_kernels = dict()
 
-def get_cumsum_kernel(samples, global_experts):
+def get_cumsum_kernel(samples, global_experts, is_cuda=True):
+
+  if not is_cuda:
+    def cpu_cumsum(mask1):
+        return torch.cumsum(mask1.to(torch.int32), dim=0, dtype=torch.int32) - 1
+    return cpu_cumsum
 
   if disable_fast_cumsum:
     logging.warning("Optimized cumsum is disabled, and may result in big performance regression.")
@@ -78,4 +83,33 @@ def get_cumsum_kernel(samples, global_experts):
 def fast_cumsum_sub_one(data, dim=0):
   if data.dim() != 2 or dim != 0:
     raise Exception("Unimplemented fast_cumsum_sub_one() of data = %s and dim = %s" % (data.size(), dim))
-  return get_cumsum_kernel(data.size(0), data.size(1))(data)
+  return get_cumsum_kernel(data.size(0), data.size(1), is_cuda=data.is_cuda)(data)
+
+def fast_topk_locations(topk_indices, num_global_experts, importance_scores=None):
+  """Locations of all top-k assignments in one pass, without dense one-hot masks
+
+  The result equals a cumsum over the k-major stacked one-hot mask [k * samples, global_experts]:
+  each assignment's location is the number of earlier assignments (lower k first, then lower sample index)
+  routed to the same expert. It is computed by a single sort over unique keys (expert, k, sample).
+
+  For batch prioritized routing, samples are ordered by ascending `importance_scores` instead of their index,
+  using one sort of the scores shared by all k slots, whose inverse permutation is built by scatter.
+  """
+  samples, top_k = topk_indices.size(0), topk_indices.size(1)
+  num_assignments = samples * top_k
+  expert_ids = topk_indices.t().reshape(-1).long()
+  sample_ranks = torch.arange(samples, device=topk_indices.device)
+  if importance_scores is not None:
+    try:
+      importance_order = torch.sort(importance_scores, stable=True)[1]
+    except TypeError:
+      importance_order = torch.argsort(importance_scores)
+    sample_ranks = torch.empty_like(sample_ranks).scatter_(0, importance_order, sample_ranks)
+  positions = (torch.arange(top_k, device=topk_indices.device).view(-1, 1) * samples + sample_ranks).view(-1)
+  sorted_keys, order = torch.sort(expert_ids * num_assignments + positions)
+  sorted_experts = sorted_keys // num_assignments
+  expert_counts = torch.bincount(expert_ids, minlength=num_global_experts)
+  expert_starts = torch.cumsum(expert_counts, dim=0) - expert_counts
+  locations = torch.empty([num_assignments], dtype=torch.int32, device=topk_indices.device)
+  locations[order] = (torch.arange(num_assignments, device=topk_indices.device) - expert_starts[sorted_experts]).to(torch.int32)
+  return locations.view(top_k, samples), expert_counts
@@ -14,65 +14,106 @@ def get_kernel_dtype(param_dtype):
       raise Exception("Unrecognized data type: %s" % param_dtype)
 
 
-def create_forward(samples, global_experts, capacity, aligned_dim, param_dtype):
-  return JitCompiler.generate_kernel({'capacity': capacity, 'samples': samples, 'hidden': aligned_dim, 'dtype': get_kernel_dtype(param_dtype), 'IS_FLOAT': 1 if param_dtype == torch.float32 else 0}, '''
+def _cpu_valid_slots(indices1_s, locations1_s, capacity, samples, top_k):
+  # Assignments of all k are flattened as [top_k * samples], so the source row of assignment i is (i % samples)
+  indices1_s, locations1_s = indices1_s.view(-1)[:samples * top_k].long(), locations1_s.view(-1)[:samples * top_k].long()
+  valid = (locations1_s < capacity) & (indices1_s >= 0)
+  return valid, torch.where(valid, indices1_s * capacity + locations1_s, torch.zeros_like(indices1_s))
+
+
+def cpu_forward(gates1_s, indices1_s, locations1_s, reshaped_input, dispatched_input, capacity, samples, hidden, top_k):
+  valid, slots = _cpu_valid_slots(indices1_s, locations1_s, capacity, samples, top_k)
+  gates1_s = gates1_s.view(-1)[:samples * top_k]
+  sel = valid.nonzero().view(-1)
+  dispatched_input = dispatched_input.view(-1, hidden)
+  dispatched_input.index_add_(0, slots[sel], reshaped_input.view(samples, hidden)[sel % samples] * gates1_s[sel].unsqueeze(-1).to(dispatched_input.dtype))
+
+
+def cpu_backward_data(gates1_s, dispatched_input, indices1_s, locations1_s, grad_reshaped_input, capacity, samples, hidden, top_k):
+  valid, slots = _cpu_valid_slots(indices1_s, locations1_s, capacity, samples, top_k)
+  gates1_s = gates1_s.view(-1)[:samples * top_k]
+  sel = valid.nonzero().view(-1)
+  grad_reshaped_input = grad_reshaped_input.view(samples, hidden).zero_()
+  grad_reshaped_input.index_add_(0, sel % samples, dispatched_input.view(-1, hidden)[slots[sel]] * gates1_s[sel].unsqueeze(-1).to(dispatched_input.dtype))
+
+
+def cpu_backward_gate(dispatched_input, indices1_s, locations1_s, reshaped_input, grad_gates1_s, capacity, samples, hidden, top_k):
+  valid, slots = _cpu_valid_slots(indices1_s, locations1_s, capacity, samples, top_k)
+  rows = torch.arange(samples * top_k, device=slots.device) % samples
+  grad = (dispatched_input.view(-1, hidden)[slots] * reshaped_input.view(samples, hidden)[rows]).sum(dim=1)
+  grad_gates1_s.view(-1)[:samples * top_k].copy_(torch.where(valid, grad, torch.zeros_like(grad)))
+
+
+def create_forward(samples, global_experts, capacity, aligned_dim, param_dtype, top_k=1, is_cuda=True):
+  if not is_cuda:
+    return JitCompiler.generate_cpu_kernel({'capacity': capacity, 'samples': samples, 'hidden': aligned_dim, 'top_k': top_k}, cpu_forward)
+  return JitCompiler.generate_kernel({'capacity': capacity, 'samples': samples, 'hidden': aligned_dim, 'top_k': top_k, 'dtype': get_kernel_dtype(param_dtype), 'IS_FLOAT': 1 if param_dtype == torch.float32 else 0}, '''
     #define capacity (@capacity@)
     #define samples (@samples@)
     #define hidden (@hidden@)
+    #define top_k (@top_k@)
     #define __dtype @dtype@
 
     extern "C" __global__ __launch_bounds__(1024) void execute(__dtype* __restrict__ gates1_s, int* __restrict__ indices1_s, int* __restrict__ locations1_s, __dtype* __restrict__ reshaped_input, __dtype* __restrict__ dispatched_input) {
       // [thread_extent] blockIdx.x = 128
       // [thread_extent] threadIdx.x = 1024
 
-      for (int i = blockIdx.x; i < samples; i += gridDim.x)
+      for (int i = blockIdx.x; i < samples * top_k; i += gridDim.x)
           if (locations1_s[i] < capacity && indices1_s[i] >= 0) {
               #pragma unroll
               for (int j = threadIdx.x; j < hidden; j += 1024)
-                  atomicAdd(&dispatched_input[(indices1_s[i] * capacity + locations1_s[i]) * (hidden) + j], gates1_s[i] * reshaped_input[i * (hidden) + j]);
+                  atomicAdd(&dispatched_input[(indices1_s[i] * capacity + locations1_s[i]) * (hidden) + j], gates1_s[i] * reshaped_input[(i % samples) * (hidden) + j]);
           }
     }
   ''')
 
 
-def create_backward_data(samples, global_experts, capacity, aligned_dim, param_dtype):
-  return JitCompiler.generate_kernel({'capacity': capacity, 'samples': samples, 'hidden': aligned_dim, 'dtype': get_kernel_dtype(param_dtype), 'IS_FLOAT': 1 if param_dtype == torch.float32 else 0}, '''
+def create_backward_data(samples, global_experts, capacity, aligned_dim, param_dtype, top_k=1, is_cuda=True):
+  if not is_cuda:
+    return JitCompiler.generate_cpu_kernel({'capacity': capacity, 'samples': samples, 'hidden': aligned_dim, 'top_k': top_k}, cpu_backward_data)
+  return JitCompiler.generate_kernel({'capacity': capacity, 'samples': samples, 'hidden': aligned_dim, 'top_k': top_k, 'dtype': get_kernel_dtype(param_dtype), 'IS_FLOAT': 1 if param_dtype == torch.float32 else 0}, '''
     #define capacity (@capacity@)
     #define samples (@samples@)
     #define hidden (@hidden@)
+    #define top_k (@top_k@)
     #define __dtype @dtype@
 
     extern "C" __global__ __launch_bounds__(1024) void execute(__dtype* __restrict__ gates1_s, __dtype* __restrict__ dispatched_input, int* __restrict__ indices1_s, int* __restrict__ locations1_s, __dtype* __restrict__ grad_reshaped_input) {
       // [thread_extent] blockIdx.x = 128
       // [thread_extent] threadIdx.x = 1024
 
-      for (int i = blockIdx.x; i < samples; i += gridDim.x)
-          if (locations1_s[i] < capacity && indices1_s[i] >= 0) {
-              #pragma unroll
-              for (int j = threadIdx.x; j < hidden; j += 1024)
-                  grad_reshaped_input[i * hidden + j] = gates1_s[i] * dispatched_input[(indices1_s[i] * capacity + locations1_s[i]) * (hidden) + j];
-          } else {
-              #pragma unroll
-              for (int j = threadIdx.x; j < hidden; j += 1024)
+      for (int i = blockIdx.x; i < samples; i += gridDim.x) {
+          #pragma unroll
+          for (int j = threadIdx.x; j < hidden; j += 1024) {
     #if @IS_FLOAT@
-                  grad_reshaped_input[i * hidden + j] = __dtype(0);
+              __dtype grad_rf = __dtype(0);
     #else
-                  grad_reshaped_input[i * hidden + j] = __dtype(0, 0);
+              __dtype grad_rf = __dtype(0, 0);
     #endif
+              #pragma unroll
+              for (int k = 0; k < top_k; ++k) {
+                  int l = k * samples + i;
+                  if (locations1_s[l] < capacity && indices1_s[l] >= 0)
+                      grad_rf += gates1_s[l] * dispatched_input[(indices1_s[l] * capacity + locations1_s[l]) * (hidden) + j];
+              }
+              grad_reshaped_input[i * hidden + j] = grad_rf;
           }
+      }
     }
   ''')
 
 
-def create_backward_gate(samples, global_experts, capacity, aligned_dim, param_dtype):
-  return JitCompiler.generate_kernel({'capacity': capacity, 'samples': samples, 'hidden': aligned_dim, 'dtype': get_kernel_dtype(param_dtype), 'IS_FLOAT': 1 if param_dtype == torch.float32 else 0}, '''
+def create_backward_gate(samples, global_experts, capacity, aligned_dim, param_dtype, top_k=1, is_cuda=True):
+  if not is_cuda:
+    return JitCompiler.generate_cpu_kernel({'capacity': capacity, 'samples': samples, 'hidden': aligned_dim, 'top_k': top_k}, cpu_backward_gate)
+  return JitCompiler.generate_kernel({'capacity': capacity, 'samples': samples, 'hidden': aligned_dim, 'top_k': top_k, 'assignments': samples * top_k, 'dtype': get_kernel_dtype(param_dtype), 'IS_FLOAT': 1 if param_dtype == torch.float32 else 0}, '''
     #define capacity (@capacity@)
     #define samples (@samples@)
     #define hidden (@hidden@)
     #define __dtype @dtype@
 
     extern "C" __global__ __launch_bounds__(32) void execute(__dtype* __restrict__ dispatched_input, int* __restrict__ indices1_s, int* __restrict__ locations1_s, __dtype* __restrict__ reshaped_input, void* __restrict__ grad_gates1_s) {
-      // [thread_extent] blockIdx.x = @samples@
+      // [thread_extent] blockIdx.x = @assignments@
       // [thread_extent] threadIdx.x = 32
       if (locations1_s[(int)blockIdx.x] >= capacity || indices1_s[(int)blockIdx.x] < 0) {
         if (((int)threadIdx.x) == 0)
@@ -90,7 +131,7 @@ def create_backward_gate(samples, global_experts, capacity, aligned_dim, param_d
       __dtype grad_gates1_s_rf = __dtype(0, 0);
     #endif
       for (int i = threadIdx.x; i < hidden; i += 32)
-        grad_gates1_s_rf += dispatched_input[indice * (hidden) + i] * reshaped_input[((int)blockIdx.x) * (hidden) + i];
+        grad_gates1_s_rf += dispatched_input[indice * (hidden) + i] * reshaped_input[(((int)blockIdx.x) % samples) * (hidden) + i];
 
     #if !defined(__HIPCC__)
       __dtype red_buf0[1];